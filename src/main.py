@@ -1,4 +1,5 @@
 from pipeline.pipeline import process_repository, get_current_repo_names
+from pipeline.batch import process_repository_batch, print_batch_summary
 import datetime
 import os
 import argparse
@@ -15,6 +16,12 @@ if __name__ == '__main__':
                        help="A text file containing a repository for each line in the form '<owner>/<name>'")
     group.add_argument('--current-repos', '-c', action='store_true',
                        help="Process the repositories currently stored in the database")
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help="The number of worker processes used to process repositories in parallel when using "
+                             "--repo-list or --current-repos (default: 1)")
+    parser.add_argument('--no-metadata-prefetch', action='store_true',
+                        help="Retrieve the metadata of each repository with the REST API instead of batched GraphQL "
+                             "queries when using --repo-list or --current-repos")
     args = parser.parse_args()
 
     current_datetime = datetime.datetime.now()
@@ -25,10 +32,12 @@ if __name__ == '__main__':
 
     # process repositories from a list in a text file
     elif args.repo_list is not None:
-        for line in args.repo_list:
-            process_repository(line.strip(), current_datetime)
+        results = process_repository_batch(args.repo_list.readlines(), current_datetime, workers=args.workers,
+                                           prefetch=not args.no_metadata_prefetch)
+        print_batch_summary(results, current_datetime)
 
     # process the repositories currently in the database
     elif args.current_repos:
-        for repo_str in get_current_repo_names():
-            process_repository(repo_str, current_datetime)
+        results = process_repository_batch(get_current_repo_names(), current_datetime, workers=args.workers,
+                                           prefetch=not args.no_metadata_prefetch)
+        print_batch_summary(results, current_datetime)
@@ -0,0 +1,129 @@
+import datetime
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tqdm.auto import tqdm
+
+from . import pipeline
+from .github_graphql import prefetch_repository_metadata
+from .pipeline import process_repository, is_valid_repo_name, REPOS_DIR
+
+# the clone directory used by the current worker process (set by the pool initializer)
+_worker_repos_dir = REPOS_DIR
+
+
+def init_worker(worker_counter, repos_dir=REPOS_DIR, num_workers=1):
+    """
+    Initializer for the worker processes of the process pool. Each worker is given its own clone directory so that
+    workers never clone into or delete from a directory that another worker is using, and its share of the LOC workers
+    so that the whole pool runs no more cloc processes than LOC_WORKERS.
+    :param worker_counter: a shared multiprocessing Value used to hand out a unique index to each worker
+    :param repos_dir: the directory to create the clone directories of the workers in
+    :param num_workers: the number of worker processes in the pool
+    :return: None
+    """
+    global _worker_repos_dir
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+
+    _worker_repos_dir = os.path.join(repos_dir, f"worker-{worker_index}")
+    os.makedirs(_worker_repos_dir, exist_ok=True)
+    pipeline.LOC_WORKERS = max(1, pipeline.LOC_WORKERS // num_workers)
+
+
+def process_repository_task(repo_str, start_datetime, metadata=None):
+    """
+    Processes a single repository and records the outcome. Any exception is caught here so that a failure for one
+    repository never affects the other repositories in the batch.
+    :param repo_str: the repository written as '<owner>/<name>'
+    :param start_datetime: the date that the pipeline run began
+    :param metadata: the prefetched repository metadata (optional)
+    :return: a dictionary with the repository string, whether it succeeded, and how long it took in seconds
+    """
+    start = time.monotonic()
+    try:
+        success = process_repository(repo_str, start_datetime, repos_dir=_worker_repos_dir, metadata=metadata)
+    except Exception as e:
+        tqdm.write(f"Unhandled error while processing {repo_str}: {e!r}")
+        success = False
+
+    return {
+        "repository": repo_str,
+        "success": success,
+        "duration": time.monotonic() - start
+    }
+
+
+def prefetch_metadata(repo_strs):
+    """
+    Retrieves the metadata of every valid repository of a batch with batched GraphQL queries
+    :param repo_strs: a list of repository strings written as '<owner>/<name>'
+    :return: a dictionary mapping each repository string to its metadata
+    """
+    valid_repo_strs = [repo_str for repo_str in repo_strs if is_valid_repo_name(repo_str)]
+    metadata, errors = prefetch_repository_metadata(valid_repo_strs)
+    for e in errors:
+        tqdm.write(f"GraphQL metadata prefetch failed for a batch, falling back to the REST API: {e!r}")
+    tqdm.write(f"Prefetched the metadata of {len(metadata)}/{len(valid_repo_strs)} repositories")
+    return metadata
+
+
+def process_repository_batch(repo_strs, start_datetime, workers=1, prefetch=True, repos_dir=REPOS_DIR):
+    """
+    Processes a batch of repositories, either one at a time in the current process or spread across a pool of worker
+    processes. Every worker creates its own logger and MongoClient (inside process_repository) and clones into its own
+    directory.
+    :param repo_strs: an iterable of repository strings written as '<owner>/<name>'
+    :param start_datetime: the date that the pipeline run began
+    :param workers: the number of worker processes to use. 1 processes the repositories in the current process
+    :param prefetch: whether to retrieve the metadata of all repositories with GraphQL before processing them, instead
+    of with three REST calls per repository
+    :param repos_dir: the directory to create the clone directories of the workers in
+    :return: a list of result dictionaries (see process_repository_task), in the order the repositories were given
+    """
+    repo_strs = [repo_str.strip() for repo_str in repo_strs if repo_str.strip()]
+    metadata = prefetch_metadata(repo_strs) if prefetch else {}
+
+    if workers <= 1:
+        return [process_repository_task(repo_str, start_datetime, metadata.get(repo_str)) for repo_str in repo_strs]
+
+    # 'spawn' so that no MongoClient or open git process is inherited from the parent process
+    context = multiprocessing.get_context("spawn")
+    worker_counter = context.Value('i', 0)
+    results = {}
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                             initargs=(worker_counter, repos_dir, workers)) as executor:
+        futures = {executor.submit(process_repository_task, repo_str, start_datetime, metadata.get(repo_str)): index
+                   for index, repo_str in enumerate(repo_strs)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                # the worker process itself died (eg. killed by the OS), only this repository is marked as failed
+                tqdm.write(f"Worker failed while processing {repo_strs[index]}: {e!r}")
+                results[index] = {"repository": repo_strs[index], "success": False, "duration": 0.0}
+
+    return [results[index] for index in range(len(repo_strs))]
+
+
+def print_batch_summary(results, start_datetime):
+    """
+    Prints a summary of a batch run to the console
+    :param results: the list of result dictionaries returned by process_repository_batch
+    :param start_datetime: the date that the pipeline run began
+    :return: None
+    """
+    succeeded = [result for result in results if result["success"]]
+    failed = [result for result in results if not result["success"]]
+    elapsed = datetime.datetime.now() - start_datetime
+
+    tqdm.write(f"Pipeline run summary: {len(results)} repositories processed in "
+               f"{str(elapsed).split('.')[0]} ({len(succeeded)} succeeded, {len(failed)} failed)")
+    for result in sorted(results, key=lambda x: x["duration"], reverse=True):
+        status = "ok" if result["success"] else "FAILED"
+        tqdm.write(f"  {result['repository']:<50} {status:<7} {result['duration']:.1f}s")
@@ -0,0 +1,130 @@
+import datetime
+import subprocess
+from functools import cached_property
+from typing import NamedTuple
+
+import numpy as np
+from tqdm import tqdm
+
+# one line per commit: hexsha, author name and strict ISO 8601 committer date separated by NUL characters
+GIT_LOG_FORMAT = "%H%x00%an%x00%cI"
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+class CommitRecord(NamedTuple):
+    """
+    The commit data used by the commit statistics and the heatmap
+    """
+    hexsha: str
+    author: str
+    committed_datetime: datetime.datetime
+
+
+class CommitIndex:
+    """
+    Every unique commit reachable from the branches and tags of a repository, read in a single walk of the history.
+    The commit statistics and the heatmap all read from the same index instead of walking the history themselves.
+    """
+    def __init__(self, records):
+        self.records = list(records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        return self.records[index]
+
+    @cached_property
+    def authors(self):
+        """
+        The unique author names in the order they were first seen. The position of a name in this list is its author id
+        """
+        return list(dict.fromkeys(record.author for record in self.records))
+
+    @cached_property
+    def author_ids(self):
+        """
+        The author id of each commit (an index into self.authors) as a NumPy int32 array
+        """
+        ids = {author: index for index, author in enumerate(self.authors)}
+        return np.fromiter((ids[record.author] for record in self.records), dtype=np.int32, count=len(self.records))
+
+    @cached_property
+    def timestamps(self):
+        """
+        The committer date of each commit in microseconds since the unix epoch (UTC) as a NumPy int64 array
+        """
+        return np.fromiter(((record.committed_datetime - EPOCH) // MICROSECOND for record in self.records),
+                           dtype=np.int64, count=len(self.records))
+
+    @cached_property
+    def utc_offsets(self):
+        """
+        The UTC offset of each committer date in microseconds as a NumPy int64 array. Adding it to the timestamps gives
+        the committer's local time, which decides the month and week a commit is counted in
+        """
+        return np.fromiter((record.committed_datetime.utcoffset() // MICROSECOND for record in self.records),
+                           dtype=np.int64, count=len(self.records))
+
+
+def as_commit_index(commits):
+    """
+    Wraps an iterable of CommitRecord tuples in a CommitIndex, unless it already is one
+    :param commits: a CommitIndex or an iterable of CommitRecord tuples
+    :return: a CommitIndex
+    """
+    return commits if isinstance(commits, CommitIndex) else CommitIndex(commits)
+
+
+def iter_git_log(repo_path, revisions=("--all",), stdin_revisions=None):
+    """
+    Streams the commits of a repository from 'git log' as CommitRecord tuples. Unlike gitPython's Commit objects,
+    nothing is parsed lazily through 'git cat-file', and only one record is held at a time. The walk uses the
+    repository's commit-graph file when there is one (the mirror cache writes it after every fetch).
+    :param repo_path: the path of the git repository (a working tree or a bare mirror)
+    :param revisions: the revision arguments for 'git log'. Defaults to every commit reachable from any reference
+    :param stdin_revisions: extra revisions (eg. '^<sha>' to exclude a commit and its history) passed through stdin,
+    which avoids command line length limits when there are thousands of them
+    :return: a generator of CommitRecord tuples
+    """
+    # --no-use-mailmap so that author names are the same as the ones recorded in the commits
+    command = ["git", "-C", repo_path, "log", "--no-use-mailmap", "--no-color", f"--format={GIT_LOG_FORMAT}",
+               *revisions]
+    if stdin_revisions is not None:
+        command.append("--stdin")
+
+    authors = {}
+    with subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          encoding="utf-8", errors="replace") as process:
+        # git reads all of the revisions from stdin before it starts writing any output
+        try:
+            process.stdin.write("".join(f"{revision}\n" for revision in stdin_revisions or []))
+            process.stdin.close()
+        except BrokenPipeError:
+            pass  # git exited early, the error is raised from its exit code below
+
+        for line in process.stdout:
+            hexsha, author, date = line.rstrip("\n").split("\x00")
+            # authors appear on many commits, so each name is only stored once
+            author = authors.setdefault(author, author)
+            yield CommitRecord(hexsha, author, datetime.datetime.fromisoformat(date.replace("Z", "+00:00")))
+
+        stderr = process.stderr.read()
+        if process.wait() != 0:
+            raise SystemError(stderr)
+
+
+def build_commit_index(repo_path, revisions=("--all",)):
+    """
+    Builds the commit index for a repository. All references are walked together, so each commit is visited once no
+    matter how many branches and tags it is reachable from.
+    :param repo_path: the path of the git repository (a working tree or a bare mirror)
+    :param revisions: the revision arguments for 'git log'. Defaults to every commit reachable from any reference
+    :return: the CommitIndex for the repository
+    """
+    return CommitIndex(tqdm(iter_git_log(repo_path, revisions), desc="indexing commits"))
@@ -0,0 +1,288 @@
+import datetime
+import subprocess
+
+import numpy as np
+from pymongo import UpdateOne
+
+from .commit_index import EPOCH, MICROSECOND, as_commit_index, iter_git_log
+from .exceptions import InvalidArgumentError
+
+MAX_AUTHORS = 25
+
+# the rolling windows that commit leaderboards can be calculated for (name -> number of days)
+COMMIT_WINDOWS = {"last_7_days": 7, "last_30_days": 30, "last_90_days": 90, "last_365_days": 365}
+DEFAULT_WINDOWS = ("last_30_days",)
+# the leaderboards that are stored for each repository
+LEADERBOARD_WINDOWS = ("last_30_days", "last_90_days", "last_365_days")
+
+# the calendar periods that commits can be grouped by, in the committer's local time
+COMMIT_PERIODS = ("month", "week")
+
+DAY = 24 * 60 * 60 * 1000 * 1000  # in microseconds
+
+
+def count_commits(commits, author_counts=None, month_counts=None):
+    """
+    Tallies the number of commits for each author, and the number of commits and the set of contributors for each
+    month, in a single pass over the commits
+    :param commits: an iterable of CommitRecord tuples
+    :param author_counts: existing author tallies to add the commits to (optional)
+    :param month_counts: existing monthly tallies to add the commits to (optional)
+    :return: a tuple of a dictionary of author name -> number of commits (in the order the authors were first seen) and
+    a dictionary of 'YYYY-MM' -> {"commits": int, "contributors": set of author names}
+    """
+    author_counts = {} if author_counts is None else author_counts
+    month_counts = {} if month_counts is None else month_counts
+    for commit in commits:
+        author_counts[commit.author] = author_counts.get(commit.author, 0) + 1
+        month = commit.committed_datetime.strftime('%Y-%m')
+        if month not in month_counts:
+            month_counts[month] = {"commits": 0, "contributors": set()}
+        month_counts[month]["commits"] += 1
+        month_counts[month]["contributors"].add(commit.author)
+    return author_counts, month_counts
+
+
+def count_commits_in_windows(commits, windows=DEFAULT_WINDOWS, now=None):
+    """
+    Counts the commits of each author in a set of rolling windows ending now. Every window is calculated in the same
+    vectorized pass: each commit is placed in a bucket by the number of window cut offs it is newer than, the buckets
+    are counted per author, and a window's counts are the sum of the buckets newer than its cut off.
+    :param commits: a CommitIndex or an iterable of CommitRecord tuples
+    :param windows: the names of the windows to calculate (keys of COMMIT_WINDOWS)
+    :param now: the current datetime (optional)
+    :return: a dictionary of window name -> NumPy array of the number of commits for each author id of the CommitIndex
+    """
+    windows = tuple(windows)
+    for window in windows:
+        if window not in COMMIT_WINDOWS:
+            raise InvalidArgumentError(f"Unknown commit window: {window}")
+    commit_index = as_commit_index(commits)
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    now = (now - EPOCH) // MICROSECOND
+
+    # the longest window has the earliest cut off
+    days = np.array([COMMIT_WINDOWS[window] for window in windows], dtype=np.int64)
+    order = np.argsort(-days, kind="stable")
+    cut_offs = now - days[order] * DAY
+    num_authors = len(commit_index.authors)
+
+    # bucket i holds the commits that are strictly newer than the first i cut offs
+    buckets = np.searchsorted(cut_offs, commit_index.timestamps, side="left")
+    counts = np.bincount(buckets * num_authors + commit_index.author_ids, minlength=(len(windows) + 1) * num_authors)
+    counts = counts.reshape(len(windows) + 1, num_authors)
+    in_window = np.cumsum(counts[::-1], axis=0)[::-1][1:]
+    return {windows[index]: in_window[position] for position, index in enumerate(order)}
+
+
+def count_commits_per_period(commits, period="month"):
+    """
+    Counts the commits and the unique contributors of each calendar month or ISO week, in the committer's local time
+    :param commits: a CommitIndex or an iterable of CommitRecord tuples
+    :param period: 'month' for 'YYYY-MM' periods or 'week' for ISO 'YYYY-Www' periods
+    :return: a dictionary of period -> {"commits": int, "contributor_count": int}
+    """
+    if period not in COMMIT_PERIODS:
+        raise InvalidArgumentError(f"Unknown commit period: {period}")
+    commit_index = as_commit_index(commits)
+    local_times = commit_index.timestamps + commit_index.utc_offsets
+
+    if period == "month":
+        keys = local_times.astype("datetime64[us]").astype("datetime64[M]").astype(np.int64)
+    else:
+        # 1970-01-01 was a thursday, so this is the number of days since the monday of the week
+        days = local_times // DAY
+        keys = days - (days + 3) % 7
+
+    unique_keys, period_ids = np.unique(keys, return_inverse=True)
+    period_ids = period_ids.reshape(-1).astype(np.int64)
+    commit_counts = np.bincount(period_ids, minlength=len(unique_keys))
+    # each unique (period, author) pair is one contributor of that period
+    num_authors = max(len(commit_index.authors), 1)
+    pairs = np.unique(period_ids * num_authors + commit_index.author_ids)
+    contributor_counts = np.bincount(pairs // num_authors, minlength=len(unique_keys))
+
+    if period == "month":
+        labels = [str(np.datetime64(int(key), "M")) for key in unique_keys]
+    else:
+        labels = []
+        for key in unique_keys:
+            year, week, _ = (EPOCH + datetime.timedelta(days=int(key))).isocalendar()
+            labels.append(f"{year}-W{week:02d}")
+
+    return {label: {"commits": int(commit_counts[i]), "contributor_count": int(contributor_counts[i])}
+            for i, label in enumerate(labels)}
+
+
+def format_commits_per_author(author_counts, recent_commits, now=None, windows=DEFAULT_WINDOWS,
+                              max_authors=MAX_AUTHORS):
+    """
+    Creates the 'commits_per_author' data stored for a repository from the all time tallies and the recent commits
+    :param author_counts: a dictionary of author name -> number of commits all time
+    :param recent_commits: a CommitIndex or an iterable of CommitRecord tuples containing at least every commit of the
+    longest window
+    :param now: the current datetime (optional)
+    :param windows: the names of the rolling windows to create leaderboards for (keys of COMMIT_WINDOWS)
+    :param max_authors: the number of authors to include in each leaderboard
+    :return: a dictionary with the commit data
+    """
+    recent_commits = as_commit_index(recent_commits)
+    window_counts = count_commits_in_windows(recent_commits, windows, now)
+
+    data = {name: {"name": name, "all_time": count, **{window: 0 for window in windows}}
+            for name, count in author_counts.items()}
+    for author_id, name in enumerate(recent_commits.authors):
+        counts = {window: int(window_counts[window][author_id]) for window in windows}
+        if name not in data:
+            if not any(counts.values()):
+                continue
+            data[name] = {"name": name, "all_time": 0}
+        data[name].update(counts)
+
+    # sort authors by number of commits. Ties are broken by name, so that the order does not depend on whether the
+    # tallies were built incrementally or from the whole history
+    result = {
+        "all_time": {
+            "top_25": sorted(data.values(), key=lambda x: (-x["all_time"], x["name"]))[:max_authors],
+            "total": sum(author_counts.values())
+        }
+    }
+    for window in windows:
+        result[window] = {
+            "top_25": sorted(data.values(), key=lambda x: (-x[window], x["name"]))[:max_authors],
+            "total": int(window_counts[window].sum())
+        }
+    return result
+
+
+def format_commits_per_month(month_counts):
+    """
+    Creates the 'commits_per_month' data stored for a repository from the monthly tallies
+    :param month_counts: a dictionary of 'YYYY-MM' -> {"commits": int, "contributor_count": int}
+    :return: a dictionary with monthly commit and contributor data
+    """
+    monthly_data_list = [{"month": month, "commits": counts["commits"],
+                          "contributor_count": counts["contributor_count"]} for month, counts in month_counts.items()]
+    return {
+        "month_data": sorted(monthly_data_list, key=lambda x: x["month"], reverse=True)
+    }
+
+
+def get_ref_tips(repo_path):
+    """
+    Gets the objects that the branches and tags of a repository currently point to
+    :param repo_path: the path of the git repository
+    :return: a sorted list of object hexshas
+    """
+    p = subprocess.run(["git", "-C", repo_path, "for-each-ref", "--format=%(objectname)"], capture_output=True,
+                       text=True)
+    if p.returncode != 0:
+        raise SystemError(p.stderr)
+    return sorted(set(p.stdout.split()))
+
+
+def history_was_rewritten(repo_path, previous_tips):
+    """
+    Checks whether any commit that was reachable at the previous run is no longer reachable from the current branches
+    and tags, eg. because of a force push or a deleted branch. If so, the stored tallies include commits that no longer
+    exist in the history and have to be rebuilt.
+    :param repo_path: the path of the git repository
+    :param previous_tips: the ref tips that were stored at the previous run
+    :return: True if the history was rewritten (or a previous tip no longer exists), False otherwise
+    """
+    p = subprocess.run(["git", "-C", repo_path, "rev-list", "--count", "--stdin", "--not", "--all"],
+                       input="".join(f"{tip}\n" for tip in previous_tips), capture_output=True, text=True)
+    if p.returncode != 0:
+        return True
+    return int(p.stdout.strip()) > 0
+
+
+def clear_ref_tips(stats_collection, search_dict):
+    """
+    Removes the stored ref tips of a repository, which makes the next run rebuild the tallies from the whole history
+    :param stats_collection: the 'commit_statistics' collection
+    :param search_dict: the query matching the document of the repository
+    :return: None
+    """
+    stats_collection.update_one(search_dict, {"$unset": {"tips": ""}})
+
+
+def update_commit_statistics(repo_owner, repo_name, repo_path, mongo_client, logger, recent_commits=None,
+                             windows=LEADERBOARD_WINDOWS):
+    """
+    Updates the commit tallies stored in mongodb for a repository and returns the 'commits_per_author' and
+    'commits_per_month' data. The tallies are stored together with the ref tips that they were calculated from, so each
+    run only walks the commits that are not reachable from the previous tips. The tallies are rebuilt from the whole
+    history on the first run and whenever the history was rewritten.
+
+    The tips are removed before the monthly tallies are written and stored again once the writes are complete, so a run
+    that stops half way (which would otherwise count the same commits twice at the next run) leads to a rebuild.
+    :param repo_owner: the owner of the repository
+    :param repo_name: the name of the repository
+    :param repo_path: the path of the git repository (a working tree or a bare mirror)
+    :param mongo_client: the MongoClient object from PyMongo
+    :param logger: The logger object to use for logging information
+    :param recent_commits: a CommitIndex containing at least the commits of the longest window (optional). If it is not
+    given, the recent commits are read from the repository
+    :param windows: the names of the rolling windows to create leaderboards for (keys of COMMIT_WINDOWS)
+    :return: a dictionary with the 'commits_per_author' and 'commits_per_month' data
+    """
+    db = mongo_client["test_db"]
+    stats_collection = db["commit_statistics"]
+    months_collection = db["commit_statistics_months"]
+    search_dict = {"name": repo_name, "owner": repo_owner}
+
+    stored = stats_collection.find_one(search_dict, {"_id": 0, "tips": 1, "authors": 1})
+    tips = get_ref_tips(repo_path)
+
+    if stored is not None and stored.get("tips") and not history_was_rewritten(repo_path, stored["tips"]):
+        new_commits = list(iter_git_log(repo_path, stdin_revisions=[f"^{tip}" for tip in stored["tips"]]))
+        logger.info(f"{len(new_commits)} new commits since the previous run")
+        author_counts = {author["name"]: author["commits"] for author in stored["authors"]}
+
+        # only the months that received new commits are read and written
+        months = {month: {"commits": 0, "contributors": set()} for month in
+                  {commit.committed_datetime.strftime('%Y-%m') for commit in new_commits}}
+        for month_doc in months_collection.find({**search_dict, "month": {"$in": list(months.keys())}}):
+            months[month_doc["month"]] = {"commits": month_doc["commits"],
+                                          "contributors": set(month_doc["contributors"])}
+        if months:
+            clear_ref_tips(stats_collection, search_dict)
+    else:
+        logger.info("calculating the commit tallies from the whole history")
+        new_commits = iter_git_log(repo_path)
+        author_counts = {}
+        months = {}
+        if stored is not None:
+            clear_ref_tips(stats_collection, search_dict)
+        months_collection.delete_many(search_dict)
+
+    author_counts, months = count_commits(new_commits, author_counts, months)
+
+    if months:
+        months_collection.bulk_write([
+            UpdateOne({**search_dict, "month": month},
+                      {"$set": {"commits": counts["commits"], "contributors": sorted(counts["contributors"]),
+                                "contributor_count": len(counts["contributors"])}},
+                      upsert=True)
+            for month, counts in months.items()
+        ], ordered=False)
+
+    stats_collection.update_one(search_dict, {"$set": {
+        "tips": tips,
+        "authors": [{"name": name, "commits": count} for name, count in author_counts.items()],
+        "updated_at": datetime.datetime.now(datetime.timezone.utc)
+    }}, upsert=True)
+
+    # the rolling window only needs the most recent commits
+    if recent_commits is None:
+        longest_window = max(COMMIT_WINDOWS[window] for window in windows)
+        recent_commits = iter_git_log(repo_path, revisions=("--all", f"--since={longest_window + 1}.days.ago"))
+
+    month_counts = {doc["month"]: doc for doc in
+                    months_collection.find(search_dict, {"_id": 0, "month": 1, "commits": 1, "contributor_count": 1})}
+    return {
+        "commits_per_author": format_commits_per_author(author_counts, recent_commits, windows=windows),
+        "commits_per_month": format_commits_per_month(month_counts)
+    }
@@ -26,4 +26,15 @@ class InvalidArgumentError(Exception):
 
     def __init__(self, message):
         self.message = message
-        super().__init__(self.message)
\ No newline at end of file
+        super().__init__(self.message)
+
+
+class GraphQLError(Exception):
+    """
+    Custom error for when a github GraphQL query returns errors instead of the requested data
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        self.message = "; ".join(error.get("message", str(error)) for error in errors)
+        super().__init__(self.message)
@@ -0,0 +1,170 @@
+import gzip
+import json
+import os
+import threading
+import zlib
+from datetime import datetime
+
+from .github_fetcher import get_updated_at
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+FETCH_ARCHIVE_DIR = os.path.join(CURRENT_DIR, "fetch_archive")
+
+# one lock per archive file, since the fetch workers of a category all append to the same file
+_archive_locks = {}
+_archive_locks_lock = threading.Lock()
+
+
+def get_archive_lock(path):
+    """
+    Gets the lock for an archive file
+    :param path: the path of the archive file
+    :return: the threading.Lock for the file
+    """
+    with _archive_locks_lock:
+        return _archive_locks.setdefault(path, threading.Lock())
+
+
+def merge_intervals(intervals):
+    """
+    Merges overlapping and touching time intervals
+    :param intervals: an iterable of (start, end) datetime tuples
+    :return: a sorted list of disjoint (start, end) datetime tuples
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class FetchArchive:
+    """
+    A local record of the raw items that perceval returned for one category of one repository. Every time slice that
+    is fetched completely is appended to a gzip file as one JSON line with the slice's bounds and items, so the archive
+    knows exactly which time ranges it covers. A later run replays the covered ranges and only fetches the rest.
+
+    Each slice is written as its own gzip member, and a member that was cut short by a crash is ignored when reading.
+    The archive can also be replayed without any network access, which gives deterministic test fixtures. After each
+    fetch the archive is compacted and the time before the start of the fetch is dropped (see compact).
+    """
+    def __init__(self, repo_owner, repo_name, category, archive_dir=FETCH_ARCHIVE_DIR):
+        """
+        :param repo_owner: the owner of the repository
+        :param repo_name: the name of the repository
+        :param category: the perceval category, 'issue' or 'pull_request'
+        :param archive_dir: the directory containing the archives
+        """
+        self.path = os.path.join(archive_dir, repo_owner, repo_name, f"{category}.jsonl.gz")
+        self.lock = get_archive_lock(self.path)
+
+    def read_slices(self):
+        """
+        Reads every complete slice in the archive
+        :return: a list of (start, end, items) tuples in the order they were recorded
+        """
+        slices = []
+        if not os.path.exists(self.path):
+            return slices
+        with self.lock, open(self.path, "rb") as archive_file:
+            data = archive_file.read()
+
+        # the gzip members are decompressed one at a time so that a member cut short by a crash only loses that slice
+        while data:
+            decompressor = zlib.decompressobj(wbits=31)
+            try:
+                line = decompressor.decompress(data)
+            except zlib.error:
+                break
+            if not decompressor.eof:
+                break
+            record = json.loads(line)
+            slices.append((datetime.fromisoformat(record["from"]), datetime.fromisoformat(record["to"]),
+                           record["items"]))
+            data = decompressor.unused_data
+        return slices
+
+    def record(self, from_date, to_date, items):
+        """
+        Appends a completely fetched time slice to the archive
+        :param from_date: the start datetime of the slice
+        :param to_date: the end datetime of the slice
+        :param items: the items that perceval returned for the slice
+        :return: None
+        """
+        line = json.dumps({"from": from_date.isoformat(), "to": to_date.isoformat(), "items": items}) + "\n"
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.lock, gzip.open(self.path, "at", encoding="utf-8") as archive_file:
+            archive_file.write(line)
+
+    def coverage(self, slices=None):
+        """
+        Gets the time ranges that the archive covers
+        :param slices: the slices returned by read_slices (optional, read from the archive otherwise)
+        :return: a sorted list of disjoint (start, end) datetime tuples
+        """
+        if slices is None:
+            slices = self.read_slices()
+        return merge_intervals((start, end) for start, end, _ in slices)
+
+    def high_water_mark(self, from_date, slices=None):
+        """
+        Gets the end of the archived range that runs without gaps from from_date. Everything between from_date and the
+        high water mark can be replayed from the archive
+        :param from_date: the start datetime of the fetch
+        :param slices: the slices returned by read_slices (optional, read from the archive otherwise)
+        :return: the high water mark (datetime), which is from_date if the archive does not cover from_date
+        """
+        for start, end in self.coverage(slices):
+            if start <= from_date < end:
+                return end
+        return from_date
+
+    def replay(self, from_date, to_date, slices=None):
+        """
+        Gets the archived items that were updated between two dates, keeping the latest copy of each item
+        :param from_date: the start datetime
+        :param to_date: the end datetime
+        :param slices: the slices returned by read_slices (optional, read from the archive otherwise)
+        :return: a list of the items
+        """
+        if slices is None:
+            slices = self.read_slices()
+        latest = {}
+        for _, _, items in slices:
+            for item in items:
+                number = item["data"]["number"]
+                if number not in latest or get_updated_at(item) > get_updated_at(latest[number]):
+                    latest[number] = item
+        return [item for item in latest.values() if from_date <= get_updated_at(item) <= to_date]
+
+    def compact(self, cut_off=None):
+        """
+        Rewrites the archive with one slice per covered range and only the latest copy of each item. The time before
+        cut_off is dropped, so the archive only grows with the time range that is being fetched rather than with the
+        whole history of the repository
+        :param cut_off: the datetime to drop the coverage and the items before (optional, nothing is dropped without it)
+        :return: None
+        """
+        slices = self.read_slices()
+        full_coverage = self.coverage(slices)
+        coverage = [(start if cut_off is None else max(start, cut_off), end) for start, end in full_coverage
+                    if cut_off is None or end > cut_off]
+        if len(slices) <= 1 and coverage == full_coverage:
+            return
+        if not coverage:
+            with self.lock:
+                os.remove(self.path)
+            return
+
+        items = self.replay(coverage[0][0], coverage[-1][1], slices)
+        temp_path = self.path + ".tmp"
+        with self.lock:
+            with gzip.open(temp_path, "wt", encoding="utf-8") as archive_file:
+                for start, end in coverage:
+                    slice_items = [item for item in items if start <= get_updated_at(item) <= end]
+                    archive_file.write(json.dumps({"from": start.isoformat(), "to": end.isoformat(),
+                                                   "items": slice_items}) + "\n")
+            os.replace(temp_path, self.path)
@@ -1,18 +1,124 @@
 import json
-import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import NamedTuple, Optional
 
-from dotenv import load_dotenv
-from perceval.backends.core.github import GitHub
+import numpy as np
 from tqdm import tqdm
 from bson.codec_options import CodecOptions
 
-load_dotenv()
-ACCESS_TOKENS = [os.environ.get('ACCESS_TOKEN')]
-for i in range(6):
-    env_token = os.environ.get(f"ACCESS_TOKEN{i}")
-    if env_token is not None:
-        ACCESS_TOKENS.append(env_token)
+from .commit_index import EPOCH, MICROSECOND, as_commit_index
+from .exceptions import InvalidArgumentError
+from .fetch_archive import FETCH_ARCHIVE_DIR, FetchArchive
+from .github_fetcher import GitHubFetcher
+from .github_tokens import ACCESS_TOKENS
+from .mongo_helpers import BULK_WRITE_BATCH_SIZE, BulkUpserter
+
+# the heatmap is a grid of weeks (width, height), so it covers the most recent width * height weeks
+HEATMAP_DIMENSIONS = (19, 8)
+
+# with search counts, the weeks that end within this long before the previous run are recalculated, to cover any events
+# that happened between that run's searches and building its heatmap
+HEATMAP_REFRESH_MARGIN = timedelta(days=1)
+HEATMAP_DATE_FORMAT = '%Y-%m-%d-%H'
+
+# the activity histograms that are precomputed for each repository (resolution -> number of periods). They are limited
+# to the heatmap window, which is as far back as the issues and pull requests are retrieved
+ACTIVITY_RESOLUTIONS = {"day": 365, "week": HEATMAP_DIMENSIONS[0] * HEATMAP_DIMENSIONS[1], "month": 35}
+
+
+# the only fields of the stored issues and pull requests that the heatmap reads. Everything else (eg. comments) stays in
+# mongodb
+ISSUE_PROJECTION = {"_id": 0, "id": 1, "state": 1, "created_at": 1, "updated_at": 1, "closed_at": 1}
+PULL_REQUEST_PROJECTION = {**ISSUE_PROJECTION, "merged_at": 1}
+
+# the field of a heatmap week that holds each EventIndex series
+HEATMAP_FIELDS = {
+    "issues_open": ("issues", "open"),
+    "pull_requests_created": ("pull_requests", "created"),
+    "pull_requests_merged": ("pull_requests", "merged"),
+    "pull_requests_closed": ("pull_requests", "closed"),
+    "commits_created": ("commits", "created"),
+}
+
+
+class IssueRecord(NamedTuple):
+    """
+    The issue data used by the heatmap, with the dates already parsed
+    """
+    id: str
+    state: str
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+    closed_at: Optional[datetime]
+
+
+class PullRequestRecord(NamedTuple):
+    """
+    The pull request data used by the heatmap, with the dates already parsed
+    """
+    id: str
+    state: str
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+    closed_at: Optional[datetime]
+    merged_at: Optional[datetime]
+
+
+class ItemUpdates(NamedTuple):
+    """
+    The issues or pull requests retrieved for the heatmap by retrieve_issues or retrieve_pull_requests
+    """
+    # id -> record of every item updated after since
+    records: dict
+    # the start of the heatmap window, or the date the previous heatmap counted the items up to
+    since: datetime
+    # id -> record of the stored versions of the records, read before they were overwritten. None when since is the
+    # start of the heatmap window, since the records are then every item the heatmap counts
+    previous: Optional[dict]
+    # the most recent update of the stored items, including the ones retrieved now
+    updated_at: Optional[datetime]
+
+
+def parse_date(date, date_format="%Y-%m-%dT%H:%M:%S%z"):
+    """
+    Parses a date from the github API or mongodb
+    :param date: a date string, a datetime object, None or the string 'None' (stored by older pipeline versions)
+    :param date_format: the datetime string format of date strings
+    :return: the datetime object, or None if there is no date
+    """
+    if date is None or date == "None":
+        return None
+    if isinstance(date, str):
+        return datetime.strptime(date, date_format)
+    return date
+
+
+def issue_record_from_document(issue_id, document, date_format="%Y-%m-%dT%H:%M:%S%z"):
+    """
+    Creates an IssueRecord from a stored issue document or an issue object
+    :param issue_id: the id of the issue
+    :param document: the issue document
+    :param date_format: the datetime string format of date strings
+    :return: the IssueRecord
+    """
+    return IssueRecord(issue_id, document["state"],
+                       *(parse_date(document.get(field), date_format)
+                         for field in ["created_at", "updated_at", "closed_at"]))
+
+
+def pull_request_record_from_document(pr_id, document, date_format="%Y-%m-%dT%H:%M:%S%z"):
+    """
+    Creates a PullRequestRecord from a stored pull request document or a pull request object
+    :param pr_id: the id of the pull request
+    :param document: the pull request document
+    :param date_format: the datetime string format of date strings
+    :return: the PullRequestRecord
+    """
+    return PullRequestRecord(pr_id, document["state"],
+                             *(parse_date(document.get(field), date_format)
+                               for field in ["created_at", "updated_at", "closed_at", "merged_at"]))
 
 
 def date_span(start_date, end_date, delta=timedelta(weeks=1)):
@@ -30,63 +136,320 @@ def date_span(start_date, end_date, delta=timedelta(weeks=1)):
         current_date = new_date
 
 
-def issue_is_open_in_week(issue, start_of_week, end_of_week, date_format="%Y-%m-%dT%H:%M:%S%z"):
-    """
-    Checks if an issue is open for the whole duration of a date range.
-    :param issue: the issue object
-    :param start_of_week: the start datetime object
-    :param end_of_week: the end datetime object
-    :param date_format: the datetime string format in the issue object
-    :return: boolean for whether the issue was open for the whole duration of the date range.
-    """
-    if issue["created_at"] is None:
-        return False
-    open_date = datetime.strptime(issue["created_at"], date_format)
-    if open_date < start_of_week:
-        if issue["state"] == "open":
-            return True
-        closed_date = datetime.strptime(issue["closed_at"], date_format)
-        if closed_date > end_of_week:
-            return True
-    return False
-
-
-def pull_request_is_modified_in_week(pr, start_of_week, end_of_week, option, date_format="%Y-%m-%dT%H:%M:%S%z"):
-    """
-    Checks if a pull request was either created, closed, or merged, in between two dates.
-    :param pr: the pull request object
-    :param start_of_week: the start datetime object
-    :param end_of_week: the end datetime object
-    :param option: the option for which action to check. Must be one of ['created', 'closed', 'merged']
-    :param date_format: the date_format for the pull request object
-    :return: boolean for whether the pull request had the specified action performed within the date range
-    """
-    options = {
-        "created": "created_at",
-        "closed": "closed_at",
-        "merged": "merged_at"
-    }
-    date_option = options[option]
-    if pr[date_option] is None:
-        return False
-    action_date = datetime.strptime(pr[date_option], date_format)
-    if start_of_week < action_date < end_of_week:
-        return True
-    return False
+def to_timestamp(date, date_format="%Y-%m-%dT%H:%M:%S%z"):
+    """
+    Converts a date string or datetime object to microseconds since the unix epoch
+    :param date: the date string, datetime object or None
+    :param date_format: the datetime string format of date strings
+    :return: the timestamp (int), or None if there is no date
+    """
+    if date is None or date == "None":
+        return None
+    if isinstance(date, str):
+        date = datetime.strptime(date, date_format)
+    return (date - EPOCH) // MICROSECOND
+
+
+def get_event_timestamps(items, field):
+    """
+    Collects one date field of a set of issues or pull requests into a sorted array
+    :param items: an iterable of IssueRecord or PullRequestRecord tuples
+    :param field: the name of the date field, eg. 'created_at'
+    :return: a sorted NumPy int64 array of timestamps (see to_timestamp), without the items that have no date
+    """
+    timestamps = [to_timestamp(getattr(item, field)) for item in items]
+    return np.sort(np.array([t for t in timestamps if t is not None], dtype=np.int64))
 
 
-def commit_is_in_week(commit, start_of_week, end_of_week):
+def get_issue_intervals(issues):
     """
-    Checks if a commit was created in a specific date range
-    :param commit: the commit object
-    :param start_of_week: the start datetime object
-    :param end_of_week: the end datetime object
-    :return: boolean for whether the commit date is between the start_of_week and end_of_week dates
+    Collects the time each issue was open for. Issues that are still open are treated as closing at the end of time.
+    :param issues: an iterable of IssueRecord tuples
+    :return: a tuple of NumPy int64 arrays of the open and close timestamps of each issue
     """
-    return start_of_week < commit.committed_datetime < end_of_week
+    opened = []
+    closed = []
+    for issue in issues:
+        open_date = to_timestamp(issue.created_at)
+        if open_date is None:
+            continue
+        if issue.state == "open":
+            close_date = np.iinfo(np.int64).max
+        else:
+            close_date = to_timestamp(issue.closed_at)
+            if close_date is None:
+                continue
+        opened.append(open_date)
+        closed.append(close_date)
+    return np.array(opened, dtype=np.int64), np.array(closed, dtype=np.int64)
 
 
-def retrieve_issues(repo_owner, repo_name, repo, num_weeks, client, logger, date_format="%Y-%m-%dT%H:%M:%S%z"):
+def count_events_in_periods(timestamps, period_starts, period_ends):
+    """
+    Counts the events at or after the start and before the end of each period with two binary searches per period.
+    The periods are aligned to midnight, so an event exactly on a boundary is counted in the period it starts
+    :param timestamps: a sorted NumPy array of event timestamps
+    :param period_starts: a NumPy array of the start timestamp of each period
+    :param period_ends: a NumPy array of the end timestamp of each period
+    :return: a NumPy array of the number of events in each period
+    """
+    return np.searchsorted(timestamps, period_ends, side="left") - np.searchsorted(timestamps, period_starts,
+                                                                                   side="left")
+
+
+def count_open_intervals_in_periods(opened, closed, period_starts, period_ends):
+    """
+    Counts the issues that are open for the whole duration of each period: created before its start and not closed
+    until after its end. The periods an issue is open for are a contiguous range, so each issue adds 1 at the start of
+    its range and subtracts 1 after the end in a difference array, and a cumulative sum gives the count for every
+    period.
+    :param opened: a NumPy array of the open timestamp of each issue
+    :param closed: a NumPy array of the close timestamp of each issue
+    :param period_starts: a sorted NumPy array of the start timestamp of each period
+    :param period_ends: a sorted NumPy array of the end timestamp of each period
+    :return: a NumPy array of the number of open issues in each period
+    """
+    # an issue is counted in the periods that start after it was opened and end before it was closed
+    first_period = np.searchsorted(period_starts, opened, side="right")
+    last_period = np.searchsorted(period_ends, closed, side="left")
+    has_periods = first_period < last_period
+
+    difference = np.zeros(len(period_starts) + 1, dtype=np.int64)
+    np.add.at(difference, first_period[has_periods], 1)
+    np.add.at(difference, last_period[has_periods], -1)
+    return np.cumsum(difference[:-1])
+
+
+class EventIndex:
+    """
+    The dates of every issue, pull request and commit event of a repository, parsed once into sorted arrays. The
+    heatmap and the activity histograms of every resolution are all counted from the same index.
+    """
+    def __init__(self, issues, pull_requests, commits):
+        """
+        :param issues: a dictionary of id -> IssueRecord (see retrieve_issues)
+        :param pull_requests: a dictionary of id -> PullRequestRecord (see retrieve_pull_requests)
+        :param commits: a CommitIndex or an iterable of CommitRecord tuples
+        """
+        self.issues_opened, self.issues_closed = get_issue_intervals(issues.values())
+        self.pull_requests = {option: get_event_timestamps(pull_requests.values(), f"{option}_at")
+                              for option in ["created", "merged", "closed"]}
+        self.commits = np.sort(as_commit_index(commits).timestamps)
+
+    def count(self, period_starts, period_ends):
+        """
+        Counts the events in a set of periods
+        :param period_starts: a sorted NumPy array of the start timestamp of each period
+        :param period_ends: a sorted NumPy array of the end timestamp of each period
+        :return: a dictionary of series name -> NumPy array of the count for each period
+        """
+        counts = {"issues_open": count_open_intervals_in_periods(self.issues_opened, self.issues_closed,
+                                                                 period_starts, period_ends)}
+        for option, timestamps in self.pull_requests.items():
+            counts[f"pull_requests_{option}"] = count_events_in_periods(timestamps, period_starts, period_ends)
+        counts["commits_created"] = count_events_in_periods(self.commits, period_starts, period_ends)
+        return counts
+
+
+def count_open_issues(issues):
+    """
+    Counts the issues that EventIndex treats as open until the end of time
+    :param issues: an iterable of IssueRecord tuples
+    :return: the number of open issues
+    """
+    return sum(1 for issue in issues if issue.state == "open" and issue.created_at is not None)
+
+
+def count_changed_periods(stored_counts, period_starts, period_ends, current, previous, open_issues):
+    """
+    Counts the events in a set of periods by applying the changed issues and pull requests to the stored counts: the
+    versions of them that the stored counts include are taken out, and their current versions are added in. This also
+    applies a change to an old period, eg. a reopened issue that is no longer closed. The items that did not change were
+    all updated before any period that was not counted before, so the only ones they count in are the open issues. The
+    commits are always counted from the commit index alone
+    :param stored_counts: a list with the stored counts of each period (a dictionary of series name -> count), or None
+    for the periods that were not counted before
+    :param period_starts: a sorted NumPy array of the start timestamp of each period
+    :param period_ends: a sorted NumPy array of the end timestamp of each period
+    :param current: the EventIndex of the current versions of the changed items and of the commits
+    :param previous: the EventIndex of the versions of the changed items that the stored counts include, with no commits
+    :param open_issues: the number of open issues that did not change
+    :return: a dictionary of series name -> NumPy array of the count for each period
+    """
+    added = current.count(period_starts, period_ends)
+    removed = previous.count(period_starts, period_ends)
+    is_stored = np.array([period is not None for period in stored_counts], dtype=bool)
+
+    counts = {}
+    for series, values in added.items():
+        if series == "commits_created":
+            counts[series] = values
+            continue
+        new_period = open_issues if series == "issues_open" else 0
+        stored = np.array([new_period if period is None else period[series] for period in stored_counts],
+                          dtype=np.int64)
+        counts[series] = stored + values - np.where(is_stored, removed[series], 0)
+    return counts
+
+
+def get_activity_periods(resolution, num_periods, now=None):
+    """
+    Gets the most recent periods of a resolution, aligned to midnight UTC. Weeks start on monday and months on the
+    first day of the month. The last period is the current, unfinished one.
+    :param resolution: one of the keys of ACTIVITY_RESOLUTIONS ('day', 'week' or 'month')
+    :param num_periods: the number of periods
+    :param now: the current datetime (optional)
+    :return: a tuple of NumPy datetime64[us] arrays of the start and end of each period, oldest first
+    """
+    if resolution not in ACTIVITY_RESOLUTIONS:
+        raise InvalidArgumentError(f"Unknown activity resolution: {resolution}")
+    if now is None:
+        now = datetime.now(timezone.utc)
+    today = np.datetime64(now.astimezone(timezone.utc).date(), "D")
+    steps = np.arange(num_periods - 1, -1, -1)
+
+    if resolution == "month":
+        starts = today.astype("datetime64[M]") - steps
+        ends = starts + 1
+    elif resolution == "week":
+        # 1970-01-01 was a thursday
+        monday = today - (today.astype(np.int64) + 3) % 7
+        starts = monday - steps * 7
+        ends = starts + 7
+    else:
+        starts = today - steps
+        ends = starts + 1
+    return starts.astype("datetime64[us]"), ends.astype("datetime64[us]")
+
+
+def build_activity_histograms(events, now=None, resolutions=None):
+    """
+    Builds the daily, weekly and monthly activity series for a repository from one event index
+    :param events: the EventIndex for the repository
+    :param now: the current datetime (optional)
+    :param resolutions: a dictionary of resolution -> number of periods. Defaults to ACTIVITY_RESOLUTIONS
+    :return: a dictionary of resolution -> {"start": list of period start dates, series name -> list of counts}
+    """
+    return update_activity_histograms({}, events, EventIndex({}, {}, []), 0, now, resolutions)
+
+
+def update_activity_histograms(stored_histograms, current, previous, open_issues, now=None, resolutions=None):
+    """
+    Updates the stored activity histograms with the issues and pull requests that changed since they were counted (see
+    count_changed_periods)
+    :param stored_histograms: the stored histograms, in the format returned by build_activity_histograms
+    :param current: the EventIndex of the current versions of the changed items and of the commits
+    :param previous: the EventIndex of the versions of the changed items that the stored histograms include
+    :param open_issues: the number of open issues that did not change
+    :param now: the current datetime (optional)
+    :param resolutions: a dictionary of resolution -> number of periods. Defaults to ACTIVITY_RESOLUTIONS
+    :return: a dictionary of resolution -> {"start": list of period start dates, series name -> list of counts}
+    """
+    histograms = {}
+    for resolution, num_periods in (resolutions or ACTIVITY_RESOLUTIONS).items():
+        starts, ends = get_activity_periods(resolution, num_periods, now)
+        unit = "M" if resolution == "month" else "D"
+        histogram = {"start": np.datetime_as_string(starts, unit=unit).tolist()}
+
+        stored = stored_histograms.get(resolution, {})
+        stored_periods = {start: {series: values[i] for series, values in stored.items() if series != "start"}
+                          for i, start in enumerate(stored.get("start", []))}
+        counts = count_changed_periods([stored_periods.get(start) for start in histogram["start"]],
+                                       starts.astype(np.int64), ends.astype(np.int64), current, previous, open_issues)
+        for series, values in counts.items():
+            histogram[series] = values.tolist()
+        histograms[resolution] = histogram
+    return histograms
+
+
+def get_latest_update(collection, repo_owner, repo_name):
+    """
+    Gets the most recent update of a repository's stored issues or pull requests
+    :param collection: the issues or pull requests collection
+    :param repo_owner: the owner of the repository
+    :param repo_name: the name of the repository
+    :return: the updated_at datetime, or None if nothing is stored
+    """
+    document = collection.find_one({"name": repo_name, "owner": repo_owner}, {"_id": 0, "updated_at": 1},
+                                   sort=[("updated_at", -1)])
+    return parse_date(document.get("updated_at")) if document else None
+
+
+def most_recent_date(dates):
+    """
+    Gets the most recent of a list of dates
+    :param dates: an iterable of datetime objects or None
+    :return: the most recent datetime, or None if there are none
+    """
+    return max((date for date in dates if date is not None), default=None)
+
+
+def store_fetched_items(collection, repo_owner, repo_name, items, projection, record_from_document, previous=None):
+    """
+    Writes fetched issues or pull requests to mongodb in batches rather than one round trip each
+    :param collection: the issues or pull requests collection
+    :param repo_owner: the owner of the repository
+    :param repo_name: the name of the repository
+    :param items: an iterable of (id, document) tuples
+    :param projection: the fields of the stored documents that the records are made from
+    :param record_from_document: issue_record_from_document or pull_request_record_from_document
+    :param previous: a dictionary to add the records of the stored versions of the items to (optional). They are read
+    a batch at a time, before the batch is written
+    :return: a dictionary of id -> record of the items
+    """
+    records = {}
+
+    def write_batch(batch):
+        if previous is not None:
+            new_ids = [num for num, _ in batch if num not in records]
+            if new_ids:
+                for document in collection.find({"name": repo_name, "owner": repo_owner, "id": {"$in": new_ids}},
+                                                projection):
+                    previous[document["id"]] = record_from_document(document["id"], document)
+        for num, document in batch:
+            writer.upsert({"name": repo_name, "owner": repo_owner, "id": num}, document)
+            records[num] = record_from_document(num, document)
+
+    # without the stored versions, each item is written as soon as it is fetched
+    batch_size = 1 if previous is None else BULK_WRITE_BATCH_SIZE
+    with BulkUpserter(collection) as writer:
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                write_batch(batch)
+                batch = []
+        write_batch(batch)
+    return records
+
+
+def parse_fetched_issues(items, date_format="%Y-%m-%dT%H:%M:%S%z"):
+    """
+    Converts the issues fetched from the github API into the documents stored in mongodb
+    :param items: an iterable of the fetched issues (from perceval)
+    :param date_format: the date format of the dates from the github API
+    :return: a generator of (issue id, document) tuples
+    """
+    for item in tqdm(items, desc="fetching issue data"):
+        num = item['data']['number']
+        # the dates are parsed once, for both the stored document and the record
+        issue = {
+            'user': item['data']['user']['login'],
+            'created_at': parse_date(item['data']['created_at'], date_format),
+            'updated_at': parse_date(item['data']['updated_at'], date_format),
+            'closed_at': parse_date(item['data']['closed_at'], date_format),
+            'state': item['data']['state'],
+        }
+        # the comments are only there if the fetcher's field profile asked for them. Leaving the field out keeps the
+        # comments that are already stored
+        if 'comments_data' in item['data']:
+            issue['comments'] = [{'user': c['user']['login'], 'created_at': c['created_at']}
+                                 for c in item['data']['comments_data']]
+        yield num, issue
+
+
+def retrieve_issues(repo_owner, repo_name, repo, num_weeks, client, logger, date_format="%Y-%m-%dT%H:%M:%S%z",
+                    since=None):
     """
     Retrieves a repository's issues from the github API. Due the the very slow process of retrieving issues from the
     github API, any issues that are extracted will be stored in mongodb so that they do not need to be retrieved from
@@ -99,76 +462,107 @@ def retrieve_issues(repo_owner, repo_name, repo, num_weeks, client, logger, date
     :param num_weeks: the number of weeks from the current date to retrieve issues from
     :param client: the MongoClient object from PyMongo
     :param logger: The logger object to use for logging information
-    :param date_format: the date format to use when representing dates as strings
-    :return: the json object with the issue data for the last num_weeks weeks
+    :param date_format: the date format of the dates from the github API
+    :param since: the date the previous heatmap counted the issues up to (optional). Only the issues updated since
+    then are returned, together with the stored versions of them, and the other stored issues are not read
+    :return: an ItemUpdates tuple of the issue id -> IssueRecord for the last num_weeks weeks, or for the issues updated
+    since the given date
     """
     db = client["test_db"]
     issue_collection = db["issues"].with_options(codec_options=CodecOptions(tz_aware=True, tzinfo=timezone.utc))
-    json_data = {}
+    records = {}
+    previous = None
 
     current_date = datetime.now(timezone.utc)
-    cut_off_date = datetime.now(timezone.utc) - timedelta(weeks=num_weeks)
-
-    most_recent_update = None
-
-    # retrieve any issues already stored in the database
-    for db_issue in issue_collection.find({"name": repo_name, "owner": repo_owner,
-                                           "updated_at": {"$gt": cut_off_date}},
-                                          {"_id": 0, "name": 0, "owner": 0}):
-        if most_recent_update is None:
-            most_recent_update = db_issue["updated_at"]
-        else:
-            if db_issue["updated_at"] > most_recent_update:
-                most_recent_update = db_issue["updated_at"]
-
-        for date_str in ["created_at", "closed_at", "updated_at"]:
-            if db_issue[date_str] is not None:
-                if db_issue[date_str] != "None":
-                    db_issue[date_str] = db_issue[date_str].strftime(date_format)
-        json_data[db_issue["id"]] = db_issue
-
-    logger.info(f"There were {len(json_data.keys())} relevant issues already found in the database")
-
-    # get the new cut off date (if there were issues already in the database)
-    if most_recent_update is not None:
-        cut_off_date = most_recent_update
+    latest_update = get_latest_update(issue_collection, repo_owner, repo_name)
+
+    if since is None:
+        since = current_date - timedelta(weeks=num_weeks)
+        cut_off_date = since
+        most_recent_update = None
+
+        # retrieve any issues already stored in the database. Only the fields used by the heatmap are read
+        for db_issue in issue_collection.find({"name": repo_name, "owner": repo_owner,
+                                               "updated_at": {"$gt": since}}, ISSUE_PROJECTION):
+            record = issue_record_from_document(db_issue["id"], db_issue)
+            if most_recent_update is None or record.updated_at > most_recent_update:
+                most_recent_update = record.updated_at
+            records[record.id] = record
+
+        logger.info(f"There were {len(records)} relevant issues already found in the database")
+
+        # get the new cut off date (if there were issues already in the database)
+        if most_recent_update is not None:
+            cut_off_date = most_recent_update
+    else:
+        # the previous heatmap counted every stored issue, so only the ones updated since then are read, each with the
+        # stored version that was counted
+        cut_off_date = since
+        previous = {}
 
     logger.info(f"Finding github issues since {cut_off_date.strftime(date_format)}")
 
-    for item in tqdm(
-            repo.fetch(from_date=cut_off_date, to_date=current_date, category="issue"),
-            desc="fetching issue data"):
-
-        num = item['data']['number']
-        json_data[num] = {}
-        json_data[num]['user'] = item['data']['user']['login']
-        json_data[num]['created_at'] = item['data']['created_at']
-        json_data[num]['updated_at'] = item['data']['updated_at']
-        json_data[num]['closed_at'] = item['data']['closed_at']
-        json_data[num]['state'] = item['data']['state']
-        json_data[num]['comments'] = []
-        for c in item['data']['comments_data']:
-            json_data[num]['comments'].append({'user': c['user']['login'], 'created_at': c['created_at']})
-
-        search = {
-            "name": repo_name,
-            "owner": repo_owner,
-            "id": num
-        }
-
-        issue_to_insert = json_data[num].copy()
-        for date_str in ["created_at", "closed_at", "updated_at"]:
-            if issue_to_insert[date_str] is not None:
-                if issue_to_insert[date_str] != "None":
-                    issue_to_insert[date_str] = datetime.strptime(issue_to_insert[date_str], date_format)
-
-        issue_collection.update_one(search, {"$set": issue_to_insert}, upsert=True)
+    issues = parse_fetched_issues(repo.fetch(from_date=cut_off_date, to_date=current_date, category="issue"),
+                                  date_format)
+    records.update(store_fetched_items(issue_collection, repo_owner, repo_name, issues, ISSUE_PROJECTION,
+                                       issue_record_from_document, previous))
 
     logger.info("Issue data successfully retrieved")
-    return json_data
+    return ItemUpdates(records, since, previous,
+                       most_recent_date([latest_update, *(record.updated_at for record in records.values())]))
+
 
+def parse_fetched_pull_requests(items, date_format="%Y-%m-%dT%H:%M:%S%z"):
+    """
+    Converts the pull requests fetched from the github API into the documents stored in mongodb
+    :param items: an iterable of the fetched pull requests (from perceval)
+    :param date_format: the date format of the dates from the github API
+    :return: a generator of (pull request id, document) tuples
+    """
+    for item in tqdm(items, desc="fetching pull request data"):
+        if 'pull_request' in item['data']:
+            continue
 
-def retrieve_pull_requests(repo_owner, repo_name, repo, num_weeks, client, logger, date_format="%Y-%m-%dT%H:%M:%S%z"):
+        num = str(item['data']['number'])
+        pull_request = {}
+        pull_request['title'] = item['data']['title']
+        pull_request['user'] = item['data']['user']['login']
+        pull_request['state'] = item['data']['state']
+        # the dates are parsed once, for both the stored document and the record
+        pull_request['created_at'] = parse_date(item['data']['created_at'], date_format)
+        pull_request['closed_at'] = parse_date(item['data']['closed_at'], date_format)
+        pull_request['updated_at'] = parse_date(item['data']['updated_at'], date_format)
+        pull_request['merged'] = item['data']['merged']
+        pull_request['merged_at'] = parse_date(item['data']['merged_at'], date_format)
+        pull_request['comments_num'] = item['data']['comments']
+        # the review fields are only there if the fetcher's field profile asked for them. Leaving them out keeps
+        # the values that are already stored
+        if 'review_comments' in item['data']:
+            pull_request['review_times'] = item['data']['review_comments']
+        if 'reviews_data' in item['data']:
+            pull_request['submitted_at'] = []
+            if item['data']['reviews_data']:
+                for c in item['data']['reviews_data']:
+                    if pull_request['submitted_at']:
+                        continue
+                    if c['user_data']:
+                        if c['user_data']['login'] != pull_request['user']:
+                            pull_request['submitted_at'] = c['submitted_at']
+            if item['data']['reviews_data']:
+                pull_request['approve_state'] = 'approve'
+            else:
+                pull_request['approve_state'] = 'not approve'
+            pull_request['reviewer'] = []
+            if item['data']['reviews_data']:
+                for c in item['data']['reviews_data']:
+                    if c['user_data']:
+                        pull_request['reviewer'].append({'user': c['user_data']['login']})
+
+        yield num, pull_request
+
+
+def retrieve_pull_requests(repo_owner, repo_name, repo, num_weeks, client, logger, date_format="%Y-%m-%dT%H:%M:%S%z",
+                           since=None):
     """
     Retrieves a repository's pull requests from the github API. Due the the very slow process of retrieving pull
     requests from the github API, any pull requests that are extracted will be stored in mongodb so that they do not
@@ -181,199 +575,359 @@ def retrieve_pull_requests(repo_owner, repo_name, repo, num_weeks, client, logge
     :param num_weeks: the number of weeks from the current date to retrieve issues from
     :param client: the MongoClient object from PyMongo
     :param logger: The logger object to use for logging information
-    :param date_format: the date format to use when representing dates as strings
-    :return: the json object with the pull request data for the last num_weeks weeks
+    :param date_format: the date format of the dates from the github API
+    :param since: the date the previous heatmap counted the pull requests up to (optional). Only the pull requests
+    updated since then are returned, together with the stored versions of them, and the other stored pull requests are
+    not read
+    :return: an ItemUpdates tuple of the pull request id -> PullRequestRecord for the last num_weeks weeks, or for the
+    pull requests updated since the given date
     """
     db = client["test_db"]
     pr_collection = db["pull_requests"].with_options(codec_options=CodecOptions(tz_aware=True, tzinfo=timezone.utc))
-    json_data = {}
+    records = {}
+    previous = None
 
     current_date = datetime.now(timezone.utc)
-    cut_off_date = datetime.now(timezone.utc) - timedelta(weeks=num_weeks)
-
-    most_recent_update = None
-
-    # retrieve any pull requests already stored in the database
-    for db_pull_request in pr_collection.find({"name": repo_name, "owner": repo_owner,
-                                               "updated_at": {"$gt": cut_off_date}},
-                                              {"_id": 0, "name": 0, "owner": 0}):
-        if most_recent_update is None:
-            most_recent_update = db_pull_request["updated_at"]
-        else:
-            if db_pull_request["updated_at"] > most_recent_update:
-                most_recent_update = db_pull_request["updated_at"]
-
-        for date_str in ["created_at", "closed_at", "updated_at", "merged_at"]:
-            if db_pull_request[date_str] is not None:
-                if db_pull_request[date_str] != "None":
-                    db_pull_request[date_str] = db_pull_request[date_str].strftime(date_format)
-        json_data[db_pull_request["id"]] = db_pull_request
-
-    logger.info(f"There were {len(json_data.keys())} relevant pull requests already found in the database")
-
-    # get the new cut off date (if there were pull requests already in the database)
-    if most_recent_update is not None:
-        cut_off_date = most_recent_update
+    latest_update = get_latest_update(pr_collection, repo_owner, repo_name)
+
+    if since is None:
+        since = current_date - timedelta(weeks=num_weeks)
+        cut_off_date = since
+        most_recent_update = None
+
+        # retrieve any pull requests already stored in the database. Only the fields used by the heatmap are read
+        for db_pull_request in pr_collection.find({"name": repo_name, "owner": repo_owner,
+                                                   "updated_at": {"$gt": since}}, PULL_REQUEST_PROJECTION):
+            record = pull_request_record_from_document(db_pull_request["id"], db_pull_request)
+            if most_recent_update is None or record.updated_at > most_recent_update:
+                most_recent_update = record.updated_at
+            records[record.id] = record
+
+        logger.info(f"There were {len(records)} relevant pull requests already found in the database")
+
+        # get the new cut off date (if there were pull requests already in the database)
+        if most_recent_update is not None:
+            cut_off_date = most_recent_update
+    else:
+        # the previous heatmap counted every stored pull request, so only the ones updated since then are read, each
+        # with the stored version that was counted
+        cut_off_date = since
+        previous = {}
 
     logger.info(f"Finding github pull requests since {cut_off_date.strftime(date_format)}")
 
-    for item in tqdm(
-            repo.fetch(from_date=cut_off_date, to_date=current_date, category="pull_request"),
-            desc="fetching pull request data"):
-
-        if 'pull_request' in item['data']:
-            continue
-
-        num = str(item['data']['number'])
-        json_data[num] = {}
-        json_data[num]['title'] = item['data']['title']
-        json_data[num]['user'] = item['data']['user']['login']
-        json_data[num]['state'] = item['data']['state']
-        json_data[num]['created_at'] = item['data']['created_at']
-        json_data[num]['closed_at'] = item['data']['closed_at']
-        json_data[num]['updated_at'] = item['data']['updated_at']
-        json_data[num]['submitted_at'] = []
-        if item['data']['reviews_data']:
-            for c in item['data']['reviews_data']:
-                if json_data[num]['submitted_at']:
-                    continue
-                if c['user_data']:
-                    if c['user_data']['login'] != json_data[num]['user']:
-                        json_data[num]['submitted_at'] = c['submitted_at']
-        json_data[num]['merged'] = item['data']['merged']
-        json_data[num]['merged_at'] = item['data']['merged_at']
-        json_data[num]['comments_num'] = item['data']['comments']
-        json_data[num]['approve_state'] = []
-        if item['data']['reviews_data']:
-            json_data[num]['approve_state'] = 'approve'
-        else:
-            json_data[num]['approve_state'] = 'not approve'
-        json_data[num]['review_times'] = item['data']['review_comments']
-        json_data[num]['reviewer'] = []
-        if item['data']['reviews_data']:
-            for c in item['data']['reviews_data']:
-                if c['user_data']:
-                    json_data[num]['reviewer'].append({'user': c['user_data']['login']})
-
-        search = {
-            "name": repo_name,
-            "owner": repo_owner,
-            "id": num
-        }
-
-        # add the pull request data to the database
-        pr_to_insert = json_data[num].copy()
-        for date_str in ["created_at", "closed_at", "updated_at", "merged_at"]:
-            if pr_to_insert[date_str] is not None:
-                if pr_to_insert[date_str] != "None":
-                    pr_to_insert[date_str] = datetime.strptime(pr_to_insert[date_str], date_format)
-
-        pr_collection.update_one(search, {"$set": pr_to_insert}, upsert=True)
+    pull_requests = parse_fetched_pull_requests(
+        repo.fetch(from_date=cut_off_date, to_date=current_date, category="pull_request"), date_format)
+    records.update(store_fetched_items(pr_collection, repo_owner, repo_name, pull_requests, PULL_REQUEST_PROJECTION,
+                                       pull_request_record_from_document, previous))
 
     logger.info("Pull Request data successfully retrieved")
-    return json_data
+    return ItemUpdates(records, since, previous,
+                       most_recent_date([latest_update, *(record.updated_at for record in records.values())]))
 
 
-def retrieve_commits(repo_instance):
+def get_counted_item_dates(repo_owner, repo_name, mongo_client, dimensions=HEATMAP_DIMENSIONS):
     """
-    Retrieves a list of unique commit objects from a Repo object
-    :param repo_instance: the Repo object
-    :return: a list of unique commits
+    Gets the dates that the stored heatmap counted the issues and pull requests up to. The stored heatmap and activity
+    histograms can only be updated with the items changed since then if they were counted from every item stored up to
+    then, with the same dimensions and resolutions. Otherwise (eg. the previous run stored the items it fetched but
+    failed before storing the heatmap) every item is counted again
+    :param repo_owner: the owner of the repository
+    :param repo_name: the name of the repository
+    :param mongo_client: the MongoClient object from PyMongo
+    :param dimensions: the dimensions of the heatmap (width, height)
+    :return: a dictionary of 'issues' and 'pull_requests' -> the date to retrieve the changed items from, or None if the
+    heatmap has to be counted from every item
     """
-    commit_list = []
-    hexshas = set()
-    for ref in tqdm(repo_instance.references, desc="extracting commits from branches"):
-        for commit in repo_instance.iter_commits(ref.name):
-            if commit.hexsha in hexshas:
-                continue
-            commit_list.append(commit)
-            hexshas.add(commit.hexsha)
-    return commit_list
-
-
-def generate_heatmap_data(repo_owner, repo_name, repo_instance, mongo_client, logger, dimensions=(19, 8)):
+    db = mongo_client["test_db"]
+    codec_options = CodecOptions(tz_aware=True, tzinfo=timezone.utc)
+    stored = db["repositories"].with_options(codec_options=codec_options).find_one(
+        {"name": repo_name, "owner": repo_owner}, {"_id": 0, "heatmap_state": 1}) or {}
+    state = stored.get("heatmap_state") or {}
+    if state.get("source") != "full" or state.get("dimensions") != list(dimensions) \
+            or state.get("resolutions") != ACTIVITY_RESOLUTIONS or "items" not in state:
+        return None
+
+    counted = {}
+    for collection_name, items in state["items"].items():
+        collection = db[collection_name].with_options(codec_options=codec_options)
+        if get_latest_update(collection, repo_owner, repo_name) != items["updated_at"]:
+            return None
+        # with nothing stored, nothing was updated between the start of the counted items and the previous run
+        counted[collection_name] = most_recent_date([items["updated_at"], items["since"]])
+    return counted
+
+
+def fetch_github_items(repo_owner, repo_name, mongo_client, logger, dimensions=HEATMAP_DIMENSIONS,
+                       archive_dir=FETCH_ARCHIVE_DIR):
     """
-    Generates the heatmap data. The data includes metrics for issues, pull requests and commit frequency.
+    Retrieves the issues and pull requests needed for the heatmap. This only needs the github API and mongodb, so it can
+    run while the repository is still being cloned.
     :param repo_owner: the owner of the repository
     :param repo_name: the name of the repository
-    :param repo_instance: the local git Repo object
     :param mongo_client: the MongoClient object from PyMongo
     :param logger: The logger object to use for logging information
     :param dimensions: the dimensions of the heatmap to generate (width, height)
-    :return: an array containing the necessary data for the heatmap
+    :param archive_dir: the directory of the raw fetch archives, so that a failed or repeated run replays what was
+    already fetched
+    :return: a tuple of the ItemUpdates of the issues and of the pull requests
     """
     num_weeks = dimensions[0] * dimensions[1]
-    start_date = datetime.now(timezone.utc) - timedelta(weeks=num_weeks)
-    end_date = datetime.now(timezone.utc)
+    # only the items that changed since the stored heatmap are retrieved, when it can be updated with them
+    counted = get_counted_item_dates(repo_owner, repo_name, mongo_client, dimensions)
+    if counted is None:
+        logger.info("Retrieving every issue and pull request of the heatmap window")
+        counted = {"issues": None, "pull_requests": None}
+
+    # each category is fetched by one worker per token, and both categories are fetched at the same time. All of the
+    # requests share the process wide token manager
+    repo = GitHubFetcher(repo_owner, repo_name, ACCESS_TOKENS,
+                         archive_factory=partial(FetchArchive, repo_owner, repo_name, archive_dir=archive_dir))
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="github-items") as executor:
+        issues = executor.submit(retrieve_issues, repo_owner, repo_name, repo, num_weeks, mongo_client, logger,
+                                 since=counted["issues"])
+        pull_requests = executor.submit(retrieve_pull_requests, repo_owner, repo_name, repo, num_weeks, mongo_client,
+                                        logger, since=counted["pull_requests"])
+        return issues.result(), pull_requests.result()
+
+
+def get_heatmap_weeks(num_weeks, now=None):
+    """
+    Gets the weeks covered by the heatmap. The weeks start on monday at midnight UTC, so the boundaries stay the same
+    from one run to the next and the last week is the current, unfinished week.
+    :param num_weeks: the number of weeks in the heatmap
+    :param now: the current datetime (optional)
+    :return: a list of (start, end) datetime tuples, oldest first
+    """
+    if now is None:
+        now = datetime.now(timezone.utc)
+    now = now.astimezone(timezone.utc)
+    current_week = (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+    return list(date_span(current_week - timedelta(weeks=num_weeks - 1), current_week + timedelta(weeks=1)))
 
-    results = []
 
-    tokens = ACCESS_TOKENS
-    tokens = [token for token in tokens if token is not None]
+def count_heatmap_weeks(events, weeks):
+    """
+    Counts the heatmap metrics for a set of weeks
+    :param events: the EventIndex for the repository
+    :param weeks: a sorted list of (start, end) datetime tuples
+    :return: a list with the issue, pull request and commit counts of each week
+    """
+    return format_week_counts(events.count(*get_week_timestamps(weeks)))
+
+
+def get_week_timestamps(weeks):
+    """
+    Converts a list of weeks into the period arrays used by EventIndex.count
+    :param weeks: a sorted list of (start, end) datetime tuples
+    :return: a tuple of NumPy int64 arrays of the start and end timestamp of each week
+    """
+    return (np.array([to_timestamp(start) for start, _ in weeks], dtype=np.int64),
+            np.array([to_timestamp(end) for _, end in weeks], dtype=np.int64))
+
 
-    repo = GitHub(
-        owner=repo_owner,
-        repository=repo_name,
-        api_token=tokens,
-        sleep_for_rate=True,
-        sleep_time=300
-    )
+def format_week_counts(counts):
+    """
+    Converts the counts returned by EventIndex.count into the counts of each heatmap week
+    :param counts: a dictionary of series name -> NumPy array of the count for each week
+    :return: a list with the issue, pull request and commit counts of each week
+    """
+    weeks = []
+    for i in range(len(counts["commits_created"])):
+        week = {}
+        for series, (group, field) in HEATMAP_FIELDS.items():
+            week.setdefault(group, {})[field] = int(counts[series][i])
+        weeks.append(week)
+    return weeks
+
+
+def get_stored_week_counts(week):
+    """
+    Reads the counts of a stored heatmap week in the format used by count_changed_periods
+    :param week: a heatmap week (see format_heatmap_data)
+    :return: a dictionary of series name -> count
+    """
+    return {series: week[group][field] for series, (group, field) in HEATMAP_FIELDS.items()}
 
-    issues = retrieve_issues(repo_owner, repo_name, repo, num_weeks, mongo_client, logger)
-    pull_requests = retrieve_pull_requests(repo_owner, repo_name, repo, num_weeks, mongo_client, logger)
-    commits = retrieve_commits(repo_instance)
 
-    for start_of_week, end_of_week in date_span(start_date, end_date):
-        index = num_weeks - len(results) - 1
-        obj = {
+def format_heatmap_data(weeks, counts, dimensions=HEATMAP_DIMENSIONS):
+    """
+    Lays out the weekly counts as heatmap cells, newest week first
+    :param weeks: a list of (start, end) datetime tuples, oldest first
+    :param counts: the counts of each week (see count_heatmap_weeks)
+    :param dimensions: the dimensions of the heatmap (width, height)
+    :return: an array containing the necessary data for the heatmap
+    """
+    num_weeks = dimensions[0] * dimensions[1]
+    results = []
+    for i, ((start_of_week, end_of_week), week_counts) in enumerate(zip(weeks, counts)):
+        index = num_weeks - i - 1
+        results.append({
             "week": index,
-            "start": start_of_week.strftime('%Y-%m-%d-%H'),
-            "end": end_of_week.strftime('%Y-%m-%d-%H'),
+            "start": start_of_week.strftime(HEATMAP_DATE_FORMAT),
+            "end": end_of_week.strftime(HEATMAP_DATE_FORMAT),
             "coords": {
                 "x": dimensions[0] - (index // dimensions[1]) - 1,
                 "y": index % dimensions[1]
             },
-            "issues": {
-                "open": 0
-            },
-            "pull_requests": {
-                "created": 0,
-                "merged": 0,
-                "closed": 0,
-            },
-            "commits": {
-                "created": 0
-            }
-        }
+            "issues": week_counts["issues"],
+            "pull_requests": week_counts["pull_requests"],
+            "commits": week_counts["commits"]
+        })
+    return results[::-1]
 
-        # check issues
-        for issue in issues.values():
-            if issue_is_open_in_week(issue, start_of_week, end_of_week):
-                obj["issues"]["open"] += 1
 
-        # check pull requests
-        for pr in pull_requests.values():
-            for option in ["created", "merged", "closed"]:
-                if pull_request_is_modified_in_week(pr, start_of_week, end_of_week, option):
-                    obj["pull_requests"][option] += 1
+def build_heatmap_data(issues, pull_requests, commits, dimensions=HEATMAP_DIMENSIONS, now=None):
+    """
+    Builds the heatmap data from the issues, pull requests and commits of a repository.
+    :param issues: a dictionary of id -> IssueRecord (see retrieve_issues)
+    :param pull_requests: a dictionary of id -> PullRequestRecord (see retrieve_pull_requests)
+    :param commits: the CommitIndex for the repository (see commit_index.build_commit_index)
+    :param dimensions: the dimensions of the heatmap to generate (width, height)
+    :param now: the current datetime (optional)
+    :return: an array containing the necessary data for the heatmap
+    """
+    weeks = get_heatmap_weeks(dimensions[0] * dimensions[1], now)
+    events = EventIndex(issues, pull_requests, commits)
+    return format_heatmap_data(weeks, count_heatmap_weeks(events, weeks), dimensions)
 
-        # check commits
-        for commit in commits:
-            if commit_is_in_week(commit, start_of_week, end_of_week):
-                obj["commits"]["created"] += 1
 
-        results.append(obj)
+def update_heatmap_data(repo_owner, repo_name, github_items, commits, mongo_client, logger,
+                        dimensions=HEATMAP_DIMENSIONS, now=None, resolutions=None):
+    """
+    Updates the heatmap data and the activity histograms. When fetch_github_items only retrieved the issues and pull
+    requests that changed since the stored heatmap, only those are indexed and applied to the stored weeks and
+    histograms (see count_changed_periods), which picks up changes to old weeks as well. Otherwise every week and
+    histogram period is counted from the items. The commits are always counted from the commit index, so commits added
+    with old dates (eg. a merged branch) are counted too.
+    :param repo_owner: the owner of the repository
+    :param repo_name: the name of the repository
+    :param github_items: the tuple of the ItemUpdates of the issues and pull requests returned by fetch_github_items
+    :param commits: the CommitIndex for the heatmap window
+    :param mongo_client: the MongoClient object from PyMongo
+    :param logger: The logger object to use for logging information
+    :param dimensions: the dimensions of the heatmap to generate (width, height)
+    :param now: the current datetime (optional)
+    :param resolutions: a dictionary of resolution -> number of periods. Defaults to ACTIVITY_RESOLUTIONS
+    :return: a tuple of the heatmap data, the activity histograms and the heatmap state to store with them
+    """
+    if now is None:
+        now = datetime.now(timezone.utc)
+    resolutions = resolutions or ACTIVITY_RESOLUTIONS
+    issues, pull_requests = github_items
+    weeks = get_heatmap_weeks(dimensions[0] * dimensions[1], now)
+
+    if issues.previous is None or pull_requests.previous is None:
+        logger.info("counting the heatmap from every issue and pull request")
+        stored_weeks = {}
+        stored_histograms = {}
+        counted_since = {"issues": issues.since, "pull_requests": pull_requests.since}
+        previous = EventIndex({}, {}, [])
+        open_issues = 0
+    else:
+        repo_collection = mongo_client["test_db"]["repositories"].with_options(
+            codec_options=CodecOptions(tz_aware=True, tzinfo=timezone.utc))
+        stored = repo_collection.find_one({"name": repo_name, "owner": repo_owner},
+                                          {"_id": 0, "heatmap_data": 1, "activity_histograms": 1, "heatmap_state": 1})
+        state = stored["heatmap_state"]
+        stored_weeks = {week["start"]: get_stored_week_counts(week) for week in stored["heatmap_data"]}
+        stored_histograms = stored["activity_histograms"]
+        counted_since = {name: items["since"] for name, items in state["items"].items()}
+
+        # the stored versions that were updated before the start of the counted items were never counted
+        previous_issues = {num: issue for num, issue in issues.previous.items()
+                           if issue.updated_at is not None and issue.updated_at > counted_since["issues"]}
+        previous_pull_requests = {num: pr for num, pr in pull_requests.previous.items()
+                                  if pr.updated_at is not None and pr.updated_at > counted_since["pull_requests"]}
+        previous = EventIndex(previous_issues, previous_pull_requests, [])
+        open_issues = state["open_issues"] - count_open_issues(previous_issues.values())
+        logger.info(f"updating the heatmap with the {len(issues.records)} issues and {len(pull_requests.records)} "
+                    f"pull requests that changed since the previous run")
+
+    current = EventIndex(issues.records, pull_requests.records, commits)
+    week_counts = count_changed_periods([stored_weeks.get(start.strftime(HEATMAP_DATE_FORMAT)) for start, _ in weeks],
+                                        *get_week_timestamps(weeks), current, previous, open_issues)
+    histograms = update_activity_histograms(stored_histograms, current, previous, open_issues, now, resolutions)
+
+    state = {
+        "source": "full",
+        "dimensions": list(dimensions),
+        "resolutions": dict(resolutions),
+        "updated_at": now,
+        "open_issues": open_issues + count_open_issues(issues.records.values()),
+        "items": {
+            "issues": {"since": counted_since["issues"], "updated_at": issues.updated_at},
+            "pull_requests": {"since": counted_since["pull_requests"], "updated_at": pull_requests.updated_at},
+        }
+    }
+    return format_heatmap_data(weeks, format_week_counts(week_counts), dimensions), histograms, state
 
-    return results[::-1]
+
+def update_heatmap_search_counts(repo_owner, repo_name, events, mongo_client, logger, dimensions=HEATMAP_DIMENSIONS,
+                                 now=None):
+    """
+    Updates the heatmap data from search counts (see heatmap_search.SearchCountIndex), which cost requests for every
+    week they are asked for. Only the weeks ending after the previous run and the weeks that are new to the window are
+    searched, the other weeks keep the search counts they were stored with. Every week is searched when there is no
+    stored heatmap, the dimensions have changed or the stored weeks were counted from the items instead. The commits of
+    every week are counted again from the local history.
+    :param repo_owner: the owner of the repository
+    :param repo_name: the name of the repository
+    :param events: the SearchCountIndex for the repository
+    :param mongo_client: the MongoClient object from PyMongo
+    :param logger: The logger object to use for logging information
+    :param dimensions: the dimensions of the heatmap to generate (width, height)
+    :param now: the current datetime (optional)
+    :return: a tuple of the heatmap data and the heatmap state to store with it
+    """
+    if now is None:
+        now = datetime.now(timezone.utc)
+    weeks = get_heatmap_weeks(dimensions[0] * dimensions[1], now)
+
+    repo_collection = mongo_client["test_db"]["repositories"].with_options(
+        codec_options=CodecOptions(tz_aware=True, tzinfo=timezone.utc))
+    stored = repo_collection.find_one({"name": repo_name, "owner": repo_owner},
+                                      {"_id": 0, "heatmap_data": 1, "heatmap_state": 1}) or {}
+    state = stored.get("heatmap_state")
+
+    if state is None or state["dimensions"] != list(dimensions) or state.get("source") != "counts":
+        stored_weeks = {}
+        searched_from = weeks[0][0]
+    else:
+        stored_weeks = {week["start"]: week for week in stored.get("heatmap_data", [])}
+        searched_from = state["updated_at"] - HEATMAP_REFRESH_MARGIN
+
+    searched = [i for i, (start, end) in enumerate(weeks)
+                if end > searched_from or start.strftime(HEATMAP_DATE_FORMAT) not in stored_weeks]
+    logger.info(f"searching the counts of {len(searched)} of {len(weeks)} heatmap weeks")
+
+    counts = [stored_weeks.get(start.strftime(HEATMAP_DATE_FORMAT)) for start, _ in weeks]
+    for i, week_counts in zip(searched, count_heatmap_weeks(events, [weeks[i] for i in searched])):
+        counts[i] = week_counts
+    commit_counts = count_events_in_periods(events.commits, *get_week_timestamps(weeks))
+    for week_counts, commit_count in zip(counts, commit_counts):
+        week_counts["commits"] = {"created": int(commit_count)}
+
+    state = {
+        "source": "counts",
+        "dimensions": list(dimensions),
+        "updated_at": now
+    }
+    return format_heatmap_data(weeks, counts, dimensions), state
 
 
-def push_heatmap_data_to_mongodb(repo_owner, repo_name, data, client):
+def push_heatmap_data_to_mongodb(repo_owner, repo_name, data, client, state=None, activity_histograms=None,
+                                 clear_activity_histograms=False):
     """
     Pushes the repository heatmap data to the mongoDB database
     :param repo_owner: the owner of the repository. Eg, 'facebook'
     :param repo_name: the name of the repository. Eg, 'react'
     :param data: the heatmap for the repository (list of dicts)
     :param client: the MongoDB client
+    :param state: the heatmap state returned by update_heatmap_data (optional)
+    :param activity_histograms: the histograms returned by build_activity_histograms (optional)
+    :param clear_activity_histograms: removes the stored histograms, for when they could not be updated and would
+    otherwise be left out of date
     :return: None
     """
     db = client['test_db']
@@ -383,4 +937,12 @@ def push_heatmap_data_to_mongodb(repo_owner, repo_name, data, client):
         "name": repo_name,
         "owner": repo_owner
     }
-    repo_collection.update_one(search_dict, {'$set': {'heatmap_data': data}}, upsert=True)
+    update = {'heatmap_data': data}
+    if state is not None:
+        update['heatmap_state'] = state
+    if activity_histograms is not None:
+        update['activity_histograms'] = activity_histograms
+    operations = {'$set': update}
+    if clear_activity_histograms:
+        operations['$unset'] = {'activity_histograms': ""}
+    repo_collection.update_one(search_dict, operations, upsert=True)
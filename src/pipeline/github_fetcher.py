@@ -0,0 +1,184 @@
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .exceptions import InvalidArgumentError
+from .github_items import GITHUB_ITEM_PROFILE, LightweightGitHub
+from .github_tokens import ManagedGitHub
+
+# the time range of a fetch is split into this many slices for each token, so that a token that finishes its slices
+# early can take over slices from the busier ones
+SLICES_PER_TOKEN = 4
+
+
+def split_time_range(from_date, to_date, num_slices):
+    """
+    Splits a time range into consecutive slices of equal length
+    :param from_date: the start datetime of the range
+    :param to_date: the end datetime of the range
+    :param num_slices: the number of slices
+    :return: a list of (start, end) datetime tuples, where each end is the start of the next slice
+    """
+    if num_slices < 1:
+        raise InvalidArgumentError("The number of slices must be at least 1")
+    step = (to_date - from_date) / num_slices
+    bounds = [from_date + step * i for i in range(num_slices)] + [to_date]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def clear_queue(q):
+    """
+    Removes every item from a queue
+    :param q: the queue.Queue
+    :return: None
+    """
+    while True:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            return
+
+
+def get_updated_at(item):
+    """
+    Gets the time an issue or pull request fetched by perceval was last updated
+    :param item: the item returned by perceval
+    :return: the datetime object
+    """
+    return datetime.strptime(item['data']['updated_at'], "%Y-%m-%dT%H:%M:%S%z")
+
+
+class GitHubFetcher:
+    """
+    Fetches issues or pull requests with one worker thread per access token. The time range of a fetch is split into
+    slices by update time, each worker fetches slices through its own perceval GitHub backend preferring its own token,
+    and the items of every slice are yielded as soon as it has been fetched, so they can be stored while the rest of
+    the fetch is still running.
+
+    With an archive, every slice is recorded once it has been fetched, and a later fetch replays the archived range
+    that starts at from_date and only fetches the time after its high water mark (see fetch_archive.FetchArchive). The
+    archived time before from_date is dropped once the fetch is complete.
+
+    The fetch method has the same signature as perceval's GitHub.fetch, so it can be used in place of the backend.
+    """
+    def __init__(self, repo_owner, repo_name, tokens, slices_per_token=SLICES_PER_TOKEN, backend_factory=None,
+                 archive_factory=None, offline=False, profile=GITHUB_ITEM_PROFILE):
+        """
+        :param repo_owner: the owner of the repository
+        :param repo_name: the name of the repository
+        :param tokens: the github access tokens to use, one worker is started for each of them
+        :param slices_per_token: the number of time slices to fetch for each token
+        :param backend_factory: a function that takes a token and returns an object with a perceval-like fetch method
+        (optional, defaults to a perceval GitHub backend)
+        :param archive_factory: a function that takes a category and returns a FetchArchive (optional, nothing is
+        archived without it)
+        :param offline: only replay the archive without fetching anything from github
+        :param profile: the field profile of the items (see github_items.ITEM_PROFILES), or 'perceval' to fetch them
+        with perceval's GitHub backend
+        """
+        self.repo_owner = repo_owner
+        self.repo_name = repo_name
+        # perceval can still fetch without a token, just with a much lower rate limit
+        self.tokens = list(tokens) or [None]
+        self.slices_per_token = slices_per_token
+        self.backend_factory = backend_factory or self.create_backend
+        self.archive_factory = archive_factory
+        self.offline = offline
+        self.profile = profile
+
+    def create_backend(self, token):
+        """
+        Creates a backend that prefers one token. The requests go through the shared token manager, so once the token
+        runs low the worker carries on with whichever token has the most budget left
+        :param token: the github access token
+        :return: the LightweightGitHub, or perceval GitHub backend with the 'perceval' profile
+        """
+        if self.profile == "perceval":
+            return ManagedGitHub(owner=self.repo_owner, repository=self.repo_name, preferred_token=token)
+        return LightweightGitHub(self.repo_owner, self.repo_name, preferred_token=token, profile=self.profile)
+
+    def fetch_slices(self, token, slices, category, results, archive=None):
+        """
+        Fetches time slices from a shared queue until it is empty, using one token. Each slice is put on the results
+        queue as soon as it has been fetched, followed by None once the worker has finished
+        :param token: the github access token of this worker
+        :param slices: a queue.Queue of (start, end) datetime tuples
+        :param category: the perceval category to fetch, 'issue' or 'pull_request'
+        :param results: a queue.Queue to put the list of items of each fetched slice on
+        :param archive: the FetchArchive to record each fetched slice in (optional)
+        :return: None
+        """
+        try:
+            while True:
+                try:
+                    start, end = slices.get_nowait()
+                except queue.Empty:
+                    return
+                backend = self.backend_factory(token)
+                slice_items = list(backend.fetch(category=category, from_date=start, to_date=end))
+                if archive is not None:
+                    archive.record(start, end, slice_items)
+                results.put(slice_items)
+        except Exception:
+            # the other workers stop after their current slice, since the fetch has failed anyway
+            clear_queue(slices)
+            raise
+        finally:
+            results.put(None)
+
+    def fetch(self, category="issue", from_date=None, to_date=None):
+        """
+        Fetches the items of a category that were updated between two dates. The items of each time slice are yielded
+        as soon as the slice has been fetched, in update order within the slice. An item that was updated during the
+        fetch can be returned by two slices: a copy is only yielded if it is newer than the copy yielded before it, so
+        keeping the last copy of each item gives its most recent version
+        :param category: the perceval category to fetch, 'issue' or 'pull_request'
+        :param from_date: the start datetime
+        :param to_date: the end datetime
+        :return: a generator of the fetched items
+        """
+        # the update time of the copy of each item (by number) that was yielded last
+        yielded = {}
+
+        def newer_items(items):
+            for item in sorted(items, key=get_updated_at):
+                number = item['data']['number']
+                updated_at = get_updated_at(item)
+                if number not in yielded or updated_at > yielded[number]:
+                    yielded[number] = updated_at
+                    yield item
+
+        archive = self.archive_factory(category) if self.archive_factory is not None else None
+        cut_off = from_date
+        if archive is not None:
+            archived_slices = archive.read_slices()
+            high_water_mark = min(archive.high_water_mark(from_date, archived_slices), to_date)
+            yield from newer_items(archive.replay(from_date, high_water_mark, archived_slices))
+            from_date = high_water_mark
+
+        if from_date < to_date and not self.offline:
+            slices = queue.Queue()
+            for time_slice in split_time_range(from_date, to_date, len(self.tokens) * self.slices_per_token):
+                slices.put(time_slice)
+            results = queue.Queue()
+
+            with ThreadPoolExecutor(max_workers=len(self.tokens), thread_name_prefix=f"fetch-{category}") as executor:
+                futures = [executor.submit(self.fetch_slices, token, slices, category, results, archive)
+                           for token in self.tokens]
+                try:
+                    running = len(futures)
+                    while running:
+                        slice_items = results.get()
+                        if slice_items is None:
+                            running -= 1
+                        else:
+                            yield from newer_items(slice_items)
+                finally:
+                    # when the consumer stops early, the workers stop after their current slice
+                    clear_queue(slices)
+            for future in futures:
+                future.result()
+
+        if archive is not None:
+            # nothing before the start of this fetch is needed again
+            archive.compact(cut_off)
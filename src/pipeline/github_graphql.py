@@ -0,0 +1,184 @@
+import json
+import os
+
+from dotenv import load_dotenv
+
+from .exceptions import HTTPError
+from .github_tokens import github_auth
+from .http_client import get_session
+
+load_dotenv()
+GRAPHQL_URL = os.environ.get("GITHUB_GRAPHQL_URL", "https://api.github.com/graphql")
+
+# the number of repositories requested in one query. Github limits the cost of a single query, and the languages and
+# topics connections of each repository add to it
+METADATA_BATCH_SIZE = 25
+
+# the fields stored from the REST API that GraphQL has no equivalent for. They are left out of the prefetched metadata,
+# so a repository keeps the values stored by an earlier REST run, if any
+REST_ONLY_METADATA_KEYS = ("has_downloads", "has_pages")
+
+REPOSITORY_METADATA_FRAGMENT = """
+fragment RepositoryMetadata on Repository {
+  description
+  forkCount
+  stargazerCount
+  watchers { totalCount }
+  diskUsage
+  defaultBranchRef { name }
+  issues(states: OPEN) { totalCount }
+  pullRequests(states: OPEN) { totalCount }
+  primaryLanguage { name }
+  languages(first: 100, orderBy: {field: SIZE, direction: DESC}) { edges { size node { name } } }
+  repositoryTopics(first: 100) { nodes { topic { name } } }
+  licenseInfo { key name spdxId url }
+  owner { __typename login avatarUrl url }
+  hasIssuesEnabled
+  hasProjectsEnabled
+  hasWikiEnabled
+  isArchived
+  isDisabled
+  isFork
+  visibility
+  homepageUrl
+  url
+  pushedAt
+  createdAt
+  updatedAt
+}
+"""
+
+
+def build_metadata_query(repo_strs):
+    """
+    Builds a GraphQL query that requests the metadata of several repositories at once. Each repository is given the
+    alias 'r<index>' so that its result can be matched back to its position in repo_strs
+    :param repo_strs: a list of repositories written as '<owner>/<name>'
+    :return: the query (str)
+    """
+    fields = []
+    for index, repo_str in enumerate(repo_strs):
+        repo_owner, repo_name = repo_str.split("/")
+        # json.dumps gives a correctly escaped GraphQL string literal
+        fields.append(f"  r{index}: repository(owner: {json.dumps(repo_owner)}, name: {json.dumps(repo_name)}) "
+                      "{ ...RepositoryMetadata }")
+    return "query {\n" + "\n".join(fields) + "\n}\n" + REPOSITORY_METADATA_FRAGMENT
+
+
+def format_repository_metadata(repo_owner, repo_name, node):
+    """
+    Converts the GraphQL result for a repository into the same dictionary that get_repository_metadata builds from the
+    REST API, apart from the fields in REST_ONLY_METADATA_KEYS
+    :param repo_owner: the owner of the repository. Eg, 'facebook'
+    :param repo_name: the name of the repository. Eg, 'react'
+    :param node: the repository object from the GraphQL response
+    :return: the metadata dictionary
+    """
+    owner = node["owner"]
+    owner_obj = {
+        "login": owner["login"],
+        "avatar_url": owner["avatarUrl"],
+        "gravatar_id": "",
+        "html_url": owner["url"],
+        "type": owner["__typename"]
+    }
+    open_issues = node["issues"]["totalCount"] + node["pullRequests"]["totalCount"]
+    license_info = node["licenseInfo"]
+    data = {
+        "name": repo_name,
+        "owner": repo_owner,
+        "owner_obj": owner_obj,
+        "description": node["description"],
+        "forks": node["forkCount"],
+        "forks_count": node["forkCount"],
+        "language": (node["primaryLanguage"] or {}).get("name"),
+        # the REST API reports the number of stars as the number of watchers
+        "stargazers_count": node["stargazerCount"],
+        "watchers_count": node["stargazerCount"],
+        "watchers": node["stargazerCount"],
+        "subscribers_count": node["watchers"]["totalCount"],
+        "size": node["diskUsage"],
+        "default_branch": (node["defaultBranchRef"] or {}).get("name"),
+        # like the REST API, the open issue count includes open pull requests
+        "open_issues_count": open_issues,
+        "open_issues": open_issues,
+        "topics": [topic["topic"]["name"] for topic in node["repositoryTopics"]["nodes"]],
+        "has_issues": node["hasIssuesEnabled"],
+        "has_projects": node["hasProjectsEnabled"],
+        "has_wiki": node["hasWikiEnabled"],
+        "archived": node["isArchived"],
+        "disabled": node["isDisabled"],
+        "fork": node["isFork"],
+        "visibility": node["visibility"].lower(),
+        "homepage": node["homepageUrl"],
+        "html_url": node["url"],
+        "pushed_at": node["pushedAt"],
+        "created_at": node["createdAt"],
+        "updated_at": node["updatedAt"],
+        "license": {
+            "key": license_info["key"],
+            "name": license_info["name"],
+            "spdx_id": license_info["spdxId"],
+            "url": license_info["url"]
+        } if license_info is not None else None,
+        "languages": {edge["node"]["name"]: edge["size"] for edge in node["languages"]["edges"]},
+    }
+    if owner["__typename"] == "Organization":
+        data["organization_obj"] = owner_obj
+    return data
+
+
+def post_graphql_query(query, url=GRAPHQL_URL, session=None):
+    """
+    Sends a GraphQL query to github
+    :param query: the query (str)
+    :param url: the url of the GraphQL endpoint
+    :param session: the requests Session to send the request with (optional, defaults to the shared session)
+    :return: the parsed response, a dictionary with 'data' and possibly 'errors'
+    """
+    session = session or get_session()
+    response = session.post(url, json={"query": query}, auth=github_auth())
+    if response.status_code != 200:
+        raise HTTPError(response.status_code)
+    return response.json()
+
+
+def fetch_metadata_batch(repo_strs, url=GRAPHQL_URL, session=None):
+    """
+    Retrieves the metadata of several repositories with a single GraphQL request
+    :param repo_strs: a list of repositories written as '<owner>/<name>'
+    :param url: the url of the GraphQL endpoint
+    :param session: the requests Session to send the request with (optional, defaults to the shared session)
+    :return: a dictionary mapping each repository string to its metadata. Repositories that could not be found or
+    returned an error are left out
+    """
+    # a repository that does not exist is returned as null together with an error, the rest of the batch still succeeds
+    results = post_graphql_query(build_metadata_query(repo_strs), url, session).get("data") or {}
+    metadata = {}
+    for index, repo_str in enumerate(repo_strs):
+        node = results.get(f"r{index}")
+        if node is not None:
+            repo_owner, repo_name = repo_str.split("/")
+            metadata[repo_str] = format_repository_metadata(repo_owner, repo_name, node)
+    return metadata
+
+
+def prefetch_repository_metadata(repo_strs, url=GRAPHQL_URL, batch_size=METADATA_BATCH_SIZE, session=None):
+    """
+    Retrieves the metadata of many repositories in batches before they are processed. A batch that fails is skipped,
+    and the repositories that are missing from the result fall back to the REST API in process_repository
+    :param repo_strs: a list of repositories written as '<owner>/<name>'
+    :param url: the url of the GraphQL endpoint
+    :param batch_size: the number of repositories requested in one query
+    :param session: the requests Session to send the requests with (optional, defaults to the shared session)
+    :return: a tuple of the dictionary mapping each repository string to its metadata, and the list of errors raised by
+    failed batches
+    """
+    metadata = {}
+    errors = []
+    for start in range(0, len(repo_strs), batch_size):
+        try:
+            metadata.update(fetch_metadata_batch(repo_strs[start:start + batch_size], url, session))
+        except Exception as e:
+            errors.append(e)
+    return metadata, errors
@@ -0,0 +1,133 @@
+import os
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from .exceptions import HTTPError, InvalidArgumentError
+from .github_tokens import TokenAuth, get_token_manager
+from .http_client import get_session
+
+load_dotenv()
+GITHUB_API_URL = "https://api.github.com"
+
+# the sub-resources requested for every item of a category. Everything else comes from the issue list itself, which
+# returns 100 items per request:
+#   comments: the issue comments ('comments_data'), only requested for issues that have comments
+#   details: the single pull request object, which adds 'review_comments' and the author association fields
+#   reviews: the pull request reviews ('reviews_data')
+# 'full' has everything retrieve_issues and retrieve_pull_requests store, 'heatmap' only what the heatmap uses
+ITEM_PROFILES = {
+    "full": {"issue": ("comments",), "pull_request": ("details", "reviews")},
+    "heatmap": {"issue": (), "pull_request": ()},
+}
+# 'perceval' uses perceval's GitHub backend, which also requests users, reactions, requested reviewers and commits
+GITHUB_ITEM_PROFILE = os.environ.get("GITHUB_ITEM_PROFILE", "full")
+ITEMS_PER_PAGE = 100
+
+
+class LightweightGitHub:
+    """
+    Fetches issues and pull requests with the github REST API, only requesting the sub-resources of each item that are
+    named in its field profile. The items have the same layout as the items of perceval's GitHub backend, without the
+    fields that were not requested, so they can be used in place of perceval's items.
+    """
+    def __init__(self, owner, repository, preferred_token=None, profile=GITHUB_ITEM_PROFILE, token_manager=None,
+                 base_url=GITHUB_API_URL, session=None):
+        """
+        :param owner: the owner of the repository
+        :param repository: the name of the repository
+        :param preferred_token: the token to use while it has budget left (see TokenManager.acquire)
+        :param profile: the name of a profile in ITEM_PROFILES
+        :param token_manager: the TokenManager (optional, defaults to the shared one)
+        :param base_url: the url of the github REST API
+        :param session: the requests Session to send the requests with (optional, defaults to the shared session)
+        """
+        if profile not in ITEM_PROFILES:
+            raise InvalidArgumentError(f"Unknown item profile '{profile}', expected one of {list(ITEM_PROFILES)}")
+        self.repo_url = f"{base_url}/repos/{owner}/{repository}"
+        self.profile = ITEM_PROFILES[profile]
+        self.auth = TokenAuth(token_manager or get_token_manager(), preferred_token)
+        self.session = session
+
+    def get_pages(self, url, params=None):
+        """
+        Gets every page of a paginated list
+        :param url: the url of the list
+        :param params: the query parameters of the first page (optional)
+        :return: a generator of the objects in the list
+        """
+        session = self.session or get_session()
+        params = {"per_page": ITEMS_PER_PAGE, **(params or {})}
+        while url is not None:
+            response = session.get(url, params=params, auth=self.auth)
+            if response.status_code != 200:
+                raise HTTPError(response.status_code)
+            yield from response.json()
+            # the next page link already contains the query parameters
+            url = response.links.get("next", {}).get("url")
+            params = None
+
+    def get_object(self, url):
+        """
+        Gets a single object
+        :param url: the url of the object
+        :return: the parsed object
+        """
+        response = (self.session or get_session()).get(url, auth=self.auth)
+        if response.status_code != 200:
+            raise HTTPError(response.status_code)
+        return response.json()
+
+    def fetch_issue_list(self, from_date, to_date):
+        """
+        Gets the issues and pull requests updated between two dates from the issue list, oldest update first
+        :param from_date: the start datetime
+        :param to_date: the end datetime
+        :return: a generator of the issue objects
+        """
+        params = {"state": "all", "sort": "updated", "direction": "asc",
+                  "since": from_date.strftime("%Y-%m-%dT%H:%M:%SZ")}
+        for issue in self.get_pages(f"{self.repo_url}/issues", params):
+            if datetime.strptime(issue["updated_at"], "%Y-%m-%dT%H:%M:%S%z") > to_date:
+                return
+            yield issue
+
+    def fetch(self, category="issue", from_date=None, to_date=None):
+        """
+        Fetches the items of a category that were updated between two dates. Like perceval, the 'issue' category
+        includes pull requests, and the 'pull_request' category only has pull requests
+        :param category: 'issue' or 'pull_request'
+        :param from_date: the start datetime
+        :param to_date: the end datetime
+        :return: a generator of items in perceval's layout, {'data': ..., 'category': ...}
+        """
+        sub_resources = self.profile[category]
+        for issue in self.fetch_issue_list(from_date, to_date):
+            if category == "issue":
+                if "comments" in sub_resources:
+                    comments_url = f"{self.repo_url}/issues/{issue['number']}/comments"
+                    issue["comments_data"] = list(self.get_pages(comments_url)) if issue["comments"] else []
+                yield {"data": issue, "category": category}
+            elif "pull_request" in issue:
+                yield {"data": self.build_pull_request(issue, sub_resources), "category": category}
+
+    def build_pull_request(self, issue, sub_resources):
+        """
+        Builds a pull request item from its entry in the issue list, adding the requested sub-resources
+        :param issue: the issue object of the pull request
+        :param sub_resources: the sub-resources to request
+        :return: the pull request object
+        """
+        merged_at = issue["pull_request"].get("merged_at")
+        pull_request = {key: value for key, value in issue.items() if key != "pull_request"}
+        pull_request["merged_at"] = merged_at
+        pull_request["merged"] = merged_at is not None
+        if "details" in sub_resources:
+            pull_request.update(self.get_object(f"{self.repo_url}/pulls/{issue['number']}"))
+        if "reviews" in sub_resources:
+            reviews = list(self.get_pages(f"{self.repo_url}/pulls/{issue['number']}/reviews"))
+            for review in reviews:
+                # perceval stores the reviewer's user object as 'user_data'. Only the login is used
+                review["user_data"] = {"login": review["user"]["login"]} if review.get("user") else None
+            pull_request["reviews_data"] = reviews
+        return pull_request
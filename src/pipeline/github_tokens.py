@@ -0,0 +1,209 @@
+import os
+import threading
+import time
+from functools import partial
+
+import requests
+from dotenv import load_dotenv
+from perceval.backends.core.github import GitHub, GitHubClient
+
+load_dotenv()
+ACCESS_TOKENS = [os.environ.get('ACCESS_TOKEN')]
+for i in range(6):
+    env_token = os.environ.get(f"ACCESS_TOKEN{i}")
+    if env_token is not None:
+        ACCESS_TOKENS.append(env_token)
+ACCESS_TOKENS = [token for token in ACCESS_TOKENS if token is not None]
+
+# the hourly request budget of a token that has not been used yet (github's limit for authenticated requests)
+DEFAULT_RATE_LIMIT = 5000
+# a token is not handed out once it has this many requests left, which leaves room for requests already in flight
+MIN_REMAINING = 10
+# extra seconds to wait after a reset time, since the clocks of github and this machine can differ slightly
+RESET_MARGIN = 1
+# how long to wait when every token is used up but github did not say when they reset
+UNKNOWN_RESET_WAIT = 60
+
+
+class TokenState:
+    """
+    The last known rate limit budget of one token
+    """
+    __slots__ = ("token", "limit", "remaining", "reset")
+
+    def __init__(self, token):
+        self.token = token
+        self.limit = DEFAULT_RATE_LIMIT
+        # None until a response has been seen for the token
+        self.remaining = None
+        self.reset = None
+
+    def available(self):
+        """
+        :return: the number of requests the token is believed to have left
+        """
+        return self.limit if self.remaining is None else self.remaining
+
+
+class TokenManager:
+    """
+    Shares a set of github access tokens between every thread of the process. Each request is given the token with the
+    most remaining budget, the budget is updated from the 'X-RateLimit-*' headers of every response, and when every
+    token is used up the requesting thread sleeps only until the earliest reset time.
+    """
+    def __init__(self, tokens, min_remaining=MIN_REMAINING, clock=time.time, sleep=time.sleep):
+        """
+        :param tokens: the github access tokens. Without any tokens requests are sent unauthenticated
+        :param min_remaining: the number of requests to leave unused on each token
+        :param clock: a function returning the current unix time (optional)
+        :param sleep: a function that sleeps for a number of seconds (optional)
+        """
+        self.states = {token: TokenState(token) for token in (tokens or [None])}
+        self.min_remaining = min_remaining
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+
+    def acquire(self, preferred=None):
+        """
+        Gets a token to send a request with, sleeping until a reset if every token is used up
+        :param preferred: a token to use as long as it still has budget left (optional). This keeps each worker of the
+        GitHubFetcher on its own token while the tokens last
+        :return: the token (None when the manager has no tokens)
+        """
+        while True:
+            with self.lock:
+                now = self.clock()
+                for state in self.states.values():
+                    if state.reset is not None and now >= state.reset + RESET_MARGIN:
+                        state.remaining = None
+                        state.reset = None
+
+                available = [state for state in self.states.values() if state.available() > self.min_remaining]
+                if available:
+                    state = self.states.get(preferred)
+                    if state not in available:
+                        state = max(available, key=TokenState.available)
+                    # reserve a request so that concurrent threads see the budget going down straight away
+                    if state.remaining is not None:
+                        state.remaining -= 1
+                    return state.token
+
+                resets = [state.reset for state in self.states.values() if state.reset is not None]
+                wait = min(resets) + RESET_MARGIN - now if resets else UNKNOWN_RESET_WAIT
+            self.sleep(max(wait, 0))
+
+    def update(self, token, headers):
+        """
+        Updates the budget of a token from the headers of a response that was sent with it
+        :param token: the token that the request was sent with
+        :param headers: the response headers
+        :return: None
+        """
+        if "X-RateLimit-Remaining" not in headers:
+            return
+        with self.lock:
+            state = self.states[token]
+            state.remaining = int(headers["X-RateLimit-Remaining"])
+            if "X-RateLimit-Limit" in headers:
+                state.limit = int(headers["X-RateLimit-Limit"])
+            if "X-RateLimit-Reset" in headers:
+                state.reset = int(headers["X-RateLimit-Reset"])
+
+    def gauges(self):
+        """
+        Gets the current budget of every token for monitoring. Tokens are identified by their last 4 characters
+        :return: a dictionary with the remaining budget of each token and of all tokens together
+        """
+        with self.lock:
+            tokens = [{
+                "token": "..." + state.token[-4:] if state.token else None,
+                "remaining": state.available(),
+                "limit": state.limit,
+                "reset": state.reset
+            } for state in self.states.values()]
+        return {
+            "tokens": tokens,
+            "total_remaining": sum(token["remaining"] for token in tokens)
+        }
+
+
+class TokenAuth(requests.auth.AuthBase):
+    """
+    Authenticates requests with a token from a TokenManager and reports the rate limit headers of each response back
+    to the manager
+    """
+    def __init__(self, manager, preferred=None):
+        self.manager = manager
+        self.preferred = preferred
+
+    def __call__(self, request):
+        token = self.manager.acquire(self.preferred)
+        if token is not None:
+            request.headers["Authorization"] = f"token {token}"
+        request.register_hook("response", partial(self.handle_response, token))
+        return request
+
+    def handle_response(self, token, response, *args, **kwargs):
+        self.manager.update(token, response.headers)
+        return response
+
+
+class ManagedGitHubClient(GitHubClient):
+    """
+    A perceval GitHub client that leaves the choice of token and the rate limit sleeping to a TokenManager instead of
+    checking the rate limit of every token itself
+    """
+    def __init__(self, token_manager, preferred_token, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session.auth = TokenAuth(token_manager, preferred_token)
+
+    def sleep_for_rate_limit(self):
+        # perceval would raise RateLimitError once the last token used is low, even when another token has budget
+        # left. The token manager switches tokens or sleeps before each request instead
+        pass
+
+    def update_rate_limit(self, response):
+        # the budget of each token is tracked by the token manager (see TokenAuth)
+        pass
+
+
+class ManagedGitHub(GitHub):
+    """
+    A perceval GitHub backend whose requests are authenticated by a TokenManager
+    """
+    def __init__(self, *args, token_manager=None, preferred_token=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_manager = token_manager or get_token_manager()
+        self.preferred_token = preferred_token
+
+    def _init_client(self, from_archive=False):
+        # no tokens and no sleeping in the client itself, the token manager does both
+        return ManagedGitHubClient(self.token_manager, self.preferred_token, self.owner, self.repository, None,
+                                   self.github_app_id, self.github_app_pk_filepath, self.base_url, False,
+                                   self.min_rate_to_sleep, self.sleep_time, self.max_retries, self.max_items,
+                                   self.archive, from_archive, self.ssl_verify)
+
+
+_token_manager = None
+_token_manager_lock = threading.Lock()
+
+
+def get_token_manager():
+    """
+    Gets the token manager shared by the whole process, creating it from ACCESS_TOKENS the first time
+    :return: the TokenManager
+    """
+    global _token_manager
+    with _token_manager_lock:
+        if _token_manager is None:
+            _token_manager = TokenManager(ACCESS_TOKENS)
+        return _token_manager
+
+
+def github_auth():
+    """
+    Gets an auth object for 'requests' calls to the github API that uses the shared token manager
+    :return: a TokenAuth object
+    """
+    return TokenAuth(get_token_manager())
@@ -0,0 +1,156 @@
+import json
+from datetime import timezone
+
+import numpy as np
+
+from .commit_index import EPOCH, MICROSECOND, as_commit_index
+from .exceptions import GraphQLError
+from .generate_heatmap_data import count_events_in_periods
+from .github_graphql import GRAPHQL_URL, post_graphql_query
+
+# the number of search counts requested in one GraphQL query
+SEARCH_COUNTS_PER_QUERY = 50
+# in 'auto' mode the search counts are used for repositories with at least this many issues and pull requests updated
+# during the heatmap window. Fetching that many items takes far more requests than one count query per week and metric
+SEARCH_MIN_ITEMS = 2000
+# 'full' fetches every issue and pull request, 'counts' only asks github for the weekly counts, and 'auto' picks one
+# based on the number of items. The source of a repository is set by the 'heatmap_source' field of its document
+HEATMAP_SOURCES = ("auto", "full", "counts")
+SEARCH_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# the EventIndex series that are counted with search queries
+SEARCH_SERIES = ("issues_open", "pull_requests_created", "pull_requests_merged", "pull_requests_closed")
+
+
+def format_search_date(timestamp):
+    """
+    Formats a timestamp for a github search qualifier
+    :param timestamp: the number of microseconds since the unix epoch
+    :return: the date string, in UTC with a precision of seconds
+    """
+    return (EPOCH + int(timestamp) * MICROSECOND).strftime(SEARCH_DATE_FORMAT)
+
+
+def get_search_queries(repo_owner, repo_name, period_start, period_end):
+    """
+    Gets the github search queries whose result counts make up the heatmap metrics of one period. The queries match the
+    rules used by EventIndex: an event is counted when it is at or after the start and before the end of the period,
+    and an issue is open when it was created before the start and was not closed until after the end. Like the stored
+    issues (the github issues list includes pull requests), the open issues include the open pull requests
+    :param repo_owner: the owner of the repository
+    :param repo_name: the name of the repository
+    :param period_start: the start timestamp of the period (see generate_heatmap_data.to_timestamp)
+    :param period_end: the end timestamp of the period
+    :return: a dictionary of series name -> list of queries, the series is the sum of the counts of its queries
+    """
+    repo = f"repo:{repo_owner}/{repo_name}"
+    start = format_search_date(period_start)
+    end = format_search_date(period_end)
+    # search ranges include both ends, so the range stops a second before the end of the period
+    last = format_search_date(period_end - 1_000_000)
+    return {
+        "issues_open": [f"{repo} is:open created:<{start}",
+                        f"{repo} is:closed created:<{start} closed:>{end}"],
+        "pull_requests_created": [f"{repo} is:pr created:{start}..{last}"],
+        "pull_requests_merged": [f"{repo} is:pr merged:{start}..{last}"],
+        "pull_requests_closed": [f"{repo} is:pr closed:{start}..{last}"],
+    }
+
+
+def fetch_search_counts(queries, url=GRAPHQL_URL, session=None, batch_size=SEARCH_COUNTS_PER_QUERY):
+    """
+    Gets the number of results of a list of github search queries, with many aliased searches in each GraphQL query
+    :param queries: a list of search queries
+    :param url: the url of the GraphQL endpoint
+    :param session: the requests Session to send the requests with (optional, defaults to the shared session)
+    :param batch_size: the number of searches in one GraphQL query
+    :return: a list of the number of results of each query
+    """
+    counts = []
+    for batch_start in range(0, len(queries), batch_size):
+        batch = queries[batch_start:batch_start + batch_size]
+        fields = [f"  q{index}: search(query: {json.dumps(query)}, type: ISSUE, first: 0) {{ issueCount }}"
+                  for index, query in enumerate(batch)]
+        response = post_graphql_query("query {\n" + "\n".join(fields) + "\n}", url, session)
+        results = response.get("data") or {}
+        if response.get("errors") or any(results.get(f"q{index}") is None for index in range(len(batch))):
+            raise GraphQLError(response.get("errors") or [{"message": "missing search results"}])
+        counts.extend(results[f"q{index}"]["issueCount"] for index in range(len(batch)))
+    return counts
+
+
+class SearchCountIndex:
+    """
+    A stand-in for EventIndex that gets the issue and pull request counts of each period from github search instead of
+    from fetched items, so the number of requests depends on the number of periods rather than the number of items.
+    Commits are still counted from the local history. Only the periods passed to count are requested, so with
+    update_heatmap_search_counts only the recalculated weeks cost any requests.
+    """
+    def __init__(self, repo_owner, repo_name, commits, url=GRAPHQL_URL, session=None):
+        """
+        :param repo_owner: the owner of the repository
+        :param repo_name: the name of the repository
+        :param commits: a CommitIndex or an iterable of CommitRecord tuples
+        :param url: the url of the GraphQL endpoint
+        :param session: the requests Session to send the requests with (optional, defaults to the shared session)
+        """
+        self.repo_owner = repo_owner
+        self.repo_name = repo_name
+        self.commits = np.sort(as_commit_index(commits).timestamps)
+        self.url = url
+        self.session = session
+
+    def count(self, period_starts, period_ends):
+        """
+        Counts the events in a set of periods
+        :param period_starts: a sorted NumPy array of the start timestamp of each period
+        :param period_ends: a sorted NumPy array of the end timestamp of each period
+        :return: a dictionary of series name -> NumPy array of the count for each period
+        """
+        # every query of every period is sent together, then the counts are summed back into their series
+        series = []
+        queries = []
+        for period, (start, end) in enumerate(zip(period_starts, period_ends)):
+            for name, period_queries in get_search_queries(self.repo_owner, self.repo_name, start, end).items():
+                series.extend((name, period) for _ in period_queries)
+                queries.extend(period_queries)
+
+        counts = {name: np.zeros(len(period_starts), dtype=np.int64) for name in SEARCH_SERIES}
+        if queries:
+            for (name, period), count in zip(series, fetch_search_counts(queries, self.url, self.session)):
+                counts[name][period] += count
+        counts["commits_created"] = count_events_in_periods(self.commits, period_starts, period_ends)
+        return counts
+
+
+def choose_heatmap_source(repo_owner, repo_name, mongo_client, since, logger, url=GRAPHQL_URL, session=None):
+    """
+    Chooses whether the heatmap of a repository is counted from fetched issues and pull requests ('full') or from
+    search counts ('counts'). The 'heatmap_source' field of the repository document can force either one, otherwise
+    ('auto') the search counts are only used for repositories with at least SEARCH_MIN_ITEMS items updated since the
+    start of the heatmap
+    :param repo_owner: the owner of the repository
+    :param repo_name: the name of the repository
+    :param mongo_client: the MongoClient object from PyMongo
+    :param since: the start of the heatmap (datetime)
+    :param logger: The logger object to use for logging information
+    :param url: the url of the GraphQL endpoint
+    :param session: the requests Session to send the requests with (optional, defaults to the shared session)
+    :return: 'full' or 'counts'
+    """
+    stored = mongo_client["test_db"]["repositories"].find_one({"name": repo_name, "owner": repo_owner},
+                                                              {"_id": 0, "heatmap_source": 1}) or {}
+    source = stored.get("heatmap_source", "auto")
+    if source not in HEATMAP_SOURCES:
+        logger.warning(f"unknown heatmap source '{source}', using 'auto'")
+        source = "auto"
+    if source != "auto":
+        return source
+
+    query = f"repo:{repo_owner}/{repo_name} updated:>={since.astimezone(timezone.utc).strftime(SEARCH_DATE_FORMAT)}"
+    try:
+        num_items = fetch_search_counts([query], url, session)[0]
+    except Exception as e:
+        logger.warning(f"could not count the issues and pull requests of the repository, fetching all of them: {e!r}")
+        return "full"
+    logger.info(f"{num_items} issues and pull requests were updated during the heatmap window")
+    return "counts" if num_items >= SEARCH_MIN_ITEMS else "full"
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from .http_client import get_session
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+HTTP_CACHE_DIR = os.path.join(CURRENT_DIR, "http_cache")
+
+# the response headers that are kept with a cached body. 'Link' is needed to follow the pages of a paginated endpoint
+CACHED_HEADERS = ("Content-Type", "Link", "ETag", "Last-Modified")
+
+
+def get_cache_path(url, headers=None, cache_dir=HTTP_CACHE_DIR):
+    """
+    Gets the path of the cache file for a request. The 'Accept' header is part of the key since github returns a
+    different body for a different media type
+    :param url: the url of the request
+    :param headers: the headers of the request (optional)
+    :param cache_dir: the directory containing the cache
+    :return: the path of the cache file (str)
+    """
+    accept = (headers or {}).get("Accept", "")
+    key = hashlib.sha256(f"{url}\n{accept}".encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, key[:2], f"{key}.json")
+
+
+def load_cache_entry(path):
+    """
+    Loads a cached response
+    :param path: the path of the cache file
+    :return: the cache entry dictionary, or None if there is no usable entry
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+
+def store_cache_entry(path, response):
+    """
+    Stores a response in the cache. The file is written to a temporary file first so that a reader in another thread
+    or process never sees a partly written entry
+    :param path: the path of the cache file
+    :param response: the requests Response object
+    :return: None
+    """
+    entry = {
+        "url": response.url,
+        "status_code": response.status_code,
+        "headers": {key: response.headers[key] for key in CACHED_HEADERS if key in response.headers},
+        "body": response.content.decode("utf-8"),
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as cache_file:
+        json.dump(entry, cache_file)
+    os.replace(temp_path, path)
+
+
+def response_from_cache_entry(entry):
+    """
+    Rebuilds a response from a cache entry
+    :param entry: the cache entry dictionary
+    :return: the requests Response object
+    """
+    response = requests.Response()
+    response.status_code = entry["status_code"]
+    response.url = entry["url"]
+    response.headers = CaseInsensitiveDict(entry["headers"])
+    response.encoding = "utf-8"
+    response._content = entry["body"].encode("utf-8")
+    return response
+
+
+def cached_get(url, cache_dir=HTTP_CACHE_DIR, session=None, **kwargs):
+    """
+    Sends a conditional GET request. When a previous response to the same request had an 'ETag' or 'Last-Modified'
+    header, it is sent back as 'If-None-Match' or 'If-Modified-Since', and a 304 response is answered with the cached
+    body. Github does not count 304 responses against the rate limit.
+    :param url: the url of the request
+    :param cache_dir: the directory containing the cache
+    :param session: the requests Session to send the request with (optional, defaults to the shared session)
+    :param kwargs: any other arguments for session.get, such as headers and auth
+    :return: the requests Response object, with status code 200 when it came from the cache
+    """
+    session = session or get_session()
+    headers = dict(kwargs.pop("headers", None) or {})
+    path = get_cache_path(url, headers, cache_dir)
+    entry = load_cache_entry(path)
+    if entry is not None:
+        if "ETag" in entry["headers"]:
+            headers["If-None-Match"] = entry["headers"]["ETag"]
+        if "Last-Modified" in entry["headers"]:
+            headers["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+
+    response = session.get(url, headers=headers, **kwargs)
+    if response.status_code == 304 and entry is not None:
+        return response_from_cache_entry(entry)
+    if response.status_code == 200 and ("ETag" in response.headers or "Last-Modified" in response.headers):
+        store_cache_entry(path, response)
+    return response
@@ -0,0 +1,104 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeouts in seconds for every request that does not set its own
+HTTP_TIMEOUT = (10, 60)
+# the number of connections kept alive per host, enough for every stage worker and fetch worker to have one
+POOL_SIZE = 32
+MAX_RETRIES = 5
+# the delay before the first retry in seconds, which doubles with every attempt up to BACKOFF_MAX
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+RETRY_STATUSES = {500, 502, 503, 504}
+
+
+def is_secondary_rate_limit(response):
+    """
+    Checks if a response was rejected by one of github's secondary rate limits (or a used up primary rate limit), which
+    is worth retrying after a wait rather than failing
+    :param response: the requests Response object
+    :return: True if the request should be retried, False otherwise
+    """
+    if response.status_code == 429:
+        return True
+    if response.status_code != 403:
+        return False
+    return "Retry-After" in response.headers or response.headers.get("X-RateLimit-Remaining") == "0" \
+        or "secondary rate limit" in response.text.lower()
+
+
+def get_backoff(attempt, response=None, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    """
+    Gets the number of seconds to wait before retrying a request. A 'Retry-After' header is followed as it is, otherwise
+    the delay grows exponentially with full jitter so that the threads that failed together do not retry together
+    :param attempt: the number of attempts that have failed so far, starting from 0
+    :param response: the response of the failed attempt (optional, None when the request raised an exception)
+    :param base: the delay of the first retry in seconds
+    :param maximum: the longest delay in seconds
+    :return: the delay in seconds
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None and retry_after.isdigit():
+            return min(int(retry_after), maximum)
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+class RetryingSession(requests.Session):
+    """
+    A requests Session that keeps connections alive in a pool, sets a default timeout and retries server errors,
+    rate limited responses and connection errors with a jittered exponential backoff. The auth object is applied again
+    for every attempt, so a retry with github_auth() can be sent with a different token.
+    """
+    def __init__(self, max_retries=MAX_RETRIES, timeout=HTTP_TIMEOUT, pool_size=POOL_SIZE, sleep=time.sleep):
+        """
+        :param max_retries: the number of times a request is retried before the last response is returned
+        :param timeout: the default timeout of each attempt
+        :param pool_size: the number of connections kept alive per host
+        :param sleep: a function that sleeps for a number of seconds (optional)
+        """
+        super().__init__()
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.sleep = sleep
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                self.sleep(get_backoff(attempt))
+            else:
+                retry = response.status_code in RETRY_STATUSES or is_secondary_rate_limit(response)
+                if not retry or attempt >= self.max_retries:
+                    return response
+                self.sleep(get_backoff(attempt, response))
+                response.close()
+            attempt += 1
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Gets the http session shared by the whole process, so that every request reuses the same connection pool
+    :return: the RetryingSession
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = RetryingSession()
+        return _session
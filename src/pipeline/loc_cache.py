@@ -0,0 +1,206 @@
+import json
+import os
+import sqlite3
+import subprocess
+import tempfile
+from contextlib import closing
+
+from .repo_cache import get_missing_objects, prefetch_blobs
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the cache of the LOC counts of every file content (git blob) that has been counted, shared by every tag and repository
+LOC_CACHE_PATH = os.environ.get("LOC_CACHE_PATH", os.path.join(CURRENT_DIR, "loc_cache.sqlite3"))
+LOC_CACHE = os.environ.get("LOC_CACHE", "true").lower() not in ("0", "false", "no")
+
+# symbolic links and submodules are not files that cloc counts
+SKIPPED_MODES = ("120000", "160000")
+LOC_TYPES = ("blank", "comment", "code")
+# the number of blobs looked up in a single sqlite query, below sqlite's limit on the number of query parameters
+LOOKUP_BATCH_SIZE = 500
+
+
+def connect_loc_cache(path=LOC_CACHE_PATH):
+    """
+    Opens the LOC cache, creating it if needed. The counts of a blob are keyed by its sha and its file name, since cloc
+    picks the language from the file name (eg. the extension, or names like 'Makefile'). The file name is stored as
+    bytes, since git file names do not have to be valid UTF-8. Files that cloc does not count are stored with no
+    language so that they are not sent to cloc again
+    :param path: the path of the sqlite database
+    :return: the sqlite3 Connection
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # the cache is written by the LOC workers of every repository being processed, so writers wait for each other
+    connection = sqlite3.connect(path, timeout=60)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS blob_loc (
+            blob_sha TEXT NOT NULL,
+            file_name BLOB NOT NULL,
+            language TEXT,
+            blank INTEGER NOT NULL,
+            comment INTEGER NOT NULL,
+            code INTEGER NOT NULL,
+            PRIMARY KEY (blob_sha, file_name)
+        ) WITHOUT ROWID
+    """)
+    return connection
+
+
+def list_tree_blobs(repo_path, revision):
+    """
+    Lists the files of a revision with 'git ls-tree'. A content that appears more than once is only listed once, under
+    the first of its paths, since cloc also counts duplicate files once
+    :param repo_path: the path of the git repository (a working tree or a bare mirror)
+    :param revision: the commit to list, eg. a tag's commit sha
+    :return: a dictionary mapping each blob sha to its file name
+    """
+    p = subprocess.run(["git", "-C", repo_path, "ls-tree", "-r", "-z", "--full-tree", revision], capture_output=True)
+    if p.returncode != 0:
+        raise SystemError(p.stderr)
+
+    blobs = {}
+    for entry in p.stdout.decode("utf-8", errors="surrogateescape").split("\0"):
+        if not entry:
+            continue
+        info, path = entry.split("\t", 1)
+        mode, object_type, sha = info.split()
+        if object_type == "blob" and mode not in SKIPPED_MODES:
+            blobs.setdefault(sha, os.path.basename(path))
+    return blobs
+
+
+def write_blobs(repo_path, blobs, destination):
+    """
+    Writes file contents from a git repository into a directory, each into '<destination>/<blob sha>/<file name>'
+    :param repo_path: the path of the git repository
+    :param blobs: a dictionary mapping each blob sha to its file name
+    :param destination: the directory to write the files to
+    :return: None
+    """
+    with tempfile.TemporaryFile() as shas_file:
+        shas_file.write("".join(f"{sha}\n" for sha in blobs).encode("utf-8"))
+        shas_file.seek(0)
+        # the contents are streamed from 'git cat-file' one blob at a time instead of being held in memory
+        with subprocess.Popen(["git", "-C", repo_path, "cat-file", "--batch"], stdin=shas_file, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL) as p:
+            for _ in blobs:
+                header = p.stdout.readline().decode("utf-8").split()
+                if len(header) != 3:
+                    raise SystemError(f"git cat-file could not read a blob: {' '.join(header)}")
+                sha, object_type, size = header
+                blob_dir = os.path.join(destination, sha)
+                os.makedirs(blob_dir)
+                with open(os.path.join(blob_dir, blobs[sha]), "wb") as blob_file:
+                    remaining = int(size)
+                    while remaining:
+                        chunk = p.stdout.read(min(remaining, 1 << 20))
+                        blob_file.write(chunk)
+                        remaining -= len(chunk)
+                p.stdout.read(1)  # the newline after the contents
+        if p.returncode != 0:
+            raise SystemError(f"git cat-file exited with {p.returncode}")
+
+
+def count_blob_files(directory, blobs):
+    """
+    Counts the files written by write_blobs with 'cloc --by-file'
+    :param directory: the directory the files were written to
+    :param blobs: a dictionary mapping each blob sha to its file name
+    :return: a dictionary mapping each blob sha to a (language, blank, comment, code) tuple. The language is None for
+    the files that cloc does not count
+    """
+    p = subprocess.run("cloc . --by-file --json", cwd=directory, capture_output=True, shell=True)
+    if p.returncode != 0:
+        raise SystemError(p.stderr)
+
+    counts = {sha: (None, 0, 0, 0) for sha in blobs}
+    # cloc prints nothing at all when none of the files are counted. The paths are printed as they are on disk, which
+    # is not always valid UTF-8, but only their first part (the blob sha) is used
+    output = json.loads(p.stdout.decode("utf-8", errors="replace")) if p.stdout.strip() else {}
+    for path, data in output.items():
+        if path in ("header", "SUM"):
+            continue
+        sha = os.path.normpath(path).split(os.sep)[0]
+        if sha in counts:
+            counts[sha] = (data["language"], data["blank"], data["comment"], data["code"])
+    return counts
+
+
+def lookup_blobs(connection, blobs):
+    """
+    Gets the cached counts of blobs
+    :param connection: the sqlite3 Connection of the cache
+    :param blobs: a dictionary mapping each blob sha to its file name
+    :return: a dictionary mapping the sha of each cached blob to a (language, blank, comment, code) tuple
+    """
+    counts = {}
+    shas = list(blobs)
+    for start in range(0, len(shas), LOOKUP_BATCH_SIZE):
+        batch = shas[start:start + LOOKUP_BATCH_SIZE]
+        rows = connection.execute(
+            f"SELECT blob_sha, file_name, language, blank, comment, code FROM blob_loc "
+            f"WHERE blob_sha IN ({', '.join('?' * len(batch))})", batch)
+        for sha, file_name, language, blank, comment, code in rows:
+            if os.fsencode(blobs[sha]) == file_name:
+                counts[sha] = (language, blank, comment, code)
+    return counts
+
+
+def store_blobs(connection, blobs, counts):
+    """
+    Adds the counts of blobs to the cache
+    :param connection: the sqlite3 Connection of the cache
+    :param blobs: a dictionary mapping each blob sha to its file name
+    :param counts: a dictionary mapping each blob sha to a (language, blank, comment, code) tuple
+    :return: None
+    """
+    with connection:
+        connection.executemany("INSERT OR REPLACE INTO blob_loc VALUES (?, ?, ?, ?, ?, ?)",
+                               [(sha, os.fsencode(blobs[sha]), *count) for sha, count in counts.items()])
+
+
+def summarise_blob_counts(counts):
+    """
+    Adds up the counts of the files of a revision per language, in the same format as cloc's output
+    :param counts: a dictionary mapping each blob sha to a (language, blank, comment, code) tuple
+    :return: a dictionary of languages and 'SUM', each with 'nFiles', 'blank', 'comment' and 'code'
+    """
+    summary = {}
+    total = {"nFiles": 0, "blank": 0, "comment": 0, "code": 0}
+    for language, *loc in counts.values():
+        if language is None:
+            continue
+        language_data = summary.setdefault(language, {"nFiles": 0, "blank": 0, "comment": 0, "code": 0})
+        for data in (language_data, total):
+            data["nFiles"] += 1
+            for loc_type, value in zip(LOC_TYPES, loc):
+                data[loc_type] += value
+    summary["SUM"] = total
+    return summary
+
+
+def count_revision_loc_cached(repo_path, revision, cache_path=LOC_CACHE_PATH, tmp_dir=None):
+    """
+    Counts the LOC of a revision from the per-blob cache. Only the files whose contents are not cached yet are written
+    to a temporary directory and counted with cloc, so a tag costs as much as the files that changed since the tags
+    that were already counted, in this repository or any other. With a blobless mirror only the contents of those
+    files are downloaded
+    :param repo_path: the path of the git repository (a working tree or a bare mirror)
+    :param revision: the commit to count, eg. a tag's commit sha
+    :param cache_path: the path of the sqlite database of the cache
+    :param tmp_dir: the directory to create the temporary directory in (None for the system's temporary directory)
+    :return: the LOC per language, in the same format as the output of the 'cloc' tool
+    """
+    blobs = list_tree_blobs(repo_path, revision)
+    with closing(connect_loc_cache(cache_path)) as connection:
+        counts = lookup_blobs(connection, blobs)
+        uncached = {sha: file_name for sha, file_name in blobs.items() if sha not in counts}
+        if uncached:
+            prefetch_blobs(repo_path, get_missing_objects(repo_path, revision) & uncached.keys())
+            with tempfile.TemporaryDirectory(prefix="loc-blobs-", dir=tmp_dir) as temp_dir:
+                write_blobs(repo_path, uncached, temp_dir)
+                new_counts = count_blob_files(temp_dir, uncached)
+            store_blobs(connection, uncached, new_counts)
+            counts.update(new_counts)
+    return summarise_blob_counts(counts)
@@ -0,0 +1,93 @@
+import time
+
+from pymongo import ASCENDING, UpdateOne
+
+# upserts are sent to mongodb in batches of this many operations, or after this many seconds, whichever comes first
+BULK_WRITE_BATCH_SIZE = 500
+BULK_WRITE_INTERVAL = 5
+
+# the compound indexes that the find and upsert calls of the pipeline rely on
+COLLECTION_INDEXES = {
+    "issues": [
+        [("owner", ASCENDING), ("name", ASCENDING), ("id", ASCENDING)],
+        [("owner", ASCENDING), ("name", ASCENDING), ("updated_at", ASCENDING)],
+    ],
+    "pull_requests": [
+        [("owner", ASCENDING), ("name", ASCENDING), ("id", ASCENDING)],
+        [("owner", ASCENDING), ("name", ASCENDING), ("updated_at", ASCENDING)],
+    ],
+    # releases are identified by their tag name rather than an id, and are never searched by update time
+    "releases": [
+        [("owner", ASCENDING), ("name", ASCENDING), ("tag_name", ASCENDING)],
+    ],
+}
+
+
+def ensure_indexes(mongo_client, logger=None):
+    """
+    Creates the indexes in COLLECTION_INDEXES if they do not exist yet. Creating an index that already exists does
+    nothing, so this is safe to call at the start of every pipeline run.
+    :param mongo_client: the MongoClient object from PyMongo
+    :param logger: The logger object to use for logging information (optional)
+    :return: None
+    """
+    db = mongo_client["test_db"]
+    for collection_name, indexes in COLLECTION_INDEXES.items():
+        for keys in indexes:
+            index_name = db[collection_name].create_index(keys)
+            if logger is not None:
+                logger.debug(f"ensured index {index_name} on the '{collection_name}' collection")
+
+
+class BulkUpserter:
+    """
+    Collects upserts for a collection and sends them with unordered bulk_write calls instead of one round trip per
+    document. The pending upserts are flushed when there are batch_size of them, when flush_interval seconds have passed
+    since the last flush, and when the upserter is closed. Use it as a context manager so that the last batch is always
+    written.
+
+    The operations of an unordered bulk write can be applied in any order, so a document that is upserted again before
+    a flush is written once, with the fields of the later upsert taking precedence.
+    """
+    def __init__(self, collection, batch_size=BULK_WRITE_BATCH_SIZE, flush_interval=BULK_WRITE_INTERVAL,
+                 clock=time.monotonic):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.clock = clock
+        # the pending fields of each document, keyed by its filter
+        self.pending = {}
+        self.last_flush = clock()
+
+    def upsert(self, search, fields):
+        """
+        Queues an update of the document matching search, which is inserted if it does not exist
+        :param search: the filter for the document
+        :param fields: the fields to $set on the document
+        :return: None
+        """
+        key = tuple(sorted(search.items()))
+        if key in self.pending:
+            self.pending[key][1].update(fields)
+        else:
+            self.pending[key] = (search, dict(fields))
+        if len(self.pending) >= self.batch_size or self.clock() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending upserts to mongodb
+        :return: None
+        """
+        if self.pending:
+            self.collection.bulk_write([UpdateOne(search, {"$set": fields}, upsert=True)
+                                        for search, fields in self.pending.values()], ordered=False)
+            self.pending = {}
+        self.last_flush = self.clock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # the documents fetched before an error are still written, so the next run does not need to fetch them again
+        self.flush()
@@ -7,30 +7,64 @@ import platform
 import re
 import ssl
 import subprocess
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import NamedTuple
 
 import colorama
 import git
-import requests
 from dotenv import load_dotenv
 from pymongo import MongoClient
 from tqdm.auto import tqdm
 
 from .colours import generate_repository_colours
-from .exceptions import HTTPError, RemoteRepoNotFoundError, InvalidArgumentError
-from .generate_heatmap_data import generate_heatmap_data, push_heatmap_data_to_mongodb
+from .exceptions import GraphQLError, HTTPError, RemoteRepoNotFoundError, InvalidArgumentError
+from .commit_index import build_commit_index
+from .commit_statistics import DEFAULT_WINDOWS, count_commits, count_commits_per_period, \
+    format_commits_per_author, format_commits_per_month, update_commit_statistics
+from .generate_heatmap_data import HEATMAP_DIMENSIONS, fetch_github_items, update_heatmap_data, \
+    update_heatmap_search_counts, get_heatmap_weeks, push_heatmap_data_to_mongodb
+from .heatmap_search import SearchCountIndex, choose_heatmap_source
+from .github_tokens import get_token_manager, github_auth
+from .http_cache import cached_get
 from .limit_languages import limit_languages_for_repository
+from .loc_cache import LOC_CACHE, count_revision_loc_cached
+from .mongo_helpers import ensure_indexes
+from .repo_cache import MIRRORS_DIR, BLOBLESS_CLONES, get_mirror_path, update_mirror, evict_mirrors, add_worktree, \
+    remove_worktree, release_mirror, get_missing_objects, prefetch_blobs
 from .sca_helpers import collect_scantist_sca_data
+from .stages import Stage, run_stages
 
 colorama.init(autoreset=True)
 load_dotenv()
-ACCESS_TOKEN = os.environ.get('ACCESS_TOKEN')
 CONNECTION_STRING = os.environ.get('CONNECTION_STRING')
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 REPOS_DIR = os.path.join(CURRENT_DIR, "tmp")
 LOGS_DIR = os.path.join(CURRENT_DIR, "logs")
 
+REMOTE_URL_TEMPLATE = "https://github.com/{owner}/{name}.git"
+
+# the maximum number of pipeline stages that run at the same time for a single repository
+STAGE_WORKERS = 4
+
+# the fields of the github repository object that are stored with the repository metadata
+REPOSITORY_METADATA_KEYS = ["description", "forks", "forks_count", "language", "stargazers_count", "watchers_count",
+                            "watchers", "size", "default_branch", "open_issues_count", "open_issues", "topics",
+                            "has_issues", "archived", "disabled", "visibility", "pushed_at", "created_at", "updated_at",
+                            "html_url", "fork", "homepage", "has_projects", "has_downloads", "has_wiki", "has_pages",
+                            "license", "subscribers_count"]
+
+# where the files of each tag are extracted for LOC counting (optional, defaults to the system's temporary directory).
+# Pointing it to a tmpfs keeps the extraction in memory
+LOC_TMP_DIR = os.environ.get("LOC_TMP_DIR")
+
+# the maximum number of tags counted at the same time (optional, defaults to the number of CPUs). Each tag is counted by
+# its own cloc process, which uses a single core. The worker processes of a batch share it (see batch.init_worker)
+LOC_WORKERS = int(os.environ.get("LOC_WORKERS", os.cpu_count() or 1))
+
 if not os.path.exists(REPOS_DIR):
     os.mkdir(REPOS_DIR)
 
@@ -156,11 +190,9 @@ def get_current_repo_log_directory(start_datetime):
     :return: the directory (str) to contain the log files
     """
     month_log_dir = os.path.join(LOGS_DIR, start_datetime.strftime("%Y-%m"))
-    if not os.path.exists(month_log_dir):
-        os.mkdir(month_log_dir)
     current_log_dir = os.path.join(month_log_dir, start_datetime.strftime("%Y-%m-%dT%H-%M-%S%z"))
-    if not os.path.exists(current_log_dir):
-        os.mkdir(current_log_dir)
+    # exist_ok because several worker processes may create the directory at the same time
+    os.makedirs(current_log_dir, exist_ok=True)
 
     return current_log_dir
 
@@ -183,6 +215,7 @@ def get_logger(repo_owner, repo_name, start_datetime):
     datetime_str = start_datetime.strftime('%Y-%m-%dT%H-%M-%S%z')
     logger = logging.getLogger(f"{datetime_str}/{repo_owner}/{repo_name}")
     logger.setLevel(logging.DEBUG)
+    logger.exception_has_occurred = False
 
     if logger.hasHandlers():
         logger.handlers = []
@@ -228,25 +261,38 @@ def get_releases(repo_owner, repo_name):
     :return: an array of release objects returned by the github REST API
     """
     url = f"https://api.github.com/repos/{repo_owner}/{repo_name}/releases?per_page=100&page=1"
-    res = requests.get(url, auth=("user", ACCESS_TOKEN))
+    res = cached_get(url, auth=github_auth())
 
     if res.status_code != 200:
         raise HTTPError(res.status_code)
 
     releases = res.json()
     while 'next' in res.links.keys():
-        res = requests.get(res.links['next']['url'], auth=("user", ACCESS_TOKEN))
+        res = cached_get(res.links['next']['url'], auth=github_auth())
         releases.extend(res.json())
     return releases
 
 
-def check_local_repo_exists(repo_name):
+def get_local_repo_path(repo_owner, repo_name, repos_dir=REPOS_DIR):
+    """
+    Gets the path of the local working tree for a repository
+    :param repo_owner: the owner of the repository. Eg, 'facebook'
+    :param repo_name: the name of the repository. Eg, 'react'
+    :param repos_dir: the directory that the repository is checked out into
+    :return: the path of the working tree (str)
+    """
+    return os.path.join(repos_dir, repo_owner, repo_name)
+
+
+def check_local_repo_exists(repo_owner, repo_name, repos_dir=REPOS_DIR):
     """
-    Checks if the local repository has already been cloned from github
+    Checks if the local repository has already been checked out
+    :param repo_owner: the owner of the repository. Eg, 'facebook'
     :param repo_name: the name of the repository. Eg, 'react'
+    :param repos_dir: the directory that the repository is checked out into
     :return: True if it exists, False otherwise
     """
-    path = os.path.join(REPOS_DIR, repo_name)
+    path = get_local_repo_path(repo_owner, repo_name, repos_dir)
     if os.path.exists(path):
         if os.path.isdir(path):
             # check that directory is a git repository
@@ -266,7 +312,7 @@ def check_remote_repo_exists(repo_owner, repo_name):
     :return: a tuple. first item: boolean of whether the repository exists on github.com, second item: the data object
     returned from the github API
     """
-    response = requests.get(f"https://api.github.com/repos/{repo_owner}/{repo_name}", auth=('user', ACCESS_TOKEN))
+    response = cached_get(f"https://api.github.com/repos/{repo_owner}/{repo_name}", auth=github_auth())
     r = response.json()
     if response.status_code != 200:
         if response.status_code == 404:
@@ -285,30 +331,91 @@ def is_valid_repo_name(repo_str):
     return bool(re.fullmatch(repo_url_pattern, repo_str))
 
 
-def clone_repo(repo_owner, repo_name, logger, print_progress=True):
+def get_remote_url(repo_owner, repo_name):
     """
-    Clones a github repository locally
-    :param print_progress: True for printing cloning progress to the console, False for no printing
+    Gets the url to clone a repository from
+    :param repo_owner: the owner of the repository. Eg, 'facebook'
     :param repo_name: the name of the repository. Eg, 'react'
+    :return: the remote url (str)
+    """
+    return REMOTE_URL_TEMPLATE.format(owner=repo_owner, name=repo_name)
+
+
+def mirror_repo(repo_owner, repo_name, logger, print_progress=True, cache_dir=MIRRORS_DIR, default_branch=None,
+                blobless=BLOBLESS_CLONES):
+    """
+    Brings the cached bare mirror of a github repository up to date. The mirror holds the full commit history, so the
+    stages that only read commit metadata can use it directly without a working tree.
     :param repo_owner: the owner of the repository. Eg, 'facebook'
+    :param repo_name: the name of the repository. Eg, 'react'
     :param logger: The logger object to use for logging information
-    :return: repo: the Repo type from gitPython
+    :param print_progress: True for printing cloning progress to the console, False for no printing
+    :param cache_dir: the directory containing the mirror cache
+    :param default_branch: the default branch of the repository (optional)
+    :param blobless: True to create new mirrors as blobless partial clones (file contents are fetched on checkout)
+    :return: the bare Repo type from gitPython for the mirror
     """
-    remote_url = f"https://github.com/{repo_owner}/{repo_name}.git"
-    repo_path = os.path.join(REPOS_DIR, repo_name)
-    repo = git.Repo.clone_from(remote_url, repo_path, progress=Progress(logger) if print_progress else None)
+    mirror_path = get_mirror_path(repo_owner, repo_name, cache_dir)
+    mirror = update_mirror(get_remote_url(repo_owner, repo_name), mirror_path, logger, default_branch=default_branch,
+                           progress=Progress(logger) if print_progress else None, blobless=blobless)
+    evict_mirrors(logger, cache_dir)
+    return mirror
 
-    return repo
+
+def checkout_repo(repo_owner, repo_name, mirror, logger, repos_dir=REPOS_DIR):
+    """
+    Creates a working tree of a repository from its mirror. For blobless mirrors this is when the file contents of the
+    checked out commit are downloaded.
+    :param repo_owner: the owner of the repository. Eg, 'facebook'
+    :param repo_name: the name of the repository. Eg, 'react'
+    :param mirror: the bare Repo type from gitPython for the mirror (see mirror_repo)
+    :param logger: The logger object to use for logging information
+    :param repos_dir: the directory to create the working tree in
+    :return: repo: the Repo type from gitPython for the working tree
+    """
+    repo_path = get_local_repo_path(repo_owner, repo_name, repos_dir)
+
+    # a working tree left over from a failed run is replaced by a fresh one
+    if check_local_repo_exists(repo_owner, repo_name, repos_dir):
+        logger.info("removing working tree left over from a previous run")
+    remove_worktree(mirror.git_dir, repo_path)
+
+    return add_worktree(mirror, repo_path)
+
+
+def clone_repo(repo_owner, repo_name, logger, print_progress=True, repos_dir=REPOS_DIR, cache_dir=MIRRORS_DIR,
+               default_branch=None, blobless=BLOBLESS_CLONES):
+    """
+    Checks out a github repository locally. The repository is kept as a bare mirror in a persistent cache so that only
+    new objects need to be fetched on later runs, and a working tree for the mirror is created in the repos_dir.
+    :param print_progress: True for printing cloning progress to the console, False for no printing
+    :param repo_name: the name of the repository. Eg, 'react'
+    :param repo_owner: the owner of the repository. Eg, 'facebook'
+    :param logger: The logger object to use for logging information
+    :param repos_dir: the directory to create the working tree in
+    :param cache_dir: the directory containing the mirror cache
+    :param default_branch: the default branch of the repository (optional)
+    :param blobless: True to create new mirrors as blobless partial clones (file contents are fetched on checkout)
+    :return: repo: the Repo type from gitPython for the working tree
+    """
+    mirror = mirror_repo(repo_owner, repo_name, logger, print_progress=print_progress, cache_dir=cache_dir,
+                         default_branch=default_branch, blobless=blobless)
+    return checkout_repo(repo_owner, repo_name, mirror, logger, repos_dir=repos_dir)
 
 
-def clean_up_repo(repo_name):
+def clean_up_repo(repo_owner, repo_name, repos_dir=REPOS_DIR, cache_dir=MIRRORS_DIR):
     """
-    Removes a local repository that has been cloned by the pipeline
+    Removes the local working tree that has been created by the pipeline. The mirror stays in the cache for the next
+    run.
+    :param repo_owner: the owner of the repository. Eg, 'facebook'
     :param repo_name: the name of the repository. Eg, 'react'
+    :param repos_dir: the directory that the working tree was created in
+    :param cache_dir: the directory containing the mirror cache
     :return: None
     """
-    if check_local_repo_exists(repo_name):
-        git.rmtree(os.path.join(REPOS_DIR, repo_name))
+    mirror_path = get_mirror_path(repo_owner, repo_name, cache_dir)
+    remove_worktree(mirror_path, get_local_repo_path(repo_owner, repo_name, repos_dir))
+    release_mirror(mirror_path)
 
 
 def push_release_to_mongodb(repo_owner, repo_name, tag, tag_data, client):
@@ -318,7 +425,7 @@ def push_release_to_mongodb(repo_owner, repo_name, tag, tag_data, client):
     :param client: the MongoDB client
     :param repo_owner: the owner of the repository. Eg, 'facebook'
     :param repo_name: the name of the repository. Eg, 'react'
-    :param tag: the gitPython 'Tag' type
+    :param tag: the TagInfo for the tag (see get_sorted_tags)
     :param tag_data: the data to be stored for the tag
     :return: None
     """
@@ -333,7 +440,7 @@ def push_release_to_mongodb(repo_owner, repo_name, tag, tag_data, client):
         "name": repo_name,
         "owner": repo_owner,
         "tag_name": tag.name,
-        "committed_date": tag.commit.committed_datetime,
+        "committed_date": tag.committed_datetime,
         "LOC": tag_data,
     }
     release_collection.update_one(search_dict, {'$set': data_to_insert}, upsert=True)
@@ -342,14 +449,15 @@ def push_release_to_mongodb(repo_owner, repo_name, tag, tag_data, client):
 def get_repository_metadata(repo_owner, repo_name):
     """
     Retrieves repository metadata from the Github REST API. Data includes general metadata, repository language stats,
-    and repository topics (if available).
+    and repository topics (if available). The responses are cached on disk and revalidated with conditional requests,
+    which do not count against the rate limit when nothing has changed.
     :param repo_owner: the owner of the repository. Eg, 'facebook'
     :param repo_name: the name of the repository. Eg, 'react'
     :return: a dictionary containing the available data that could be retrieved
     """
     data = {}
 
-    response = requests.get(f"https://api.github.com/repos/{repo_owner}/{repo_name}", auth=('user', ACCESS_TOKEN))
+    response = cached_get(f"https://api.github.com/repos/{repo_owner}/{repo_name}", auth=github_auth())
     r = response.json()
 
     if response.status_code != 200:
@@ -366,19 +474,14 @@ def get_repository_metadata(repo_owner, repo_name):
     if 'organization' in r:
         data["organization_obj"] = dict(zip(owner_keys, [r["organization"][key] for key in owner_keys]))
 
-    keys = ["description", "forks", "forks_count", "language", "stargazers_count", "watchers_count", "watchers", "size",
-            "default_branch", "open_issues_count", "open_issues", "topics", "has_issues", "archived", "disabled",
-            "visibility", "pushed_at", "created_at", "updated_at", "html_url", "fork", "homepage", "has_projects",
-            "has_downloads", "has_wiki", "has_pages", "license", "subscribers_count"]
-    for key in keys:
+    for key in REPOSITORY_METADATA_KEYS:
         try:
             data[key] = r[key]
         except KeyError:
             pass
 
     # get the repository languages
-    response = requests.get(f"https://api.github.com/repos/{repo_owner}/{repo_name}/languages",
-                            auth=('user', ACCESS_TOKEN))
+    response = cached_get(f"https://api.github.com/repos/{repo_owner}/{repo_name}/languages", auth=github_auth())
     data["languages"] = response.json()
 
     if response.status_code != 200:
@@ -386,8 +489,8 @@ def get_repository_metadata(repo_owner, repo_name):
 
     # get the topics for the repository
     headers_for_topics = {'Accept': 'application/vnd.github.mercy-preview+json'}
-    response = requests.get(f"https://api.github.com/repos/{repo_owner}/{repo_name}/topics", headers=headers_for_topics,
-                            auth=('user', ACCESS_TOKEN))
+    response = cached_get(f"https://api.github.com/repos/{repo_owner}/{repo_name}/topics", headers=headers_for_topics,
+                          auth=github_auth())
 
     if response.status_code != 200:
         raise HTTPError(response.status_code)
@@ -415,14 +518,17 @@ def push_repository_to_mongodb(repo_owner, repo_name, data, client):
     repo_collection.update_one(search_dict, {'$set': data}, upsert=True)
 
 
-def call_cloc(repo_path, include_header=False):
+def call_cloc(repo_path, include_header=False, vcs="git"):
     """
     Calls CLOC for a local git repository. Information about CLOC can be found here: https://github.com/AlDanial/cloc
     :param repo_path: the path to the local git repository
     :param include_header: whether to include the header information in the output
+    :param vcs: the version control system cloc uses to list the files to count, or None to count every file in the
+    directory (eg. a tree extracted with extract_revision)
     :return: The output of the 'cloc' tool in a dictionary format
     """
-    p = subprocess.run(f"cloc . --vcs=git --json", cwd=repo_path, capture_output=True, shell=True)
+    vcs_option = f" --vcs={vcs}" if vcs else ""
+    p = subprocess.run(f"cloc .{vcs_option} --json", cwd=repo_path, capture_output=True, shell=True)
     if p.returncode != 0:
         raise SystemError(p.stderr)
 
@@ -432,97 +538,123 @@ def call_cloc(repo_path, include_header=False):
     return tag_data
 
 
-def get_commits_per_author(repo):
+def extract_revision(repo_path, revision, destination, index_file):
     """
-    Gets a tally of the number of commits all time and in the last 30 days for each author and returns a dictionary
-    structure containing the data
-    :param repo: the Repo type from gitPython
+    Writes the files of a revision into a directory without checking it out. The tree is read into a temporary index
+    file and written out with 'git checkout-index', so the HEAD, index and working tree of the repository are never
+    touched and other stages can keep using it. With a blobless mirror the missing file contents are downloaded with a
+    single request first.
+    :param repo_path: the path of the git repository (a working tree or a bare mirror)
+    :param revision: the commit to extract, eg. a tag's commit sha
+    :param destination: the directory to write the files to
+    :param index_file: the path of the temporary index file, which must not be inside destination
+    :return: None
+    """
+    prefetch_blobs(repo_path, get_missing_objects(repo_path, revision))
+    env = {**os.environ, "GIT_INDEX_FILE": index_file}
+    os.makedirs(destination, exist_ok=True)
+    commands = [
+        ["git", "-C", repo_path, "read-tree", f"{revision}^{{tree}}"],
+        ["git", "-C", repo_path, f"--work-tree={destination}", "checkout-index", "--all", "--force"],
+    ]
+    for command in commands:
+        p = subprocess.run(command, env=env, capture_output=True)
+        if p.returncode != 0:
+            raise SystemError(p.stderr)
+
+
+def count_revision_loc(repo_path, revision, tmp_dir=LOC_TMP_DIR):
+    """
+    Counts the LOC of a revision by extracting its files into a temporary directory and running cloc on them
+    :param repo_path: the path of the git repository (a working tree or a bare mirror)
+    :param revision: the commit to count, eg. a tag's commit sha
+    :param tmp_dir: the directory to create the temporary directory in (None for the system's temporary directory)
+    :return: The output of the 'cloc' tool in a dictionary format
+    """
+    with tempfile.TemporaryDirectory(prefix="loc-", dir=tmp_dir) as temp_dir:
+        tree_dir = os.path.join(temp_dir, "tree")
+        extract_revision(repo_path, revision, tree_dir, os.path.join(temp_dir, "index"))
+        return call_cloc(tree_dir, vcs=None)
+
+
+def count_tags_loc(repo_path, tags, max_workers=LOC_WORKERS, tmp_dir=LOC_TMP_DIR, use_cache=LOC_CACHE):
+    """
+    Counts the LOC of several tags at the same time. Every tag is counted by its own cloc process (on its own temporary
+    directory), so a thread pool is enough to keep one core busy per worker.
+    :param repo_path: the path of the git repository (a working tree or a bare mirror)
+    :param tags: a list of TagInfo tuples
+    :param max_workers: the maximum number of tags counted at the same time
+    :param tmp_dir: the directory to create the temporary directories in (None for the system's temporary directory)
+    :param use_cache: whether to count the tags with the per-blob LOC cache (see count_revision_loc_cached) instead of
+    counting every file of every tag
+    :return: a generator of (tag, cloc output) tuples in the order of the tags. The tags that have not started yet are
+    cancelled if the generator is closed or a tag fails
+    """
+    count = partial(count_revision_loc_cached if use_cache else count_revision_loc, tmp_dir=tmp_dir)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tags))), thread_name_prefix="cloc")
+    try:
+        futures = [executor.submit(count, repo_path, tag.commit_sha) for tag in tags]
+        for tag, future in zip(tags, futures):
+            yield tag, future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def get_commits_per_author(commit_index, windows=DEFAULT_WINDOWS):
+    """
+    Gets a tally of the number of commits all time and in rolling windows (the last 30 days by default) for each author
+    and returns a dictionary structure containing the data
+    :param commit_index: the CommitIndex for the repository (see build_commit_index)
+    :param windows: the names of the rolling windows to create leaderboards for (keys of COMMIT_WINDOWS)
     :return: a dictionary with the commit data
     """
-    data = {}
-    all_time_total = 0
-    last_30_days_total = 0
-    commit_set = set()
-    for ref in repo.references:
-        for commit in repo.iter_commits(ref.name):
-            # if the commit has already been counted for another branch, ignore it
-            if commit.hexsha in commit_set:
-                continue
-            commit_set.add(commit.hexsha)
-            if commit.author.name in data.keys():
-                data[commit.author.name]["all_time"] += 1
-                all_time_total += 1
-            else:
-                data[commit.author.name] = {
-                    "name": commit.author.name,
-                    "all_time": 1,
-                    "last_30_days": 0
-                }
-                all_time_total += 1
-            # check if the commit was in the most recent 30 days
-            if (datetime.datetime.now(datetime.timezone.utc) - commit.committed_datetime) < datetime.timedelta(
-                    days=30):
-                data[commit.author.name]["last_30_days"] += 1
-                last_30_days_total += 1
-
-    # sort authors by number of commits
-    all_time_list = sorted(data.values(), key=lambda x: x["all_time"], reverse=True)
-    last_30_days_list = sorted(data.values(), key=lambda x: x["last_30_days"], reverse=True)
-    MAX_AUTHORS = 25
-    return {
-        "all_time": {
-            "top_25": all_time_list[:min(MAX_AUTHORS, len(all_time_list))],
-            "total": all_time_total
-        },
-        "last_30_days": {
-            "top_25": last_30_days_list[:min(MAX_AUTHORS, len(last_30_days_list))],
-            "total": last_30_days_total
-        }
-    }
+    author_counts, _ = count_commits(commit_index)
+    return format_commits_per_author(author_counts, commit_index, windows=windows)
 
 
-def get_monthly_commit_data(repo):
+def get_monthly_commit_data(commit_index):
     """
     Gets the total number of commits for each month of a repo and gets total number of contributors per month,
     and returns a dictionary structure containing the data
-    :param repo: The Repo type from gitPython
+    :param commit_index: the CommitIndex for the repository (see build_commit_index)
     :return: a dictionary with monthly commit and contributor data
     """
-    data = {}
-    commit_set = set()
-    all_time_total = 0
-    for ref in repo.references:
-
-        for commit in repo.iter_commits(ref.name):
-            # if the commit has already been counted for another branch, ignore it
-            if commit.hexsha in commit_set:
-                continue
-            commit_set.add(commit.hexsha)
-            # print(commit.hexsha)
-
-            commit_date = commit.committed_datetime.strftime('%Y-%m')
-            if commit_date in data.keys():
-                data[commit_date]["commits"] += 1
-                all_time_total += 1
-            else:  # For the first commit of a month
-                data[commit_date] = {
-                    "month": commit_date,
-                    "commits": 1,
-                    "contributor_count": 1,
-                    "contributor_name": {commit.author.name}
-                }
-            # If the contributor name is unique:
-            if commit.author.name not in data[commit_date]["contributor_name"]:
-                data[commit_date]["contributor_count"] += 1
-                data[commit_date]["contributor_name"].add(commit.author.name)
-
-    monthly_data_list = sorted(data.values(), key=lambda x: x["month"], reverse=True)  # list of dictionary of set
-    for i, _ in enumerate(monthly_data_list):
-        monthly_data_list[i].pop("contributor_name")
-
-    return {
-        "month_data": monthly_data_list
-    }
+    return format_commits_per_month(count_commits_per_period(commit_index, "month"))
+
+
+class TagInfo(NamedTuple):
+    """
+    The information about a git tag that the pipeline needs. Unlike gitPython's TagReference it is read for all tags in
+    one 'git for-each-ref' call instead of resolving each tag object separately.
+    """
+    name: str
+    commit_sha: str
+    committed_datetime: datetime.datetime
+
+
+def get_sorted_tags(repo):
+    """
+    Lists the tags of a repository that point to a commit, sorted by the date of that commit. The commit dates come
+    straight from 'git for-each-ref', so no tag or commit objects have to be resolved one by one.
+    :param repo: the Repo type from gitPython
+    :return: a list of TagInfo objects sorted from the oldest to the newest commit date
+    """
+    tag_format = "%(refname:strip=2)%09%(objecttype)%09%(objectname)%09%(committerdate:iso-strict)%09" \
+                 "%(*objecttype)%09%(*objectname)%09%(*committerdate:iso-strict)"
+    output = repo.git.for_each_ref("refs/tags", format=tag_format)
+
+    tags = []
+    for line in output.splitlines():
+        name, object_type, sha, date, peeled_type, peeled_sha, peeled_date = line.split("\t")
+        # annotated tags are peeled to the commit they point to
+        if object_type == "tag":
+            object_type, sha, date = peeled_type, peeled_sha, peeled_date
+        # tags can also point to trees or blobs, which have no commit date and no source to count
+        if object_type != "commit" or not date:
+            continue
+        tags.append(TagInfo(name, sha, datetime.datetime.fromisoformat(date.replace("Z", "+00:00"))))
+
+    return sorted(tags, key=lambda t: t.committed_datetime)
 
 
 def reduce_releases(releases, max_releases=15):
@@ -570,22 +702,27 @@ def get_current_repo_names(mongo_client=None):
         yield f"{repo['owner']}/{repo['name']}"
 
 
-def process_repository(repo_str, start_datetime):
+def process_repository(repo_str, start_datetime, repos_dir=REPOS_DIR, metadata=None):
     """
     Processes the repository by doing the following:
         - validate the repository input
-        - clone the repository (if not currently in the 'tmp' folder
+        - fetch the repository into the mirror cache and check it out into the 'tmp' folder
         - retrieve a list of tags/releases for the repository
         - iterate through the tags/releases
         - calculate the LOC data for each tag/release by using a command line tool called 'cloc'
         - push the data to mongodb
+    The steps are run as a graph of stages (see stages.py) so that steps which do not depend on each other, such as
+    fetching issues from github and cloning the repository, run at the same time.
     :param repo_str: concatenation of the repository owner and name separated by a '/'. Eg, 'facebook/react'
     :param start_datetime: the date that the pipeline run began
-    :return: None
+    :param repos_dir: the directory to clone the repository into. Worker processes each use their own directory
+    :param metadata: the repository metadata if it was already retrieved, eg. by the GraphQL prefetch of a batch run
+    (optional, retrieved from the REST API otherwise)
+    :return: True if the repository was processed without any exceptions being logged, False otherwise
     """
     if not is_valid_repo_name(repo_str):
         tqdm.write("Invalid repository name!")
-        return
+        return False
 
     repo_owner, repo_name = repo_str.split("/")
 
@@ -593,47 +730,100 @@ def process_repository(repo_str, start_datetime):
 
     logger.info(f"Running pipeline process for repository: {repo_str}")
 
-    try:
-        # get repository metadata from the github API
-        logger.info("Retrieving repository metadata from the Github REST API")
-        try:
-            data = get_repository_metadata(repo_owner, repo_name)
-            data["last_pipeline_run_at"] = datetime.datetime.now()
-        except RemoteRepoNotFoundError as e:
-            logger.exception(str(e))
-            return
-
-        repo_path = os.path.join(REPOS_DIR, repo_name)
+    repo_path = get_local_repo_path(repo_owner, repo_name, repos_dir)
+    mirror_path = get_mirror_path(repo_owner, repo_name)
 
-        # check if repository is already cloned locally
-        if check_local_repo_exists(repo_name):
-            logger.info("using cached repository")
-            repo = git.Repo(repo_path)
+    def get_metadata(results):
+        # get repository metadata from the github API
+        if metadata is not None:
+            logger.info("Using the repository metadata retrieved from the Github GraphQL API")
+            data = dict(metadata)
         else:
-            logger.info("cloning repository...")
-            repo = clone_repo(repo_owner, repo_name, logger)
+            logger.info("Retrieving repository metadata from the Github REST API")
+            data = get_repository_metadata(repo_owner, repo_name)
+        data["last_pipeline_run_at"] = datetime.datetime.now()
+        return data
 
-        # get the mongoDB client
+    def connect_to_mongodb(results):
         logger.info("connecting to mongodb")
         mongo_client = MongoClient(CONNECTION_STRING, ssl_cert_reqs=ssl.CERT_NONE)
-
-        logger.info("calculating commits per author data")
-        data['commits_per_author'] = get_commits_per_author(repo)
-
-        logger.info("calculating commits per month")
-        data['commits_per_month'] = get_monthly_commit_data(repo)
-
+        ensure_indexes(mongo_client, logger)
+        return mongo_client
+
+    # the git repositories opened by the stages, which are closed once the repository has been processed
+    opened_repos = []
+
+    def get_mirror(results):
+        logger.info("updating the cached mirror...")
+        mirror = mirror_repo(repo_owner, repo_name, logger, default_branch=results["metadata"].get("default_branch"))
+        opened_repos.append(mirror)
+        return mirror
+
+    def get_local_repository(results):
+        logger.info("checking out the repository...")
+        repo = checkout_repo(repo_owner, repo_name, results["mirror"], logger, repos_dir=repos_dir)
+        opened_repos.append(repo)
+        return repo
+
+    def index_commits(results):
+        # the history is read straight from the mirror, which does not need any file contents. Only the commits in the
+        # heatmap window are indexed, the all time statistics are kept up to date incrementally
+        logger.info("indexing the recent commit history")
+        num_weeks = HEATMAP_DIMENSIONS[0] * HEATMAP_DIMENSIONS[1]
+        commit_index = build_commit_index(mirror_path, ("--all", f"--since={num_weeks + 1}.weeks.ago"))
+        logger.info(f"There were {len(commit_index)} commits found in the last {num_weeks} weeks")
+        return commit_index
+
+    def calculate_commit_statistics(results):
+        logger.info("updating the commit statistics")
+        return update_commit_statistics(repo_owner, repo_name, mirror_path, results["mongodb"], logger,
+                                        recent_commits=results["commit_index"])
+
+    def fetch_issues_and_pull_requests(results):
+        heatmap_start = get_heatmap_weeks(HEATMAP_DIMENSIONS[0] * HEATMAP_DIMENSIONS[1])[0][0]
+        if choose_heatmap_source(repo_owner, repo_name, results["mongodb"], heatmap_start, logger) == "counts":
+            # the heatmap stage asks github search for the weekly counts instead
+            logger.info("Using github search counts for the heatmap instead of retrieving issues and pull requests")
+            return None
+        logger.info("Retrieving issues and pull requests for the heatmap")
+        return fetch_github_items(repo_owner, repo_name, results["mongodb"], logger)
+
+    def generate_heatmap(results):
         logger.info("Generating heatmap data")
-        heatmap_data = generate_heatmap_data(repo_owner, repo_name, repo, mongo_client, logger)
+        github_items = results["github_items"]
+        activity_histograms = None
+        if github_items is None:
+            try:
+                events = SearchCountIndex(repo_owner, repo_name, results["commit_index"])
+                heatmap_data, heatmap_state = update_heatmap_search_counts(repo_owner, repo_name, events,
+                                                                           results["mongodb"], logger)
+            except (HTTPError, GraphQLError) as e:
+                logger.warning(f"github search counts failed, retrieving issues and pull requests instead: {e!r}")
+                github_items = fetch_github_items(repo_owner, repo_name, results["mongodb"], logger)
+
+        if github_items is not None:
+            # the daily, weekly and monthly activity histograms are updated together with the heatmap
+            heatmap_data, activity_histograms, heatmap_state = update_heatmap_data(
+                repo_owner, repo_name, github_items, results["commit_index"], results["mongodb"], logger)
 
         logger.info("Pushing heatmap data to mongodb")
-        push_heatmap_data_to_mongodb(repo_owner, repo_name, heatmap_data, mongo_client)
-
-        # get the tags from the repository
-        tags = sorted(repo.tags, key=lambda t: t.commit.committed_datetime)
+        # the histograms cannot be counted from the search counts, so the old ones are removed rather than left stale
+        push_heatmap_data_to_mongodb(repo_owner, repo_name, heatmap_data, results["mongodb"], heatmap_state,
+                                     activity_histograms, clear_activity_histograms=activity_histograms is None)
+
+    def find_tags(results):
+        # get the tags from the repository. Only the tags selected by reduce_releases are ever checked out, so with a
+        # blobless mirror only the file contents of those tags are downloaded
+        tags = get_sorted_tags(results["mirror"])
         logger.info(f"There were {len(tags)} tags found in the repository")
+        return tags
+
+    def push_repository_data(results):
+        data = results["metadata"]
+        data.update(results["commit_statistics"])
 
         # adding some tag related information to the repository metadata
+        tags = results["tags"]
         data["num_tags"] = len(tags)
         if len(tags) > 0:
             data["latest_tag"] = tags[-1].name
@@ -642,49 +832,90 @@ def process_repository(repo_str, start_datetime):
 
         # push the repository data to mongoDB
         logger.info("Pushing repository data to mongoDB")
-        push_repository_to_mongodb(repo_owner, repo_name, data, mongo_client)
+        push_repository_to_mongodb(repo_owner, repo_name, data, results["mongodb"])
 
+    def count_tag_loc(results):
         # reducing the number of tags
-        tags = reduce_releases(tags, max_releases=30)
+        tags = reduce_releases(list(results["tags"]), max_releases=30)
         logger.info(f"number of tags reduced to: {len(tags)}")
 
-        g = git.Git(repo_path)  # initialise git in order to checkout each tag
-        tag_loop = tqdm(tags, desc="calculating LOC for each tag")  # tqdm object for displaying the progress bar
+        logger.info(f"counting LOC for {len(tags)} tags with up to {LOC_WORKERS} workers")
+        # the tags' files are extracted from the mirror into temporary directories and counted with the 'cloc' command
+        # line tool, several tags at a time. The results arrive in tag order
+        tag_counts = count_tags_loc(mirror_path, tags, max_workers=LOC_WORKERS)
+        tag_loop = tqdm(tag_counts, total=len(tags), desc="calculating LOC for each tag")
 
         try:
-            for tag in tag_loop:
-                tag_name = tag.name
-                tag_loop.set_description(f"processing tag: {tag}")
+            for tag, tag_data in tag_loop:
+                tag_loop.set_description(f"processed tag: {tag.name}")
                 tag_loop.refresh()
 
-                logger.info(f"checking out tag: {tag}")
-                g.checkout(tag_name, force=True)
-
-                logger.info(f"counting LOC for tag: {tag}")
-                # calling the 'cloc' command line tool to count LOC statistics for the repository
-                tag_data = call_cloc(repo_path)  # this data can possibly be used later on
-
-                logger.info("pushing to mongodb...")
-                push_release_to_mongodb(repo_owner, repo_name, tag, tag_data, mongo_client)
+                logger.info(f"pushing the LOC of tag {tag.name} to mongodb...")
+                push_release_to_mongodb(repo_owner, repo_name, tag, tag_data, results["mongodb"])
         except Exception as err:
             logger.exception(err)
+        finally:
+            tag_counts.close()  # cancels the tags that have not been counted yet
 
+    def limit_languages(results):
         logger.info("Updating the LOC data to limit the number of languages")
-        limit_languages_for_repository(repo_owner, repo_name, mongo_client)
+        limit_languages_for_repository(repo_owner, repo_name, results["mongodb"])
 
+    def collect_sca_data(results):
         try:
+            # the scan runs on the working tree, checked out at the latest tag
+            tags = results["tags"]
+            if tags:
+                logger.info(f"checking out the latest tag: {tags[-1].name}")
+                results["clone"].git.checkout(tags[-1].commit_sha, force=True)
             logger.info("Collecting SCA data")
-            collect_scantist_sca_data(REPOS_DIR, repo_path, repo_owner, repo_name, mongo_client, logger)
+            collect_scantist_sca_data(repos_dir, repo_path, repo_owner, repo_name, results["mongodb"], logger)
         except Exception as err:
             logger.exception(err)
 
+    def generate_colours(results):
         logger.info("Generating dynamic colours for the repository")
-        generate_repository_colours(repo_owner, repo_name, mongo_client)
+        generate_repository_colours(repo_owner, repo_name, results["mongodb"])
+
+    stages = [
+        Stage("metadata", get_metadata),
+        Stage("mongodb", connect_to_mongodb),
+        Stage("mirror", get_mirror, requires=["metadata"]),
+        Stage("clone", get_local_repository, requires=["mirror"]),
+        Stage("github_items", fetch_issues_and_pull_requests, requires=["metadata", "mongodb"]),
+        Stage("commit_index", index_commits, requires=["mirror"]),
+        Stage("commit_statistics", calculate_commit_statistics, requires=["mirror", "mongodb", "commit_index"]),
+        Stage("heatmap", generate_heatmap, requires=["github_items", "commit_index", "mongodb"]),
+        Stage("tags", find_tags, requires=["mirror"]),
+        Stage("repository", push_repository_data, requires=["metadata", "commit_statistics", "tags", "mongodb"]),
+        # the LOC stage reads the tags straight from the mirror, so SCA can scan the working tree at the same time
+        Stage("tag_loc", count_tag_loc, requires=["tags", "mirror", "mongodb"]),
+        Stage("limit_languages", limit_languages, requires=["tag_loc"]),
+        Stage("sca", collect_sca_data, requires=["clone", "tags", "mongodb"]),
+        Stage("colours", generate_colours, requires=["limit_languages", "sca", "repository"]),
+    ]
 
-        repo.close()
-        time.sleep(2)  # to wait for the previous git related processes to release the repository
-        logger.info("deleting local repository...")
-        clean_up_repo(repo_name)
+    try:
+        run_stages(stages, logger, max_workers=STAGE_WORKERS)
+
+        gauges = get_token_manager().gauges()
+        budgets = ", ".join(f"{token['token']}: {token['remaining']}" for token in gauges["tokens"])
+        logger.info(f"github token budget remaining: {gauges['total_remaining']} ({budgets})")
 
     except Exception as e:
         logger.exception(str(e))
+
+    finally:
+        # the working tree and the in use marker of the mirror are removed even when a stage failed, so the mirror
+        # does not stay protected from eviction
+        try:
+            for repo in opened_repos:
+                repo.close()
+            if opened_repos:
+                time.sleep(2)  # to wait for the previous git related processes to release the repository
+            logger.info("deleting local working tree...")
+            clean_up_repo(repo_owner, repo_name, repos_dir)
+        except Exception as e:
+            logger.exception(str(e))
+
+    return not logger.exception_has_occurred
@@ -0,0 +1,286 @@
+import os
+import shutil
+import subprocess
+import time
+
+import git
+from dotenv import load_dotenv
+
+load_dotenv()
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+MIRRORS_DIR = os.path.join(CURRENT_DIR, "mirrors")
+
+# the disk space that the mirror cache may use before the least recently used mirrors are evicted
+MIRROR_CACHE_QUOTA = int(float(os.environ.get("MIRROR_CACHE_QUOTA_GB", "50")) * 1024 ** 3)
+
+# only branches and tags are mirrored. A plain '--mirror' clone would also fetch github's refs/pull/* references which
+# would add unmerged pull request commits to the commit statistics
+MIRROR_REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+
+# new mirrors are created as blobless partial clones. They hold every commit and tree but file contents are only
+# downloaded for the commits that are actually checked out (tag LOC counting and SCA)
+BLOBLESS_CLONES = os.environ.get("BLOBLESS_CLONES", "true").lower() not in ("0", "false", "no")
+
+LAST_USED_FILE = "pipeline-last-used"
+# every process using a mirror writes its own marker, '<IN_USE_FILE>-<pid>', so runs sharing a mirror do not remove
+# each other's marker
+IN_USE_FILE = "pipeline-in-use"
+# a mirror that has been marked as in use for longer than this is assumed to be left over from a crashed run
+IN_USE_TIMEOUT = 24 * 60 * 60
+
+
+def get_mirror_path(repo_owner, repo_name, cache_dir=MIRRORS_DIR):
+    """
+    Gets the path of the cached bare mirror for a repository. Mirrors are keyed by both owner and name so that forks
+    with the same name never share a mirror.
+    :param repo_owner: the owner of the repository. Eg, 'facebook'
+    :param repo_name: the name of the repository. Eg, 'react'
+    :param cache_dir: the directory containing the mirror cache
+    :return: the path of the mirror (str)
+    """
+    return os.path.join(cache_dir, repo_owner, f"{repo_name}.git")
+
+
+def is_mirror(mirror_path):
+    """
+    Checks if a directory contains a usable bare git repository
+    :param mirror_path: the path of the mirror
+    :return: True if it does, False otherwise
+    """
+    if not os.path.isdir(mirror_path):
+        return False
+    try:
+        return git.Repo(mirror_path).bare
+    except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError):
+        return False
+
+
+def update_mirror(remote_url, mirror_path, logger, default_branch=None, progress=None, blobless=BLOBLESS_CLONES):
+    """
+    Brings the bare mirror of a repository up to date. The first time a repository is seen it is cloned, after that
+    only the new objects are fetched.
+    :param remote_url: the url of the remote repository
+    :param mirror_path: the path of the mirror (see get_mirror_path)
+    :param logger: The logger object to use for logging information
+    :param default_branch: the default branch of the remote repository, used to keep the mirror's HEAD up to date
+    :param progress: a git.RemoteProgress object for showing the progress of the initial clone (optional)
+    :param blobless: True to create a new mirror as a blobless partial clone. An existing mirror keeps the mode it was
+    created with, since fetches reuse the filter stored in the mirror's config
+    :return: the bare Repo object from gitPython
+    """
+    if is_mirror(mirror_path):
+        logger.info("fetching new objects into the cached mirror")
+        mirror = git.Repo(mirror_path)
+        mirror.git.fetch("--prune", "origin")
+    else:
+        if os.path.exists(mirror_path):
+            logger.warning(f"removing invalid mirror at {mirror_path}")
+            shutil.rmtree(mirror_path, ignore_errors=True)
+        logger.info("cloning repository into the mirror cache")
+        os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+        clone_options = ["--filter=blob:none"] if blobless else []
+        mirror = git.Repo.clone_from(remote_url, mirror_path, bare=True, progress=progress,
+                                     multi_options=clone_options)
+        mirror.git.config("--unset-all", "remote.origin.fetch", with_exceptions=False)
+        for refspec in MIRROR_REFSPECS:
+            mirror.git.config("--add", "remote.origin.fetch", refspec)
+
+    if default_branch is not None:
+        mirror.git.symbolic_ref("HEAD", f"refs/heads/{default_branch}")
+
+    # the commit-graph file lets 'git rev-list' walk the history without parsing every commit object
+    mirror.git.commit_graph("write", "--reachable")
+
+    mark_mirror_used(mirror_path)
+    return mirror
+
+
+def get_in_use_file(mirror_path, pid=None):
+    """
+    Gets the path of the in use marker of a process
+    :param mirror_path: the path of the mirror
+    :param pid: the id of the process (optional, defaults to the current process)
+    :return: the path of the marker file
+    """
+    return os.path.join(mirror_path, f"{IN_USE_FILE}-{pid or os.getpid()}")
+
+
+def mark_mirror_used(mirror_path, pid=None):
+    """
+    Records that a mirror is being used right now. The last used time decides the eviction order and the in use
+    marker stops the mirror from being evicted while a pipeline process is still using it.
+    :param mirror_path: the path of the mirror
+    :param pid: the id of the process using the mirror (optional, defaults to the current process)
+    :return: None
+    """
+    for path in [os.path.join(mirror_path, LAST_USED_FILE), get_in_use_file(mirror_path, pid)]:
+        with open(path, 'w') as marker:
+            marker.write(str(pid or os.getpid()))
+
+
+def release_mirror(mirror_path, pid=None):
+    """
+    Removes the in use marker of a process from a mirror. The mirror can be evicted once no process has a marker on it
+    :param mirror_path: the path of the mirror
+    :param pid: the id of the process that used the mirror (optional, defaults to the current process)
+    :return: None
+    """
+    try:
+        os.remove(get_in_use_file(mirror_path, pid))
+    except FileNotFoundError:
+        pass
+
+
+def is_mirror_in_use(mirror_path, now=None):
+    """
+    Checks whether any process has marked a mirror as in use. Markers older than IN_USE_TIMEOUT are left over from a
+    crashed run and are ignored
+    :param mirror_path: the path of the mirror
+    :param now: the current unix time (optional)
+    :return: True if the mirror is in use
+    """
+    now = time.time() if now is None else now
+    for file_name in os.listdir(mirror_path):
+        if file_name.startswith(IN_USE_FILE):
+            try:
+                if now - os.path.getmtime(os.path.join(mirror_path, file_name)) < IN_USE_TIMEOUT:
+                    return True
+            except FileNotFoundError:
+                # released while the markers were being listed
+                continue
+    return False
+
+
+def get_directory_size(path):
+    """
+    Calculates the total size of the files in a directory
+    :param path: the path of the directory
+    :return: the size in bytes
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            try:
+                total += os.lstat(os.path.join(root, file_name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def list_mirrors(cache_dir=MIRRORS_DIR):
+    """
+    Lists the mirrors currently in the cache
+    :param cache_dir: the directory containing the mirror cache
+    :return: a list of dictionaries with the path, size, last used time and in use status of each mirror
+    """
+    mirrors = []
+    if not os.path.isdir(cache_dir):
+        return mirrors
+
+    now = time.time()
+    for owner in os.listdir(cache_dir):
+        owner_dir = os.path.join(cache_dir, owner)
+        if not os.path.isdir(owner_dir):
+            continue
+        for name in os.listdir(owner_dir):
+            mirror_path = os.path.join(owner_dir, name)
+            if not os.path.isdir(mirror_path):
+                continue
+            last_used_file = os.path.join(mirror_path, LAST_USED_FILE)
+            last_used = os.path.getmtime(last_used_file if os.path.exists(last_used_file) else mirror_path)
+            in_use = is_mirror_in_use(mirror_path, now)
+            mirrors.append({
+                "path": mirror_path,
+                "size": get_directory_size(mirror_path),
+                "last_used": last_used,
+                "in_use": in_use
+            })
+    return mirrors
+
+
+def evict_mirrors(logger, cache_dir=MIRRORS_DIR, quota=MIRROR_CACHE_QUOTA):
+    """
+    Removes the least recently used mirrors until the cache fits within the disk quota. Mirrors that are in use are
+    never removed.
+    :param logger: The logger object to use for logging information
+    :param cache_dir: the directory containing the mirror cache
+    :param quota: the maximum size of the cache in bytes
+    :return: a list of the paths of the mirrors that were removed
+    """
+    mirrors = list_mirrors(cache_dir)
+    total = sum(mirror["size"] for mirror in mirrors)
+    removed = []
+
+    for mirror in sorted(mirrors, key=lambda x: x["last_used"]):
+        if total <= quota:
+            break
+        if mirror["in_use"]:
+            continue
+        logger.info(f"evicting mirror {mirror['path']} ({mirror['size'] / 1024 ** 2:.1f} MB) from the cache")
+        shutil.rmtree(mirror["path"], ignore_errors=True)
+        total -= mirror["size"]
+        removed.append(mirror["path"])
+
+    return removed
+
+
+def add_worktree(mirror, worktree_path, commit="HEAD"):
+    """
+    Creates a working tree for a mirror. The working tree shares the object database of the mirror, so no objects are
+    copied.
+    :param mirror: the bare Repo object of the mirror
+    :param worktree_path: the path to create the working tree at
+    :param commit: the commit to check out in the working tree
+    :return: the Repo object from gitPython for the working tree
+    """
+    mirror.git.worktree("prune")
+    os.makedirs(os.path.dirname(worktree_path), exist_ok=True)
+    mirror.git.worktree("add", "--detach", "--force", worktree_path, commit)
+    return git.Repo(worktree_path)
+
+
+def remove_worktree(mirror_path, worktree_path):
+    """
+    Removes a working tree that was created by add_worktree
+    :param mirror_path: the path of the mirror
+    :param worktree_path: the path of the working tree
+    :return: None
+    """
+    if os.path.exists(worktree_path):
+        git.rmtree(worktree_path)
+    if is_mirror(mirror_path):
+        git.Repo(mirror_path).git.worktree("prune")
+
+
+def get_missing_objects(repo_path, revision):
+    """
+    Gets the objects of a revision that are not in the repository yet, which is the file contents that have not been
+    downloaded into a blobless mirror. Nothing is downloaded
+    :param repo_path: the path of the git repository (a working tree or a bare mirror)
+    :param revision: the commit to check, eg. a tag's commit sha
+    :return: a set of object shas
+    """
+    p = subprocess.run(["git", "-C", repo_path, "rev-list", "--objects", "--no-walk", "--missing=print", revision],
+                       capture_output=True)
+    if p.returncode != 0:
+        raise SystemError(p.stderr)
+    # the objects that are present are printed with their path, which does not have to be valid UTF-8
+    return {line[1:].decode("ascii") for line in p.stdout.splitlines() if line.startswith(b"?")}
+
+
+def prefetch_blobs(repo_path, shas):
+    """
+    Downloads file contents into a blobless mirror with a single request. Without this git downloads every missing
+    blob with its own request as it is read
+    :param repo_path: the path of the git repository
+    :param shas: the shas of the missing blobs
+    :return: None
+    """
+    if not shas:
+        return
+    # the same request that git sends itself when it fetches a missing object
+    p = subprocess.run(["git", "-C", repo_path, "-c", "fetch.negotiationAlgorithm=noop", "fetch", "origin", "--no-tags",
+                        "--no-write-fetch-head", "--recurse-submodules=no", "--filter=blob:none", "--stdin"],
+                       input="\n".join(sorted(shas)).encode("utf-8"), capture_output=True)
+    if p.returncode != 0:
+        raise SystemError(p.stderr)
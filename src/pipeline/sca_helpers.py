@@ -1,5 +1,5 @@
-import requests
 from .exceptions import HTTPError
+from .http_client import get_session
 import subprocess
 import json
 import os
@@ -25,7 +25,7 @@ def download_scantist_bom_detector(repos_dir, url="https://scripts.scantist.com/
     if os.path.exists(file_path):
         return False, file_path
 
-    r = requests.get(url)
+    r = get_session().get(url)
     if r.status_code != 200:
         raise HTTPError(r.status_code)
 
@@ -0,0 +1,101 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .exceptions import InvalidArgumentError
+
+
+class Stage:
+    """
+    A single step of the pipeline. A stage is a function that takes the results of the stages that have already run
+    (a dictionary of stage name -> return value) and returns its own result. A stage only starts once all of the stages
+    it requires have finished.
+    """
+    def __init__(self, name, func, requires=()):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, requires={self.requires!r})"
+
+
+def order_stages(stages):
+    """
+    Validates the dependencies between stages and returns them in an order where every stage comes after the stages
+    it requires (a topological order). The original order is kept wherever the dependencies allow it.
+    :param stages: a list of Stage objects
+    :return: a list of the same Stage objects in dependency order
+    """
+    by_name = {}
+    for stage in stages:
+        if stage.name in by_name:
+            raise InvalidArgumentError(f"Duplicate stage name: {stage.name}")
+        by_name[stage.name] = stage
+
+    for stage in stages:
+        for name in stage.requires:
+            if name not in by_name:
+                raise InvalidArgumentError(f"Stage '{stage.name}' requires unknown stage '{name}'")
+
+    ordered = []
+    done = set()
+    remaining = list(stages)
+    while remaining:
+        ready = [stage for stage in remaining if all(name in done for name in stage.requires)]
+        if not ready:
+            raise InvalidArgumentError(f"Stages contain a dependency cycle: {[s.name for s in remaining]}")
+        for stage in ready:
+            ordered.append(stage)
+            done.add(stage.name)
+            remaining.remove(stage)
+    return ordered
+
+
+def run_stages(stages, logger, max_workers=4):
+    """
+    Runs a set of stages on a pool of threads. A stage is started as soon as every stage it requires has finished, so
+    independent stages run at the same time and the total time is set by the longest chain of dependent stages. The
+    heavy lifting in the pipeline stages happens in subprocesses (git, cloc, java) and network requests, so threads
+    are enough to overlap them.
+
+    If a stage raises an exception no new stages are started, the stages that are already running are allowed to
+    finish, and the exception is re-raised.
+    :param stages: a list of Stage objects
+    :param logger: The logger object to use for logging information
+    :param max_workers: the maximum number of stages that can run at the same time
+    :return: a dictionary of stage name -> the value returned by that stage
+    """
+    pending = order_stages(stages)
+    results = {}
+    running = {}
+    error = None
+
+    def run(stage):
+        start = time.monotonic()
+        result = stage.func(results)
+        logger.info(f"stage '{stage.name}' finished in {time.monotonic() - start:.1f}s")
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage") as executor:
+        while pending or running:
+            if error is None:
+                for stage in [s for s in pending if all(name in results for name in s.requires)]:
+                    pending.remove(stage)
+                    running[executor.submit(run, stage)] = stage
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    results[stage.name] = future.result()
+                except Exception as e:
+                    if error is None:
+                        error = e
+
+    if error is not None:
+        raise error
+
+    return results
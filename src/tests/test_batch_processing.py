@@ -0,0 +1,62 @@
+import datetime
+import os
+
+from src.pipeline import batch
+
+
+def test_process_repository_batch_sequential(mocker):
+    process_mock = mocker.patch('src.pipeline.batch.process_repository', side_effect=[True, False])
+    prefetch_mock = mocker.patch('src.pipeline.batch.prefetch_repository_metadata',
+                                 return_value=({"a/b": {"name": "b"}}, [RuntimeError("boom")]))
+    results = batch.process_repository_batch(["a/b\n", "", "c/d"], datetime.datetime.now())
+
+    assert process_mock.call_count == 2
+    assert [r["repository"] for r in results] == ["a/b", "c/d"]
+    assert [r["success"] for r in results] == [True, False]
+
+    # the prefetched metadata is passed on, the other repository falls back to the REST API
+    prefetch_mock.assert_called_once_with(["a/b", "c/d"])
+    assert process_mock.call_args_list[0][1]["metadata"] == {"name": "b"}
+    assert process_mock.call_args_list[1][1]["metadata"] is None
+
+
+def test_process_repository_batch_failures_are_isolated(mocker):
+    process_mock = mocker.patch('src.pipeline.batch.process_repository',
+                                side_effect=[RuntimeError("boom"), True])
+    results = batch.process_repository_batch(["a/b", "c/d"], datetime.datetime.now(), prefetch=False)
+
+    assert process_mock.call_count == 2
+    assert [r["success"] for r in results] == [False, True]
+
+
+def test_process_repository_batch_process_pool(tmpdir):
+    # invalid repository names are rejected before any network access, so this only exercises the pool itself
+    results = batch.process_repository_batch(["invalid", "also invalid/"], datetime.datetime.now(), workers=2,
+                                             repos_dir=str(tmpdir))
+
+    assert [r["repository"] for r in results] == ["invalid", "also invalid/"]
+    assert not any(r["success"] for r in results)
+    assert sorted(os.listdir(tmpdir)) == ["worker-0", "worker-1"]
+
+
+def test_print_batch_summary(mocker):
+    write_mock = mocker.patch('src.pipeline.batch.tqdm.write')
+    results = [
+        {"repository": "a/b", "success": True, "duration": 1.0},
+        {"repository": "c/d", "success": False, "duration": 2.0},
+    ]
+    batch.print_batch_summary(results, datetime.datetime.now())
+
+    assert "2 repositories processed" in write_mock.call_args_list[0][0][0]
+    assert "1 succeeded, 1 failed" in write_mock.call_args_list[0][0][0]
+    assert "c/d" in write_mock.call_args_list[1][0][0]
+
+
+def test_init_worker_shares_the_loc_workers(tmpdir, mocker):
+    mocker.patch('src.pipeline.pipeline.LOC_WORKERS', 8)
+    mocker.patch('src.pipeline.batch._worker_repos_dir')
+    counter = mocker.MagicMock(value=0)
+    batch.init_worker(counter, str(tmpdir), num_workers=3)
+
+    assert batch.pipeline.LOC_WORKERS == 2
+    assert batch._worker_repos_dir == os.path.join(str(tmpdir), "worker-0")
@@ -0,0 +1,53 @@
+import datetime
+import os
+
+import git
+import pytest
+
+from src.pipeline import commit_index
+
+
+def create_repo(path, commits):
+    repo = git.Repo.init(path)
+    for index, (author, date) in enumerate(commits):
+        with open(os.path.join(path, "file.txt"), 'w') as f:
+            f.write(str(index))
+        repo.index.add(["file.txt"])
+        date = datetime.datetime.fromisoformat(date)
+        repo.index.commit(f"commit {index}", author=git.Actor(author, "a@a.com"),
+                          committer=git.Actor(author, "a@a.com"), author_date=date, commit_date=date)
+    return repo
+
+
+def test_build_commit_index(tmpdir):
+    repo = create_repo(os.path.join(tmpdir, "repo"), [
+        ("Stephen A", "2020-01-09T15:38:43+01:00"),
+        ("Stephen B", "2020-02-09T15:38:43-05:00"),
+        ("Stephen A", "2020-05-09T15:38:43+00:00"),
+    ])
+    # a second branch sharing the first commit is only walked once
+    branch = repo.create_head("branch", repo.head.commit.parents[0].parents[0])
+    repo.head.reference = branch
+    repo.head.reset(index=True, working_tree=True)
+    with open(os.path.join(tmpdir, "repo", "other.txt"), 'w') as f:
+        f.write("other")
+    repo.index.add(["other.txt"])
+    date = datetime.datetime.fromisoformat("2020-03-01T10:00:00+02:00")
+    branch_commit = repo.index.commit("branch commit", author=git.Actor("Stephen C", "c@c.com"), author_date=date,
+                                      commit_date=date)
+
+    index = commit_index.build_commit_index(str(repo.git_dir))
+
+    assert len(index) == 4
+    assert sorted(c.author for c in index) == ["Stephen A", "Stephen A", "Stephen B", "Stephen C"]
+    records = {c.hexsha: c for c in index}
+    assert records[branch_commit.hexsha].committed_datetime == date
+    assert records[branch_commit.hexsha].committed_datetime.utcoffset() == datetime.timedelta(hours=2)
+    for record in index:
+        assert record.committed_datetime == repo.commit(record.hexsha).committed_datetime
+    repo.close()
+
+
+def test_build_commit_index_error(tmpdir):
+    with pytest.raises(SystemError):
+        commit_index.build_commit_index(str(tmpdir))
@@ -0,0 +1,207 @@
+import datetime
+import os
+from typing import NamedTuple
+
+import git
+import pytest
+
+from src.pipeline import commit_statistics
+from src.pipeline.commit_index import CommitIndex, CommitRecord, build_commit_index
+from src.pipeline.exceptions import InvalidArgumentError
+from src.pipeline.pipeline import get_commits_per_author, get_monthly_commit_data
+
+
+class FakeCollection:
+    """
+    A minimal in-memory stand-in for the parts of a pymongo collection used by update_commit_statistics
+    """
+    def __init__(self):
+        self.docs = []
+        self.written_months = []
+
+    def _matches(self, doc, query):
+        for key, value in query.items():
+            if isinstance(value, dict) and "$in" in value:
+                if doc.get(key) not in value["$in"]:
+                    return False
+            elif doc.get(key) != value:
+                return False
+        return True
+
+    def find_one(self, query, projection=None):
+        return next(iter(self.find(query)), None)
+
+    def find(self, query, projection=None):
+        return [dict(doc) for doc in self.docs if self._matches(doc, query)]
+
+    def update_one(self, query, update, upsert=False):
+        for doc in self.docs:
+            if self._matches(doc, query):
+                doc.update(update.get("$set", {}))
+                for key in update.get("$unset", {}):
+                    doc.pop(key, None)
+                return
+        if upsert:
+            self.docs.append({**query, **update["$set"]})
+
+    def delete_many(self, query):
+        self.docs = [doc for doc in self.docs if not self._matches(doc, query)]
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            self.written_months.append(request.filter["month"])
+            self.update_one(request.filter, request.update, upsert=request.upsert)
+
+
+class UpdateRequest(NamedTuple):
+    """
+    Records the arguments of a pymongo UpdateOne for FakeCollection.bulk_write
+    """
+    filter: dict
+    update: dict
+    upsert: bool = False
+
+
+@pytest.fixture
+def update_requests(mocker):
+    mocker.patch.object(commit_statistics, "UpdateOne", UpdateRequest)
+
+
+def commit(repo, author, date):
+    with open(os.path.join(repo.working_tree_dir, "file.txt"), 'a') as f:
+        f.write(date)
+    repo.index.add(["file.txt"])
+    date = datetime.datetime.fromisoformat(date)
+    return repo.index.commit(date.isoformat(), author=git.Actor(author, "a@a.com"),
+                             committer=git.Actor(author, "a@a.com"), author_date=date, commit_date=date)
+
+
+def test_format_commits_per_author_matches_the_full_calculation():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    commits = [
+        CommitRecord("1", "A", now - datetime.timedelta(days=100)),
+        CommitRecord("2", "B", now - datetime.timedelta(days=40)),
+        CommitRecord("3", "B", now - datetime.timedelta(days=10)),
+        CommitRecord("4", "C", now - datetime.timedelta(days=1)),
+    ]
+    counts, _ = commit_statistics.count_commits(commits[:2])
+    counts, _ = commit_statistics.count_commits(commits[2:], counts)
+
+    # the all time tallies are folded in two steps, the 30 day window only needs the recent commits
+    result = commit_statistics.format_commits_per_author(counts, commits[2:])
+    assert result == get_commits_per_author(commits)
+    assert result["all_time"]["total"] == 4
+    assert result["last_30_days"]["total"] == 2
+    assert result["all_time"]["top_25"][0] == {"name": "B", "all_time": 2, "last_30_days": 1}
+
+
+def test_count_commits_in_windows_and_periods():
+    now = datetime.datetime(2021, 3, 1, tzinfo=datetime.timezone.utc)
+    commits = CommitIndex([
+        CommitRecord("1", "A", datetime.datetime.fromisoformat("2020-01-01T10:00:00+00:00")),
+        CommitRecord("2", "B", datetime.datetime.fromisoformat("2020-12-31T23:30:00-05:00")),
+        CommitRecord("3", "A", datetime.datetime.fromisoformat("2021-02-20T10:00:00+00:00")),
+        CommitRecord("4", "A", datetime.datetime.fromisoformat("2021-02-27T10:00:00+00:00")),
+    ])
+    windows = commit_statistics.count_commits_in_windows(commits, list(commit_statistics.COMMIT_WINDOWS), now)
+    # author ids are in the order the authors were first seen
+    assert commits.authors == ["A", "B"]
+    assert windows["last_7_days"].tolist() == [1, 0]
+    assert windows["last_30_days"].tolist() == [2, 0]
+    assert windows["last_90_days"].tolist() == [2, 1]
+    assert windows["last_365_days"].tolist() == [2, 1]
+
+    # periods use the committer's local time, so commit 2 is in december 2020
+    assert commit_statistics.count_commits_per_period(commits, "month") == {
+        "2020-01": {"commits": 1, "contributor_count": 1},
+        "2020-12": {"commits": 1, "contributor_count": 1},
+        "2021-02": {"commits": 2, "contributor_count": 1},
+    }
+    assert commit_statistics.count_commits_per_period(commits, "week") == {
+        "2020-W01": {"commits": 1, "contributor_count": 1},
+        "2020-W53": {"commits": 1, "contributor_count": 1},
+        "2021-W07": {"commits": 1, "contributor_count": 1},
+        "2021-W08": {"commits": 1, "contributor_count": 1},
+    }
+
+    with pytest.raises(InvalidArgumentError):
+        commit_statistics.count_commits_in_windows(commits, ["last_2_days"], now)
+
+
+def test_history_was_rewritten(tmpdir):
+    repo = git.Repo.init(os.path.join(tmpdir, "repo"))
+    commit(repo, "A", "2020-01-01T00:00:00+00:00")
+    first = commit(repo, "A", "2020-01-02T00:00:00+00:00")
+    tips = commit_statistics.get_ref_tips(repo.git_dir)
+    assert tips == [first.hexsha]
+
+    commit(repo, "A", "2020-01-03T00:00:00+00:00")
+    assert not commit_statistics.history_was_rewritten(repo.git_dir, tips)
+
+    # a force push that drops the previous tip
+    repo.head.reset("HEAD~2", index=True, working_tree=True)
+    commit(repo, "B", "2020-01-04T00:00:00+00:00")
+    assert commit_statistics.history_was_rewritten(repo.git_dir, tips)
+
+    # a tip that no longer exists in the repository at all
+    assert commit_statistics.history_was_rewritten(repo.git_dir, ["0" * 40])
+
+
+def test_update_commit_statistics_is_incremental(tmpdir, mock_logger, repo_owner, repo_name, update_requests):
+    repo = git.Repo.init(os.path.join(tmpdir, "repo"))
+    commit(repo, "A", "2020-01-01T00:00:00+00:00")
+    commit(repo, "B", "2020-01-15T00:00:00+00:00")
+    commit(repo, "A", "2020-02-01T00:00:00+00:00")
+
+    db = {"commit_statistics": FakeCollection(), "commit_statistics_months": FakeCollection()}
+    client = {"test_db": db}
+
+    first = commit_statistics.update_commit_statistics(repo_owner, repo_name, repo.git_dir, client, mock_logger)
+    assert first["commits_per_author"]["all_time"]["total"] == 3
+
+    commit(repo, "C", "2020-03-01T00:00:00+00:00")
+    db["commit_statistics_months"].written_months = []
+    second = commit_statistics.update_commit_statistics(repo_owner, repo_name, repo.git_dir, client, mock_logger)
+
+    # only the month of the new commit is rewritten, and the result is the same as a full calculation
+    assert db["commit_statistics_months"].written_months == ["2020-03"]
+    commit_index = build_commit_index(repo.git_dir)
+    assert second["commits_per_author"] == get_commits_per_author(commit_index, commit_statistics.LEADERBOARD_WINDOWS)
+    assert second["commits_per_month"] == get_monthly_commit_data(commit_index)
+
+    # rewriting the history rebuilds the tallies from scratch
+    repo.head.reset("HEAD~1", index=True, working_tree=True)
+    repo.git.reflog("expire", "--expire=now", "--all")
+    third = commit_statistics.update_commit_statistics(repo_owner, repo_name, repo.git_dir, client, mock_logger)
+    commit_index = build_commit_index(repo.git_dir)
+    assert third["commits_per_author"] == get_commits_per_author(commit_index, commit_statistics.LEADERBOARD_WINDOWS)
+    assert third["commits_per_month"] == get_monthly_commit_data(commit_index)
+
+
+def test_update_commit_statistics_rebuilds_after_an_interrupted_run(tmpdir, mock_logger, repo_owner, repo_name,
+                                                                    update_requests, mocker):
+    repo = git.Repo.init(os.path.join(tmpdir, "repo"))
+    commit(repo, "A", "2020-01-01T00:00:00+00:00")
+    db = {"commit_statistics": FakeCollection(), "commit_statistics_months": FakeCollection()}
+    client = {"test_db": db}
+    commit_statistics.update_commit_statistics(repo_owner, repo_name, repo.git_dir, client, mock_logger)
+
+    # the run stops after the monthly tallies were written, before the new tips were stored
+    commit(repo, "B", "2020-01-02T00:00:00+00:00")
+    update_one = db["commit_statistics"].update_one
+
+    def interrupted_update_one(query, update, upsert=False):
+        if "$set" in update:
+            raise SystemError("connection lost")
+        update_one(query, update, upsert)
+
+    interrupted = mocker.patch.object(db["commit_statistics"], "update_one", side_effect=interrupted_update_one)
+    with pytest.raises(SystemError):
+        commit_statistics.update_commit_statistics(repo_owner, repo_name, repo.git_dir, client, mock_logger)
+    mocker.stop(interrupted)
+    assert "tips" not in db["commit_statistics"].docs[0]
+
+    # the next run rebuilds the tallies instead of counting the new commit a second time
+    result = commit_statistics.update_commit_statistics(repo_owner, repo_name, repo.git_dir, client, mock_logger)
+    assert result["commits_per_month"]["month_data"] == [{"month": "2020-01", "commits": 2, "contributor_count": 2}]
+    assert result["commits_per_author"]["all_time"]["total"] == 2
@@ -1,45 +1,29 @@
 import json
-from unittest.mock import MagicMock
-import unittest
 from src.pipeline import pipeline
+from src.pipeline.commit_index import CommitIndex, CommitRecord
 import datetime
 import os
-import time
 from freezegun import freeze_time
 
 
-def generate_fake_repo(json_file):
+def generate_fake_commit_index(json_file):
     current_dir = os.path.dirname(os.path.abspath(__file__))
     date_format = "%Y-%m-%d %H:%M:%S%z"
 
     with open(os.path.join(current_dir, json_file), 'r') as f:
         fakerepo = json.load(f)
 
-    def iter_commits(branch_name):
-        nonlocal date_format
-        commits = fakerepo[branch_name]
-        commit_objs = []
-        for commit in commits:
-            c_mock = MagicMock()
-            c_mock.hexsha = commit["hexsha"]
-            c_mock.committed_datetime = datetime.datetime.strptime(commit["committed_datetime"], date_format)
-            c_mock.author.name = commit["author"]["name"]
-            commit_objs.append(c_mock)
-
-        return commit_objs
-
-    branches = []
-    for branch in ["branch1", "branch2"]:
-        mock = MagicMock()
-        mock.name = branch
-        branches.append(mock)
-
-    return MagicMock(references=branches, iter_commits=iter_commits)
+    # like 'git log --all', every commit reachable from any branch is only included once
+    commits = {c["hexsha"]: c for branch in ["branch1", "branch2"] for c in fakerepo[branch]}.values()
+    return CommitIndex(
+        CommitRecord(c["hexsha"], c["author"]["name"], datetime.datetime.strptime(c["committed_datetime"], date_format))
+        for c in commits
+    )
 
 
 @freeze_time("2021-08-29")
 def test_get_commits_per_author(mocker):
-    repo = generate_fake_repo('test_repo2.json')
+    commit_index = generate_fake_commit_index('test_repo2.json')
 
     expected_result = {
         "all_time": {
@@ -73,13 +57,13 @@ def test_get_commits_per_author(mocker):
             "total": 4
         }
     }
-    result = pipeline.get_commits_per_author(repo)
+    result = pipeline.get_commits_per_author(commit_index)
 
     assert expected_result == result
 
 
 def test_get_monthly_commit_data():
-    repo = generate_fake_repo('test_repo.json')
+    commit_index = generate_fake_commit_index('test_repo.json')
 
     expected_result = {
         "month_data": [
@@ -106,6 +90,6 @@ def test_get_monthly_commit_data():
         ]
     }
 
-    result = pipeline.get_monthly_commit_data(repo)
+    result = pipeline.get_monthly_commit_data(commit_index)
 
     assert expected_result == result
@@ -1,3 +1,4 @@
+import datetime
 from unittest.mock import MagicMock
 
 from src.pipeline import pipeline
@@ -44,14 +45,12 @@ def test_pushing_release_data_to_db():
     }
     owner = "owner"
     repo = "repo"
-    tag = MagicMock()
-    tag.name = 'v1.0.0'
-    tag.commit.committed_datetime = ''
+    tag = pipeline.TagInfo('v1.0.0', 'abcdef', datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc))
     pipeline.push_release_to_mongodb(owner, repo, tag, {'key': 'val'}, mock_client)
     mock_client['test_db']['releases'].update_one.assert_called_once_with(
         {"name": repo, "owner": owner, "tag_name": tag.name},
         {'$set':
-             {"name": repo, "owner": owner, "tag_name": tag.name, "committed_date": tag.commit.committed_datetime,
+             {"name": repo, "owner": owner, "tag_name": tag.name, "committed_date": tag.committed_datetime,
               "LOC": {'key': 'val'}}
          },
         upsert=True
@@ -76,3 +75,21 @@ def test_push_heatmap_data_to_mongodb():
         {'$set': {'heatmap_data': 'value'}},
         upsert=True
     )
+
+
+def test_push_heatmap_data_to_mongodb_clears_the_histograms():
+    mock_collection = MagicMock()
+    mock_client = {
+        'test_db': {
+            'repositories': mock_collection
+        }
+    }
+
+    generate_heatmap_data.push_heatmap_data_to_mongodb("owner", "repo", "value", mock_client,
+                                                       clear_activity_histograms=True)
+
+    mock_collection.update_one.assert_called_once_with(
+        {"name": "repo", "owner": "owner"},
+        {'$set': {'heatmap_data': 'value'}, '$unset': {'activity_histograms': ""}},
+        upsert=True
+    )
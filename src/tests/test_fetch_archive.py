@@ -0,0 +1,106 @@
+import gzip
+import os
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
+import pytest
+
+from src.pipeline import fetch_archive, github_fetcher
+
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+END = START + timedelta(days=4)
+ITEMS = [
+    {"data": {"number": 1, "updated_at": "2020-01-01T06:00:00Z", "state": "open"}},
+    {"data": {"number": 2, "updated_at": "2020-01-02T06:00:00Z", "state": "open"}},
+    {"data": {"number": 3, "updated_at": "2020-01-03T06:00:00Z", "state": "open"}},
+    {"data": {"number": 1, "updated_at": "2020-01-04T06:00:00Z", "state": "closed"}},
+]
+
+
+class FakeBackend:
+    """
+    Returns the items updated during the requested range, and fails once the range starts at or after fail_from
+    """
+    def __init__(self, calls, fail_from=None):
+        self.calls = calls
+        self.fail_from = fail_from
+
+    def fetch(self, category, from_date, to_date):
+        self.calls.append((from_date, to_date))
+        if self.fail_from is not None and from_date >= self.fail_from:
+            raise ConnectionError("connection reset")
+        return [item for item in ITEMS if from_date <= github_fetcher.get_updated_at(item) < to_date]
+
+
+def create_fetcher(tmpdir, backend, offline=False):
+    return github_fetcher.GitHubFetcher(
+        "owner", "name", ["token"], slices_per_token=4, backend_factory=lambda token: backend, offline=offline,
+        archive_factory=partial(fetch_archive.FetchArchive, "owner", "name", archive_dir=tmpdir))
+
+
+def test_failed_fetch_resumes_from_the_high_water_mark(tmpdir):
+    calls = []
+    fetcher = create_fetcher(tmpdir, FakeBackend(calls, fail_from=START + timedelta(days=2)))
+    with pytest.raises(ConnectionError):
+        list(fetcher.fetch(category="issue", from_date=START, to_date=END))
+
+    # the first two slices were recorded before the failure
+    archive = fetch_archive.FetchArchive("owner", "name", "issue", archive_dir=tmpdir)
+    assert archive.coverage() == [(START, START + timedelta(days=2))]
+    assert archive.high_water_mark(START) == START + timedelta(days=2)
+    assert archive.high_water_mark(END) == END
+
+    calls = []
+    fetcher = create_fetcher(tmpdir, FakeBackend(calls))
+    result = list(fetcher.fetch(category="issue", from_date=START, to_date=END))
+    # the archived range is replayed first, then the newer copy of item 1 arrives with the fetched slices
+    assert [item["data"]["number"] for item in result] == [1, 2, 3, 1]
+    # only the range after the high water mark was fetched again
+    assert min(start for start, _ in calls) == START + timedelta(days=2)
+    assert archive.coverage() == [(START, END)]
+    # the archive was compacted into a single slice holding the latest copy of each item
+    assert len(archive.read_slices()) == 1
+
+    # the archive alone can be replayed without going to the API
+    calls = []
+    fetcher = create_fetcher(tmpdir, FakeBackend(calls), offline=True)
+    assert list(fetcher.fetch(category="issue", from_date=START, to_date=END)) == result[1:]
+    assert calls == []
+
+
+def test_partly_written_slices_are_ignored(tmpdir):
+    archive = fetch_archive.FetchArchive("owner", "name", "pull_request", archive_dir=tmpdir)
+    archive.record(START, START + timedelta(days=1), ITEMS[:1])
+    archive.record(START + timedelta(days=1), START + timedelta(days=2), ITEMS[1:2])
+    # a crash in the middle of writing a slice leaves a truncated gzip member at the end of the file
+    member = gzip.compress(b'{"from": "2020-01-02T00:00:00+00:00", "to": "2020-01-03T00:00:00+00:00", "items": []}\n')
+    with open(archive.path, "ab") as archive_file:
+        archive_file.write(member[:len(member) // 2])
+
+    assert archive.coverage() == [(START, START + timedelta(days=2))]
+    archive.compact()
+    assert os.path.exists(archive.path) and not os.path.exists(archive.path + ".tmp")
+    assert archive.replay(START, END) == ITEMS[:2]
+
+
+def test_merge_intervals():
+    day = timedelta(days=1)
+    intervals = [(START + 3 * day, START + 4 * day), (START, START + day), (START + day, START + 2 * day)]
+    assert fetch_archive.merge_intervals(intervals) == [(START, START + 2 * day), (START + 3 * day, START + 4 * day)]
+
+
+def test_compact_drops_the_time_before_the_cut_off(tmpdir):
+    day = timedelta(days=1)
+    archive = fetch_archive.FetchArchive("owner", "name", "issue", archive_dir=tmpdir)
+    for index in range(3):
+        archive.record(START + index * day, START + (index + 1) * day, ITEMS[index:index + 1])
+
+    cut_off = START + day + timedelta(hours=12)
+    archive.compact(cut_off)
+    assert archive.coverage() == [(cut_off, START + 3 * day)]
+    assert archive.replay(START, END) == ITEMS[2:3]
+
+    # nothing is left once the cut off is after the whole archive
+    archive.compact(END)
+    assert not os.path.exists(archive.path)
+    assert archive.coverage() == []
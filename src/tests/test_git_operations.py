@@ -4,7 +4,11 @@ import pytest
 from src.pipeline import pipeline
 from src.pipeline.exceptions import *
 from unittest.mock import MagicMock
+import datetime
+import itertools
 import json
+import os
+import time
 import git
 
 
@@ -53,15 +57,162 @@ def test_call_cloc_error(mocker):
         results = pipeline.call_cloc('', False)
 
 
-def test_clone_repo(mocker):
-    owner = 'owner'
-    repo = 'repo'
-    mocker.patch(
-        'git.Repo.clone_from',
-        return_value='return'
-    )
-    result = pipeline.clone_repo(owner, repo, None, print_progress=False)
-    assert result == 'return'
+def test_clone_repo(tmpdir, mock_logger, mocker):
+    # a local repository stands in for github
+    remote = git.Repo.init(os.path.join(tmpdir, "remote"))
+    with open(os.path.join(tmpdir, "remote", "file.txt"), 'w') as f:
+        f.write("content")
+    remote.index.add(["file.txt"])
+    remote.index.commit("initial commit")
+    remote.create_tag("v1.0.0")
+    mocker.patch('src.pipeline.pipeline.REMOTE_URL_TEMPLATE', os.path.join(str(tmpdir), "{name}"))
+
+    repos_dir = os.path.join(tmpdir, "tmp")
+    cache_dir = os.path.join(tmpdir, "mirrors")
+    repo = pipeline.clone_repo('owner', 'remote', mock_logger, print_progress=False, repos_dir=repos_dir,
+                               cache_dir=cache_dir)
+
+    assert repo.working_tree_dir == os.path.join(repos_dir, 'owner', 'remote')
+    assert [t.name for t in repo.tags] == ["v1.0.0"]
+    assert os.path.exists(os.path.join(repos_dir, 'owner', 'remote', 'file.txt'))
+    assert os.path.isdir(os.path.join(cache_dir, 'owner', 'remote.git'))
+    repo.close()
+
+    # the second run only fetches the new objects into the mirror
+    with open(os.path.join(tmpdir, "remote", "file.txt"), 'w') as f:
+        f.write("new content")
+    remote.index.add(["file.txt"])
+    new_commit = remote.index.commit("second commit")
+    repo = pipeline.clone_repo('owner', 'remote', mock_logger, print_progress=False, repos_dir=repos_dir,
+                               cache_dir=cache_dir)
+    assert repo.head.commit.hexsha == new_commit.hexsha
+    repo.close()
+
+    pipeline.clean_up_repo('owner', 'remote', repos_dir=repos_dir, cache_dir=cache_dir)
+    assert not os.path.exists(os.path.join(repos_dir, 'owner', 'remote'))
+    assert os.path.isdir(os.path.join(cache_dir, 'owner', 'remote.git'))
+
+
+def test_clone_repo_blobless(tmpdir, mock_logger, mocker):
+    remote = git.Repo.init(os.path.join(tmpdir, "remote"))
+    remote.git.config("uploadpack.allowFilter", "true")
+    for version in ["1", "2"]:
+        with open(os.path.join(tmpdir, "remote", "file.txt"), 'w') as f:
+            f.write(version)
+        remote.index.add(["file.txt"])
+        remote.index.commit(f"commit {version}")
+    mocker.patch('src.pipeline.pipeline.REMOTE_URL_TEMPLATE', "file://" + os.path.join(str(tmpdir), "{name}"))
+
+    mirror = pipeline.mirror_repo('owner', 'remote', mock_logger, print_progress=False,
+                                  cache_dir=os.path.join(tmpdir, "mirrors"), blobless=True)
+    # the full history is available without any file contents
+    assert len(list(mirror.iter_commits("HEAD"))) == 2
+    missing = mirror.git.rev_list("--objects", "--missing=print", "--all").splitlines()
+    assert sum(1 for line in missing if line.startswith("?")) == 2
+
+    # checking out the working tree only downloads the contents of the checked out commit
+    repo = pipeline.checkout_repo('owner', 'remote', mirror, mock_logger, repos_dir=os.path.join(tmpdir, "tmp"))
+    with open(os.path.join(repo.working_tree_dir, "file.txt")) as f:
+        assert f.read() == "2"
+    missing = mirror.git.rev_list("--objects", "--missing=print", "--all").splitlines()
+    assert sum(1 for line in missing if line.startswith("?")) == 1
+    repo.close()
+    mirror.close()
+
+
+def test_extract_revision(tmpdir, mock_logger, mocker):
+    remote = git.Repo.init(os.path.join(tmpdir, "remote"))
+    remote.git.config("uploadpack.allowFilter", "true")
+    commits = []
+    os.makedirs(os.path.join(tmpdir, "remote", "src"))
+    with open(os.path.join(tmpdir, "remote", "other.txt"), 'w') as f:
+        f.write("other")
+    remote.index.add(["other.txt"])
+    for version in ["1", "2"]:
+        with open(os.path.join(tmpdir, "remote", "src", "file.txt"), 'w') as f:
+            f.write(version)
+        remote.index.add([os.path.join("src", "file.txt")])
+        commits.append(remote.index.commit(f"commit {version}"))
+    mocker.patch('src.pipeline.pipeline.REMOTE_URL_TEMPLATE', "file://" + os.path.join(str(tmpdir), "{name}"))
+    mirror = pipeline.mirror_repo('owner', 'remote', mock_logger, print_progress=False,
+                                  cache_dir=os.path.join(tmpdir, "mirrors"), blobless=True)
+    head = mirror.head.commit.hexsha
+
+    destination = os.path.join(tmpdir, "extracted")
+    run = mocker.patch('subprocess.run', wraps=pipeline.subprocess.run)
+    pipeline.extract_revision(mirror.git_dir, commits[0].hexsha, destination, os.path.join(tmpdir, "index"))
+    # both files of the commit were downloaded with a single request
+    assert sum(1 for call in run.call_args_list if "fetch" in call[0][0]) == 1
+    mocker.stop(run)
+    with open(os.path.join(destination, "src", "file.txt")) as f:
+        assert f.read() == "1"
+    # the mirror is left as it was, and only the contents of the extracted commit were downloaded
+    assert mirror.head.commit.hexsha == head
+    assert not os.path.exists(os.path.join(mirror.git_dir, "index"))
+    missing = mirror.git.rev_list("--objects", "--missing=print", "--all").splitlines()
+    assert sum(1 for line in missing if line.startswith("?")) == 1
+
+    with pytest.raises(SystemError):
+        pipeline.extract_revision(mirror.git_dir, "missing-tag", destination, os.path.join(tmpdir, "index"))
+
+    # cloc counts every file of the extracted tree, since it is not a git repository
+    git_run = pipeline.subprocess.run
+    cloc_result = MagicMock(returncode=0, stdout=json.dumps({'header': 'data', 'Text': {'code': 1}}), stderr='')
+    run = mocker.patch('subprocess.run', side_effect=lambda command, **kwargs:
+                       cloc_result if kwargs.get("shell") else git_run(command, **kwargs))
+    assert pipeline.count_revision_loc(mirror.git_dir, commits[1].hexsha, tmp_dir=str(tmpdir)) == {'Text': {'code': 1}}
+    assert run.call_args[0][0] == "cloc . --json"
+    mirror.close()
+
+
+def test_count_tags_loc(mocker):
+    tags = [pipeline.TagInfo(f"v{i}", f"sha{i}", None) for i in range(6)]
+    running = []
+    peak = []
+
+    def count_revision_loc(repo_path, revision, tmp_dir):
+        running.append(revision)
+        peak.append(len(running))
+        # the earlier tags take longer, so they finish last
+        time.sleep(0.05 * (6 - int(revision[3:])) / 6)
+        running.remove(revision)
+        if revision == "sha4":
+            raise SystemError("cloc failed")
+        return {"revision": revision}
+
+    mocker.patch('src.pipeline.pipeline.count_revision_loc', side_effect=count_revision_loc)
+    counts = pipeline.count_tags_loc("mirror", tags, max_workers=3, use_cache=False)
+    assert [(tag.name, data["revision"]) for tag, data in itertools.islice(counts, 4)] == \
+        [("v0", "sha0"), ("v1", "sha1"), ("v2", "sha2"), ("v3", "sha3")]
+    assert 1 < max(peak) <= 3
+    with pytest.raises(SystemError):
+        next(counts)
+
+
+def test_get_sorted_tags(tmpdir):
+    repo = git.Repo.init(os.path.join(tmpdir, "repo"))
+    repo.git.config("user.name", "test")
+    repo.git.config("user.email", "test@test.com")
+    dates = ["2020-03-01T12:00:00+01:00", "2020-01-01T12:00:00+00:00", "2020-02-01T12:00:00-05:00"]
+    commits = []
+    for index, date in enumerate(dates):
+        with open(os.path.join(tmpdir, "repo", "file.txt"), 'w') as f:
+            f.write(str(index))
+        repo.index.add(["file.txt"])
+        date = datetime.datetime.fromisoformat(date)
+        commits.append(repo.index.commit(f"commit {index}", author_date=date, commit_date=date))
+    repo.create_tag("lightweight", ref=commits[0])
+    repo.create_tag("annotated", ref=commits[1], message="an annotated tag")
+    repo.create_tag("middle", ref=commits[2])
+    repo.create_tag("tree", ref=commits[2].tree)
+
+    tags = pipeline.get_sorted_tags(repo)
+
+    assert [t.name for t in tags] == ["annotated", "middle", "lightweight"]
+    assert [t.commit_sha for t in tags] == [commits[1].hexsha, commits[2].hexsha, commits[0].hexsha]
+    assert [t.committed_datetime for t in tags] == [datetime.datetime.fromisoformat(d) for d in
+                                                    [dates[1], dates[2], dates[0]]]
+    repo.close()
 
 
 def test_check_local_repo_exists_does_exist(mocker):
@@ -69,20 +220,43 @@ def test_check_local_repo_exists_does_exist(mocker):
     mocker.patch('os.path.exists', return_value=True)
     mocker.patch('os.path.isdir', return_value=True)
     mocker.patch('git.Repo', return_value=MagicMock(git_dir=''))
-    assert pipeline.check_local_repo_exists('repo')
+    assert pipeline.check_local_repo_exists('owner', 'repo')
 
 
 def test_check_local_repo_exists_doesnt_exist(mocker):
     mocker.patch('os.path.exists', return_value=True)
     mocker.patch('os.path.isdir', return_value=True)
     mocker.patch('git.Repo', return_value=MagicMock(git_dir=''), side_effect=git.exc.InvalidGitRepositoryError)
-    assert not pipeline.check_local_repo_exists('repo')
+    assert not pipeline.check_local_repo_exists('owner', 'repo')
 
 
 def test_clean_up_repo(mocker):
-    mocker.patch('src.pipeline.pipeline.check_local_repo_exists', return_value=True)
-    mocker.patch('git.rmtree', return_value=None)
-    assert pipeline.clean_up_repo('repo') is None
+    remove_mock = mocker.patch('src.pipeline.pipeline.remove_worktree', return_value=None)
+    release_mock = mocker.patch('src.pipeline.pipeline.release_mirror', return_value=None)
+    assert pipeline.clean_up_repo('owner', 'repo') is None
+    remove_mock.assert_called_once()
+    release_mock.assert_called_once()
+
+
+def test_process_repository_cleans_up_after_a_failed_stage(mock_logger, mocker):
+    mocker.patch('src.pipeline.pipeline.get_logger', return_value=mock_logger)
+    mocker.patch('src.pipeline.pipeline.time.sleep')
+    mirror = MagicMock()
+
+    def run_stages(stages, logger, max_workers):
+        stages_by_name = {stage.name: stage for stage in stages}
+        mocker.patch('src.pipeline.pipeline.mirror_repo', return_value=mirror)
+        stages_by_name["mirror"].func({"metadata": {}})
+        raise SystemError("cloc failed")
+
+    mocker.patch('src.pipeline.pipeline.run_stages', side_effect=run_stages)
+    clean_up_mock = mocker.patch('src.pipeline.pipeline.clean_up_repo', return_value=None)
+    mock_logger.exception_has_occurred = True
+
+    assert not pipeline.process_repository('owner/repo', datetime.datetime.now(), repos_dir='repos')
+    mirror.close.assert_called_once()
+    clean_up_mock.assert_called_once_with('owner', 'repo', 'repos')
+    mock_logger.exception.assert_called_once_with("cloc failed")
 
 # def test_get_monthly_commit_data(mocker):
 #     # go through each line of the function get_monthly_commit_data, and ensure that each line is mocked out.
@@ -0,0 +1,94 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from src.pipeline import github_fetcher
+from src.pipeline.exceptions import *
+
+
+def test_split_time_range():
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    end = datetime(2020, 1, 5, tzinfo=timezone.utc)
+    slices = github_fetcher.split_time_range(start, end, 4)
+    assert slices[0] == (start, datetime(2020, 1, 2, tzinfo=timezone.utc))
+    assert slices[-1] == (datetime(2020, 1, 4, tzinfo=timezone.utc), end)
+    assert len(slices) == 4
+
+    with pytest.raises(InvalidArgumentError):
+        github_fetcher.split_time_range(start, end, 0)
+
+
+def test_fetcher_merges_slices_from_every_token():
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    # item 1 was updated during the fetch, so both its old and new versions are returned
+    items = [
+        {"data": {"number": 1, "updated_at": "2020-01-01T06:00:00Z", "state": "open"}},
+        {"data": {"number": 2, "updated_at": "2020-01-02T06:00:00Z", "state": "open"}},
+        {"data": {"number": 3, "updated_at": "2020-01-03T06:00:00Z", "state": "open"}},
+        {"data": {"number": 1, "updated_at": "2020-01-04T06:00:00Z", "state": "closed"}},
+    ]
+    # the first fetch of each token waits for the other token, so this only finishes if both are used at the same time
+    barrier = threading.Barrier(2, timeout=5)
+    calls = []
+    lock = threading.Lock()
+
+    class FakeBackend:
+        def __init__(self, token):
+            self.token = token
+
+        def fetch(self, category, from_date, to_date):
+            with lock:
+                first_call = self.token not in {token for token, _, _ in calls}
+                calls.append((self.token, category, from_date))
+            if first_call:
+                barrier.wait()
+            return [item for item in items
+                    if from_date <= github_fetcher.get_updated_at(item) < to_date]
+
+    fetcher = github_fetcher.GitHubFetcher("owner", "name", ["token_a", "token_b"], slices_per_token=2,
+                                           backend_factory=FakeBackend)
+    result = list(fetcher.fetch(category="issue", from_date=start, to_date=start + timedelta(days=4)))
+
+    # the slices arrive in the order they finish, and a copy of an item is only yielded when it is newer than the copy
+    # yielded before it, so the last copy of each item is the most recent one
+    latest = {item["data"]["number"]: item for item in result}
+    assert sorted(latest) == [1, 2, 3]
+    assert latest[1]["data"]["state"] == "closed"
+    copies = [github_fetcher.get_updated_at(item) for item in result if item["data"]["number"] == 1]
+    assert copies == sorted(set(copies))
+    # the 4 slices were all fetched, each through a backend bound to a single token
+    assert len(calls) == 4
+    assert {token for token, _, _ in calls} == {"token_a", "token_b"}
+    assert {category for _, category, _ in calls} == {"issue"}
+
+
+def test_fetcher_yields_each_slice_as_it_is_fetched():
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    calls = []
+    # the second slice is only fetched once the test allows it
+    second_slice_started = threading.Event()
+    second_slice = threading.Event()
+
+    class FakeBackend:
+        def __init__(self, token):
+            pass
+
+        def fetch(self, category, from_date, to_date):
+            calls.append(from_date)
+            if len(calls) == 2:
+                second_slice_started.set()
+                second_slice.wait(timeout=5)
+            return [{"data": {"number": len(calls), "updated_at": from_date.strftime("%Y-%m-%dT%H:%M:%SZ")}}]
+
+    fetcher = github_fetcher.GitHubFetcher("owner", "name", ["token"], slices_per_token=4, backend_factory=FakeBackend)
+    items = fetcher.fetch(category="issue", from_date=start, to_date=start + timedelta(days=4))
+    # the first slice is available while the second one is still being fetched
+    assert next(items)["data"]["number"] == 1
+    assert second_slice_started.wait(timeout=5)
+    assert len(calls) == 2
+
+    # closing the generator early stops the fetch after the slice that is being fetched
+    second_slice.set()
+    items.close()
+    assert len(calls) == 2
@@ -0,0 +1,115 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.pipeline import github_graphql, pipeline
+from src.pipeline.http_client import RetryingSession
+
+
+def repository_node(name):
+    return {
+        "description": f"the {name} repository",
+        "forkCount": 3,
+        "stargazerCount": 10,
+        "watchers": {"totalCount": 2},
+        "diskUsage": 100,
+        "defaultBranchRef": {"name": "main"},
+        "issues": {"totalCount": 4},
+        "pullRequests": {"totalCount": 1},
+        "primaryLanguage": {"name": "Python"},
+        "languages": {"edges": [{"size": 900, "node": {"name": "Python"}}, {"size": 100, "node": {"name": "Shell"}}]},
+        "repositoryTopics": {"nodes": [{"topic": {"name": "data"}}]},
+        "licenseInfo": {"key": "mit", "name": "MIT License", "spdxId": "MIT", "url": "http://choosealicense.com/mit"},
+        "owner": {"__typename": "Organization", "login": "owner", "avatarUrl": "a", "url": "https://github.com/owner"},
+        "hasIssuesEnabled": True,
+        "hasProjectsEnabled": False,
+        "hasWikiEnabled": True,
+        "isArchived": False,
+        "isDisabled": False,
+        "isFork": False,
+        "visibility": "PUBLIC",
+        "homepageUrl": None,
+        "url": f"https://github.com/owner/{name}",
+        "pushedAt": "2021-08-01T00:00:00Z",
+        "createdAt": "2020-01-01T00:00:00Z",
+        "updatedAt": "2021-08-02T00:00:00Z",
+    }
+
+
+@pytest.fixture
+def graphql_server():
+    """
+    A local stand-in for the github GraphQL endpoint. Every repository named 'missing' is returned as null
+    """
+    queries = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            query = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["query"]
+            queries.append(query)
+            data = {alias: None if name == "missing" else repository_node(name)
+                    for alias, name in re.findall(r'(r\d+): repository\(owner: "[^"]*", name: "([^"]*)"\)', query)}
+            body = json.dumps({"data": data}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/graphql", queries
+    server.shutdown()
+    server.server_close()
+
+
+def test_prefetch_repository_metadata(graphql_server):
+    url, queries = graphql_server
+    session = RetryingSession(sleep=lambda seconds: None)
+    repo_strs = ["owner/a", "owner/missing", "owner/c"]
+    metadata, errors = github_graphql.prefetch_repository_metadata(repo_strs, url=url, batch_size=2, session=session)
+
+    assert errors == []
+    assert len(queries) == 2
+    assert list(metadata) == ["owner/a", "owner/c"]
+    data = metadata["owner/c"]
+    assert data["name"] == "c"
+    assert data["owner_obj"]["login"] == "owner"
+    assert data["organization_obj"] == data["owner_obj"]
+    assert data["open_issues_count"] == 5
+    assert data["default_branch"] == "main"
+    assert data["languages"] == {"Python": 900, "Shell": 100}
+    assert data["topics"] == ["data"]
+    assert data["license"]["spdx_id"] == "MIT"
+    assert data["visibility"] == "public"
+
+
+def test_prefetch_skips_failed_batches(requests_mock):
+    url = "https://example.com/graphql"
+    requests_mock.post(url, status_code=401)
+    metadata, errors = github_graphql.prefetch_repository_metadata(["owner/a"], url=url)
+    assert metadata == {}
+    assert errors[0].status_code == 401
+
+    # names are escaped as GraphQL strings
+    assert 'name: "a\\"b"' in github_graphql.build_metadata_query(['owner/a"b'])
+
+
+def test_graphql_and_rest_metadata_have_the_same_fields(requests_mock):
+    repo_url = "https://api.github.com/repos/owner/name"
+    owner_obj = {"login": "owner", "avatar_url": "a", "gravatar_id": "", "html_url": "b", "type": "Organization"}
+    requests_mock.get(repo_url, json={**{key: None for key in pipeline.REPOSITORY_METADATA_KEYS}, "owner": owner_obj,
+                                      "organization": owner_obj})
+    requests_mock.get(f"{repo_url}/languages", json={})
+    requests_mock.get(f"{repo_url}/topics", json={"names": []})
+    rest_keys = set(pipeline.get_repository_metadata("owner", "name"))
+
+    graphql_keys = set(github_graphql.format_repository_metadata("owner", "name", repository_node("name")))
+    assert graphql_keys == rest_keys - set(github_graphql.REST_ONLY_METADATA_KEYS)
@@ -0,0 +1,90 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from src.pipeline import generate_heatmap_data
+from src.pipeline.exceptions import InvalidArgumentError
+from src.pipeline.github_items import LightweightGitHub
+from src.pipeline.github_tokens import TokenManager
+from src.pipeline.http_client import RetryingSession
+
+REPO_URL = "https://api.github.com/repos/owner/name"
+START = datetime(2021, 1, 1, tzinfo=timezone.utc)
+END = datetime(2021, 2, 1, tzinfo=timezone.utc)
+
+
+def issue(number, updated_at, comments=0, pull_request=None):
+    data = {"number": number, "title": f"item {number}", "user": {"login": "author"}, "state": "closed",
+            "comments": comments, "created_at": "2021-01-01T00:00:00Z", "updated_at": updated_at,
+            "closed_at": "2021-01-03T00:00:00Z"}
+    if pull_request is not None:
+        data["pull_request"] = pull_request
+    return data
+
+
+@pytest.fixture
+def github_api(requests_mock):
+    page_2 = f"{REPO_URL}/issues?page=2"
+    requests_mock.get(f"{REPO_URL}/issues", [
+        {"json": [issue(1, "2021-01-02T00:00:00Z", comments=2)], "headers": {"Link": f'<{page_2}>; rel="next"'}},
+    ])
+    requests_mock.get(page_2, json=[
+        issue(2, "2021-01-03T00:00:00Z", pull_request={"merged_at": "2021-01-03T00:00:00Z"}),
+        # updated after the end of the fetch, so the list stops here
+        issue(3, "2021-03-01T00:00:00Z"),
+    ])
+    requests_mock.get(f"{REPO_URL}/issues/1/comments", json=[
+        {"user": {"login": "a"}, "created_at": "2021-01-02T00:00:00Z"},
+        {"user": {"login": "b"}, "created_at": "2021-01-02T01:00:00Z"},
+    ])
+    requests_mock.get(f"{REPO_URL}/pulls/2", json={"number": 2, "review_comments": 4, "merged": True})
+    requests_mock.get(f"{REPO_URL}/pulls/2/reviews", json=[
+        {"user": {"login": "reviewer"}, "submitted_at": "2021-01-02T12:00:00Z"}])
+    return requests_mock
+
+
+def create_backend(profile):
+    return LightweightGitHub("owner", "name", profile=profile, token_manager=TokenManager(["token"]),
+                             session=RetryingSession(sleep=lambda seconds: None))
+
+
+def test_full_profile_requests_the_stored_sub_resources(github_api):
+    issues = list(create_backend("full").fetch("issue", START, END))
+    assert [item["data"]["number"] for item in issues] == [1, 2]
+    assert [c["user"]["login"] for c in issues[0]["data"]["comments_data"]] == ["a", "b"]
+    # the list is requested from the start date in update order, and the issue without comments costs no request
+    first_request = github_api.request_history[0]
+    assert first_request.qs["since"] == ["2021-01-01t00:00:00z"]
+    assert first_request.qs["sort"] == ["updated"]
+    assert first_request.headers["Authorization"] == "token token"
+    assert github_api.call_count == 3
+
+    pull_requests = list(create_backend("full").fetch("pull_request", START, END))
+    assert len(pull_requests) == 1
+    data = pull_requests[0]["data"]
+    assert data["merged"] and data["merged_at"] == "2021-01-03T00:00:00Z"
+    assert data["review_comments"] == 4
+    assert data["reviews_data"][0]["user_data"] == {"login": "reviewer"}
+
+
+def test_heatmap_profile_only_reads_the_issue_list(github_api, mock_logger, mocker):
+    pull_requests = list(create_backend("heatmap").fetch("pull_request", START, END))
+    assert github_api.call_count == 2
+    assert "reviews_data" not in pull_requests[0]["data"]
+
+    # only the fields that were fetched are stored, so the stored reviews are kept
+    collection = mocker.MagicMock()
+    collection.with_options.return_value = collection
+    collection.find.return_value = []
+    collection.find_one.return_value = None
+    repo = mocker.MagicMock()
+    repo.fetch.return_value = pull_requests
+    records = generate_heatmap_data.retrieve_pull_requests("owner", "name", repo, 4, {"test_db": {
+        "pull_requests": collection}}, mock_logger).records
+    assert records["2"].merged_at == datetime(2021, 1, 3, tzinfo=timezone.utc)
+    fields = collection.bulk_write.call_args[0][0][0]._doc["$set"]
+    assert fields["merged"] is True
+    assert "reviewer" not in fields and "review_times" not in fields
+
+    with pytest.raises(InvalidArgumentError):
+        create_backend("everything")
@@ -0,0 +1,106 @@
+import time
+
+import requests
+
+from src.pipeline import github_tokens
+from src.pipeline.github_tokens import ManagedGitHub, TokenAuth, TokenManager
+
+
+class FakeClock:
+    def __init__(self, now=1000):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def headers(remaining, reset=2000, limit=5000):
+    return {"X-RateLimit-Remaining": str(remaining), "X-RateLimit-Limit": str(limit), "X-RateLimit-Reset": str(reset)}
+
+
+def test_acquire_prefers_the_token_with_the_most_budget():
+    clock = FakeClock()
+    manager = TokenManager(["aaaa1111", "bbbb2222"], min_remaining=10, clock=clock, sleep=clock.sleep)
+    manager.update("aaaa1111", headers(100))
+    manager.update("bbbb2222", headers(200))
+    assert manager.acquire() == "bbbb2222"
+    # the preferred token is used while it still has budget left
+    assert manager.acquire("aaaa1111") == "aaaa1111"
+    assert manager.states["aaaa1111"].remaining == 99
+
+    manager.update("aaaa1111", headers(10))
+    assert manager.acquire("aaaa1111") == "bbbb2222"
+
+    # responses without rate limit headers do not change the budget
+    manager.update("bbbb2222", {})
+    assert manager.states["bbbb2222"].remaining == 198
+
+    gauges = manager.gauges()
+    assert gauges["tokens"][0] == {"token": "...1111", "remaining": 10, "limit": 5000, "reset": 2000}
+    assert gauges["total_remaining"] == 208
+    assert clock.sleeps == []
+
+
+def test_acquire_sleeps_until_the_earliest_reset():
+    clock = FakeClock()
+    manager = TokenManager(["aaaa1111", "bbbb2222"], min_remaining=10, clock=clock, sleep=clock.sleep)
+    manager.update("aaaa1111", headers(0, reset=1500))
+    manager.update("bbbb2222", headers(5, reset=1200))
+
+    assert manager.acquire("aaaa1111") == "bbbb2222"
+    assert clock.sleeps == [200 + github_tokens.RESET_MARGIN]
+    # the budget is unknown again after the reset, so the full limit is assumed
+    assert manager.states["bbbb2222"].available() == 5000
+
+    # without a known reset time the manager waits a fixed amount of time before looking again
+    manager = TokenManager(["aaaa1111"], min_remaining=10, clock=clock, sleep=clock.sleep)
+    manager.states["aaaa1111"].remaining = 0
+    clock.sleeps = []
+    original_sleep = clock.sleep
+
+    def sleep(seconds):
+        original_sleep(seconds)
+        manager.states["aaaa1111"].remaining = 100
+
+    manager.sleep = sleep
+    assert manager.acquire() == "aaaa1111"
+    assert clock.sleeps == [github_tokens.UNKNOWN_RESET_WAIT]
+
+
+def test_token_auth_sets_the_header_and_reads_the_response(mocker):
+    manager = TokenManager(["aaaa1111"])
+    request = requests.Request("GET", "https://api.github.com/repos/owner/name").prepare()
+    request = TokenAuth(manager)(request)
+    assert request.headers["Authorization"] == "token aaaa1111"
+
+    response = mocker.MagicMock()
+    response.headers = headers(42)
+    for hook in request.hooks["response"]:
+        hook(response)
+    assert manager.states["aaaa1111"].remaining == 42
+
+    # without any tokens requests are sent unauthenticated
+    request = requests.Request("GET", "https://api.github.com/repos/owner/name").prepare()
+    request = TokenAuth(TokenManager([]))(request)
+    assert "Authorization" not in request.headers
+
+
+def test_managed_github_switches_to_the_token_with_budget(requests_mock):
+    url = "https://api.github.com/repos/owner/name/issues"
+    reset = int(time.time()) + 3600
+    requests_mock.get(url, [{"json": [], "headers": headers(10, reset)}, {"json": [], "headers": headers(3999, reset)}])
+    manager = TokenManager(["aaaa1111", "bbbb2222"], min_remaining=10)
+    manager.update("bbbb2222", headers(4000, reset))
+    client = ManagedGitHub("owner", "name", token_manager=manager, preferred_token="aaaa1111")._init_client()
+
+    # the preferred token is nearly used up after the first request, so perceval's own rate limit check would stop
+    # the fetch here. The token manager moves on to the other token instead
+    client.fetch(url)
+    client.fetch(url)
+    assert [r.headers["Authorization"] for r in requests_mock.request_history] == ["token aaaa1111", "token bbbb2222"]
+    assert manager.states["bbbb2222"].remaining == 3999
@@ -1,9 +1,12 @@
 import datetime
+import random
 from src.pipeline import generate_heatmap_data
+from src.pipeline.commit_index import CommitRecord
 from unittest.mock import MagicMock
+from freezegun import freeze_time
+from pymongo import UpdateOne
 import json
 import os
-from src.tests.test_contributor_commit_functions import generate_fake_repo
 
 
 def test_date_span():
@@ -20,72 +23,221 @@ def test_date_span():
     assert expected == actual
 
 
-def test_issue_is_open_in_week_true():
-    str_format = "%Y-%m-%dT%H:%M:%S%z"
-    issue = {
-        "created_at": "2020-01-02T12:00:00Z",
-        "state": "closed",
-        "closed_at": "2020-01-15T12:00:00Z"
-    }
-
-    start = datetime.datetime.strptime("2020-01-04T12:00:00Z", str_format)
-    end = datetime.datetime.strptime("2020-01-12T12:00:00Z", str_format)
-    assert generate_heatmap_data.issue_is_open_in_week(issue, start, end)
-
-    issue["state"] = "open"
-    issue["closed_at"] = None
-    assert generate_heatmap_data.issue_is_open_in_week(issue, start, end)
-
-
-def test_issue_is_open_in_week_false():
-    str_format = "%Y-%m-%dT%H:%M:%S%z"
-    issue = {
-        "created_at": "2020-01-02T12:00:00Z",
-        "state": "closed",
-        "closed_at": "2020-01-10T12:00:00Z"
-    }
-
-    start = datetime.datetime.strptime("2020-01-04T12:00:00Z", str_format)
-    end = datetime.datetime.strptime("2020-01-12T12:00:00Z", str_format)
-    assert not generate_heatmap_data.issue_is_open_in_week(issue, start, end)
-
-    issue["state"] = "open"
-    issue["closed_at"] = None
-    issue["created_at"] = "2020-01-07T12:00:00Z"
-    assert not generate_heatmap_data.issue_is_open_in_week(issue, start, end)
-
-
-def test_pull_request_is_modified_in_week():
-    str_format = "%Y-%m-%dT%H:%M:%S%z"
+def issue_is_open_in_week(issue, start_of_week, end_of_week, date_format="%Y-%m-%dT%H:%M:%S%z"):
+    """
+    The original per-week check: the issue was open for the whole week
+    """
+    if issue["created_at"] is None:
+        return False
+    if datetime.datetime.strptime(issue["created_at"], date_format) >= start_of_week:
+        return False
+    return issue["state"] == "open" or datetime.datetime.strptime(issue["closed_at"], date_format) > end_of_week
 
-    for option in ['created', 'closed', 'merged']:
-        pr = {f"{option}_at": "2020-01-02T12:00:00Z"}
 
-        start = datetime.datetime.strptime("2020-01-04T12:00:00Z", str_format)
-        end = datetime.datetime.strptime("2020-01-12T12:00:00Z", str_format)
-        assert not generate_heatmap_data.pull_request_is_modified_in_week(pr, start, end, option)
+def pull_request_is_modified_in_week(pr, start_of_week, end_of_week, option, date_format="%Y-%m-%dT%H:%M:%S%z"):
+    """
+    The original per-week check: the pull request was created, merged or closed (option) during the week
+    """
+    date = pr[f"{option}_at"]
+    return date is not None and start_of_week < datetime.datetime.strptime(date, date_format) < end_of_week
 
-        pr[f"{option}_at"] = "2020-01-07T12:00:00Z"
-        assert generate_heatmap_data.pull_request_is_modified_in_week(pr, start, end, option)
 
-        pr[f"{option}_at"] = "2020-01-20T12:00:00Z"
-        assert not generate_heatmap_data.pull_request_is_modified_in_week(pr, start, end, option)
+def commit_is_in_week(commit, start_of_week, end_of_week):
+    """
+    The original per-week check: the commit was made during the week
+    """
+    return start_of_week < commit.committed_datetime < end_of_week
 
 
-def test_commit_is_in_week():
-    str_format = "%Y-%m-%dT%H:%M:%S%z"
-    commit = MagicMock()
-    commit.committed_datetime = datetime.datetime.strptime("2020-01-04T12:00:00Z", str_format)
-
-    start = datetime.datetime.strptime("2020-01-04T12:00:00Z", str_format)
-    end = datetime.datetime.strptime("2020-01-12T12:00:00Z", str_format)
-    assert not generate_heatmap_data.commit_is_in_week(commit, start, end)
-
-    commit.committed_datetime = datetime.datetime.strptime("2020-01-07T12:00:00Z", str_format)
-    assert generate_heatmap_data.commit_is_in_week(commit, start, end)
-
-    commit.committed_datetime = datetime.datetime.strptime("2020-01-20T12:00:00Z", str_format)
-    assert not generate_heatmap_data.commit_is_in_week(commit, start, end)
+@freeze_time("2021-08-29 10:30:00")
+def test_build_heatmap_data_matches_the_weekly_checks():
+    rng = random.Random(0)
+    date_format = "%Y-%m-%dT%H:%M:%S%z"
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    def random_date():
+        # some dates land exactly on week boundaries, which are excluded by the strict comparisons
+        if rng.random() < 0.1:
+            return now - datetime.timedelta(weeks=rng.randint(0, 160))
+        return now - datetime.timedelta(seconds=rng.randint(-86400, 160 * 7 * 86400))
+
+    issues = {}
+    for i in range(300):
+        created = random_date()
+        state = rng.choice(["open", "closed"])
+        closed = None if state == "open" else created + datetime.timedelta(seconds=rng.randint(0, 60 * 86400))
+        issues[i] = {"created_at": created.strftime(date_format), "state": state,
+                     "closed_at": closed.strftime(date_format) if closed else None}
+    pull_requests = {}
+    for i in range(300):
+        pull_requests[str(i)] = {f"{option}_at": random_date().strftime(date_format) if rng.random() < 0.7 else None
+                                 for option in ["created", "merged", "closed"]}
+    commits = [CommitRecord(str(i), "A", random_date()) for i in range(500)]
+
+    issue_records = {i: generate_heatmap_data.issue_record_from_document(i, issue) for i, issue in issues.items()}
+    pull_request_records = {i: generate_heatmap_data.pull_request_record_from_document(i, {"state": "open", **pr})
+                            for i, pr in pull_requests.items()}
+    actual = generate_heatmap_data.build_heatmap_data(issue_records, pull_request_records, commits)
+
+    # the weeks start on monday at midnight, the newest one is the current week
+    assert len(actual) == 152
+    assert actual[0]["start"] == "2021-08-23-00"
+    assert actual[0]["coords"] == {"x": 18, "y": 0}
+    for week in actual:
+        start = datetime.datetime.strptime(week["start"], "%Y-%m-%d-%H").replace(tzinfo=datetime.timezone.utc)
+        end = start + datetime.timedelta(weeks=1)
+        assert week["issues"]["open"] == sum(
+            issue_is_open_in_week(issue, start, end) for issue in issues.values())
+        for option in ["created", "merged", "closed"]:
+            assert week["pull_requests"][option] == sum(
+                pull_request_is_modified_in_week(pr, start, end, option)
+                for pr in pull_requests.values())
+        assert week["commits"]["created"] == sum(
+            commit_is_in_week(commit, start, end) for commit in commits)
+
+
+def test_update_heatmap_data_applies_the_changed_items(mock_logger):
+    def date(*args):
+        return datetime.datetime(*args, tzinfo=datetime.timezone.utc)
+
+    IssueRecord = generate_heatmap_data.IssueRecord
+    PullRequestRecord = generate_heatmap_data.PullRequestRecord
+    ItemUpdates = generate_heatmap_data.ItemUpdates
+    resolutions = {"day": 10, "week": 4, "month": 6}
+    issues = {
+        "1": IssueRecord("1", "closed", date(2021, 3, 1), date(2021, 4, 10), date(2021, 4, 10)),
+        "2": IssueRecord("2", "open", date(2021, 6, 1), date(2021, 6, 1), None),
+    }
+    pull_requests = {
+        "1": PullRequestRecord("1", "closed", date(2021, 5, 3), date(2021, 5, 5), date(2021, 5, 5), None),
+        "2": PullRequestRecord("2", "open", date(2021, 8, 16), date(2021, 8, 16), None, None),
+    }
+    commits = [CommitRecord("1", "A", date(2021, 8, 2, 12))]
+
+    repo_collection = MagicMock()
+    repo_collection.with_options.return_value = repo_collection
+    client = {"test_db": {"repositories": repo_collection}}
+
+    now = date(2021, 8, 20, 12)
+    since = now - datetime.timedelta(weeks=152)
+    data, histograms, state = generate_heatmap_data.update_heatmap_data(
+        "owner", "name", (ItemUpdates(issues, since, None, date(2021, 6, 1)),
+                          ItemUpdates(pull_requests, since, None, date(2021, 8, 16))),
+        commits, client, mock_logger, now=now, resolutions=resolutions)
+    assert data == generate_heatmap_data.build_heatmap_data(issues, pull_requests, commits, now=now)
+    assert histograms == generate_heatmap_data.build_activity_histograms(
+        generate_heatmap_data.EventIndex(issues, pull_requests, commits), now, resolutions)
+    # the stored heatmap was not read
+    repo_collection.find_one.assert_not_called()
+    assert state["open_issues"] == 1
+
+    # a week later, an issue was reopened, a pull request was reopened and closed again, and a commit dated in an old
+    # week was merged. Issue 4 was stored before the heatmap window, so its previous version was never counted. An old
+    # week's stored counts are changed to show that the weeks are reused
+    data[100]["pull_requests"]["created"] = 50
+    repo_collection.find_one.return_value = {"heatmap_data": data, "activity_histograms": histograms,
+                                             "heatmap_state": state}
+    changed_issues = {
+        "1": IssueRecord("1", "open", date(2021, 3, 1), date(2021, 8, 25), None),
+        "3": IssueRecord("3", "open", date(2021, 8, 23), date(2021, 8, 23), None),
+        "4": IssueRecord("4", "closed", date(2017, 1, 1), date(2021, 8, 26), date(2021, 8, 26)),
+    }
+    previous_issues = {
+        "1": issues["1"],
+        "4": IssueRecord("4", "open", date(2017, 1, 1), date(2018, 3, 1), None),
+    }
+    changed_pull_requests = {
+        "1": PullRequestRecord("1", "closed", date(2021, 5, 3), date(2021, 8, 24), date(2021, 8, 24), None),
+    }
+    commits.append(CommitRecord("2", "B", date(2021, 5, 5, 12)))
+
+    now = date(2021, 8, 27, 12)
+    updated, updated_histograms, updated_state = generate_heatmap_data.update_heatmap_data(
+        "owner", "name", (ItemUpdates(changed_issues, date(2021, 6, 1), previous_issues, date(2021, 8, 26)),
+                          ItemUpdates(changed_pull_requests, date(2021, 8, 16), {"1": pull_requests["1"]},
+                                      date(2021, 8, 24))),
+        commits, client, mock_logger, now=now, resolutions=resolutions)
+
+    issues.update(changed_issues)
+    pull_requests.update(changed_pull_requests)
+    expected = generate_heatmap_data.build_heatmap_data(issues, pull_requests, commits, now=now)
+    assert updated[101]["pull_requests"]["created"] == 50
+    updated[101]["pull_requests"]["created"] = 0
+    # every week is the same as when it is counted from every item, including the old weeks that the changes reach
+    assert updated == expected
+    assert updated_histograms == generate_heatmap_data.build_activity_histograms(
+        generate_heatmap_data.EventIndex(issues, pull_requests, commits), now, resolutions)
+    assert updated_state["open_issues"] == 3
+    assert updated_state["items"] == {"issues": {"since": since, "updated_at": date(2021, 8, 26)},
+                                      "pull_requests": {"since": since, "updated_at": date(2021, 8, 24)}}
+
+
+def test_update_heatmap_search_counts_only_searches_recent_weeks(mock_logger):
+    date = datetime.datetime(2021, 8, 2, 12, tzinfo=datetime.timezone.utc)
+    commits = [CommitRecord("1", "A", date)]
+    pull_requests = {"1": generate_heatmap_data.PullRequestRecord(
+        "1", "open", datetime.datetime(2021, 8, 16, tzinfo=datetime.timezone.utc), None, None, None)}
+
+    repo_collection = MagicMock()
+    repo_collection.with_options.return_value = repo_collection
+    repo_collection.find_one.return_value = None
+    client = {"test_db": {"repositories": repo_collection}}
+
+    now = datetime.datetime(2021, 8, 20, 12, tzinfo=datetime.timezone.utc)
+    events = generate_heatmap_data.EventIndex({}, pull_requests, commits)
+    data, state = generate_heatmap_data.update_heatmap_search_counts("owner", "name", events, client, mock_logger,
+                                                                     now=now)
+    assert data == generate_heatmap_data.build_heatmap_data({}, pull_requests, commits, now=now)
+
+    # a week later the window has shifted by one week. An old week's stored counts are changed to show that old weeks
+    # are not searched again, while the commits of every week are counted again
+    data[30]["issues"]["open"] = 100
+    repo_collection.find_one.return_value = {"heatmap_data": data, "heatmap_state": state}
+    commits.append(CommitRecord("2", "B", datetime.datetime(2021, 5, 5, 12, tzinfo=datetime.timezone.utc)))
+
+    now = datetime.datetime(2021, 8, 27, 12, tzinfo=datetime.timezone.utc)
+    events = generate_heatmap_data.EventIndex({}, pull_requests, commits)
+    searched = MagicMock(wraps=events.count)
+    events.count = searched
+    updated, _ = generate_heatmap_data.update_heatmap_search_counts("owner", "name", events, client, mock_logger,
+                                                                    now=now)
+    # only the previous week and the new week were searched
+    assert len(searched.call_args[0][0]) == 2
+    assert updated[31]["issues"]["open"] == 100
+    updated[31]["issues"]["open"] = 0
+    assert updated == generate_heatmap_data.build_heatmap_data({}, pull_requests, commits, now=now)
+
+    # weeks that were counted from the items are all searched again, so the two sources are never mixed
+    state["source"] = "full"
+    generate_heatmap_data.update_heatmap_search_counts("owner", "name", events, client, mock_logger, now=now)
+    assert len(searched.call_args[0][0]) == 152
+
+
+def test_build_activity_histograms():
+    issues = {1: generate_heatmap_data.issue_record_from_document(
+        1, {"created_at": "2021-06-30T12:00:00Z", "state": "open", "closed_at": None})}
+    pull_requests = {"1": generate_heatmap_data.pull_request_record_from_document(
+        "1", {"created_at": "2021-08-02T00:00:00Z", "merged_at": "2021-08-04T08:00:00Z",
+              "closed_at": "2021-08-04T08:00:00Z", "state": "closed"})}
+    commits = [CommitRecord("1", "A", datetime.datetime(2021, 7, 31, 23, 59, tzinfo=datetime.timezone.utc))]
+    events = generate_heatmap_data.EventIndex(issues, pull_requests, commits)
+
+    now = datetime.datetime(2021, 8, 4, 12, tzinfo=datetime.timezone.utc)
+    histograms = generate_heatmap_data.build_activity_histograms(events, now, {"day": 5, "week": 2, "month": 3})
+    assert histograms["day"] == {
+        "start": ["2021-07-31", "2021-08-01", "2021-08-02", "2021-08-03", "2021-08-04"],
+        "issues_open": [1, 1, 1, 1, 1],
+        "pull_requests_created": [0, 0, 1, 0, 0],
+        "pull_requests_merged": [0, 0, 0, 0, 1],
+        "pull_requests_closed": [0, 0, 0, 0, 1],
+        "commits_created": [1, 0, 0, 0, 0],
+    }
+    assert histograms["week"]["start"] == ["2021-07-26", "2021-08-02"]
+    assert histograms["week"]["commits_created"] == [1, 0]
+    assert histograms["week"]["pull_requests_created"] == [0, 1]
+    assert histograms["month"]["start"] == ["2021-06", "2021-07", "2021-08"]
+    assert histograms["month"]["issues_open"] == [0, 1, 1]
+    assert histograms["month"]["commits_created"] == [0, 1, 0]
 
 
 def test_retrieve_issues(mock_logger):
@@ -122,6 +274,7 @@ def test_retrieve_issues(mock_logger):
 
     mock_collection = MagicMock()
     mock_collection.find = MagicMock(return_value={})
+    mock_collection.find_one = MagicMock(return_value=None)
     mock_collection.update_one = MagicMock(return_value={})
     with_options_mock = MagicMock()
     with_options_mock.with_options = MagicMock(return_value=mock_collection)
@@ -136,31 +289,88 @@ def test_retrieve_issues(mock_logger):
     data = generate_heatmap_data.retrieve_issues(owner, name, repo, 1, mock_client, mock_logger)
 
     mock_collection.find.assert_called_once()
-
-    assert data == {
-        "1": {
-            "user": "user_a",
-            "created_at": "2020-01-12T12:00:00Z",
-            "updated_at": "2020-01-14T12:00:00Z",
-            "closed_at": None,
-            "state": "open",
-            "comments": [
-                {"user": "user_b", "created_at": "2020-01-14T12:00:00Z"}
-            ]
-        },
-        "2": {
-            "user": "user_b",
-            "created_at": "2020-01-12T12:00:00Z",
-            "updated_at": "2020-01-12T12:00:00Z",
-            "closed_at": "2020-01-12T12:00:00Z",
-            "state": "closed",
-            "comments": [
-                {"user": "user_c", "created_at": "2020-01-20T12:00:00Z"},
-                {"user": "user_d", "created_at": "2020-01-21T12:00:00Z"},
-            ]
-        },
+    # only the fields used by the heatmap are read from mongodb
+    assert mock_collection.find.call_args[0][1] == generate_heatmap_data.ISSUE_PROJECTION
+
+    def date(string):
+        return datetime.datetime.strptime(string, "%Y-%m-%dT%H:%M:%S%z")
+
+    assert data.previous is None
+    assert data.updated_at == date("2020-01-14T12:00:00Z")
+    assert data.records == {
+        "1": generate_heatmap_data.IssueRecord("1", "open", date("2020-01-12T12:00:00Z"),
+                                               date("2020-01-14T12:00:00Z"), None),
+        "2": generate_heatmap_data.IssueRecord("2", "closed", date("2020-01-12T12:00:00Z"),
+                                               date("2020-01-12T12:00:00Z"), date("2020-01-12T12:00:00Z")),
     }
 
+    # the whole issue is still stored in mongodb, with every upsert sent in one unordered bulk write
+    mock_collection.bulk_write.assert_called_once()
+    operations = mock_collection.bulk_write.call_args[0][0]
+    assert mock_collection.bulk_write.call_args[1] == {"ordered": False}
+    assert len(operations) == 2
+    assert operations[1] == UpdateOne({"name": name, "owner": owner, "id": "2"}, {"$set": {
+        "user": "user_b",
+        "created_at": date("2020-01-12T12:00:00Z"),
+        "updated_at": date("2020-01-12T12:00:00Z"),
+        "closed_at": date("2020-01-12T12:00:00Z"),
+        "state": "closed",
+        "comments": [
+            {"user": "user_c", "created_at": "2020-01-20T12:00:00Z"},
+            {"user": "user_d", "created_at": "2020-01-21T12:00:00Z"},
+        ]
+    }}, upsert=True)
+
+
+def test_retrieve_issues_since_the_previous_heatmap(mock_logger):
+    def date(string):
+        return datetime.datetime.strptime(string, "%Y-%m-%dT%H:%M:%S%z")
+
+    repo = MagicMock()
+    repo.fetch.return_value = [{"data": {"number": "1", "user": {"login": "user_a"},
+                                         "created_at": "2020-01-12T12:00:00Z", "updated_at": "2020-02-01T12:00:00Z",
+                                         "closed_at": None, "state": "open"}}]
+    collection = MagicMock()
+    collection.with_options.return_value = collection
+    collection.find_one.return_value = {"updated_at": date("2020-01-20T12:00:00Z")}
+    collection.find.return_value = [{"id": "1", "state": "closed", "created_at": date("2020-01-12T12:00:00Z"),
+                                     "updated_at": date("2020-01-20T12:00:00Z"),
+                                     "closed_at": date("2020-01-20T12:00:00Z")}]
+
+    data = generate_heatmap_data.retrieve_issues("owner", "name", repo, 1, {"test_db": {"issues": collection}},
+                                                 mock_logger, since=date("2020-01-20T12:00:00Z"))
+
+    assert repo.fetch.call_args[1]["from_date"] == date("2020-01-20T12:00:00Z")
+    # only the stored versions of the fetched issues are read, before they are overwritten
+    collection.find.assert_called_once()
+    assert collection.find.call_args[0][0] == {"name": "name", "owner": "owner", "id": {"$in": ["1"]}}
+    assert data.previous == {"1": generate_heatmap_data.IssueRecord(
+        "1", "closed", date("2020-01-12T12:00:00Z"), date("2020-01-20T12:00:00Z"), date("2020-01-20T12:00:00Z"))}
+    assert list(data.records) == ["1"] and data.records["1"].state == "open"
+    assert data.updated_at == date("2020-02-01T12:00:00Z")
+    collection.bulk_write.assert_called_once()
+
+
+def test_get_counted_item_dates(mocker):
+    date = datetime.datetime(2021, 8, 20, tzinfo=datetime.timezone.utc)
+    collection = MagicMock()
+    collection.with_options.return_value = collection
+    collection.find_one.return_value = {"heatmap_state": {
+        "source": "full",
+        "dimensions": list(generate_heatmap_data.HEATMAP_DIMENSIONS),
+        "resolutions": generate_heatmap_data.ACTIVITY_RESOLUTIONS,
+        "items": {"issues": {"since": date - datetime.timedelta(weeks=152), "updated_at": date},
+                  "pull_requests": {"since": date - datetime.timedelta(weeks=152), "updated_at": date}}}}
+    client = {"test_db": {"repositories": collection, "issues": collection, "pull_requests": collection}}
+
+    latest_update = mocker.patch('src.pipeline.generate_heatmap_data.get_latest_update', return_value=date)
+    assert generate_heatmap_data.get_counted_item_dates("owner", "name", client) == {
+        "issues": date, "pull_requests": date}
+    # items were stored after the heatmap, so every item has to be counted again
+    latest_update.return_value = date + datetime.timedelta(hours=1)
+    assert generate_heatmap_data.get_counted_item_dates("owner", "name", client) is None
+    assert generate_heatmap_data.get_counted_item_dates("owner", "name", client, dimensions=(2, 2)) is None
+
 
 def test_retrieve_pull_requests(mock_logger):
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -177,6 +387,7 @@ def test_retrieve_pull_requests(mock_logger):
 
     mock_collection = MagicMock()
     mock_collection.find = MagicMock(return_value={})
+    mock_collection.find_one = MagicMock(return_value=None)
     mock_collection.update_one = MagicMock(return_value={})
     with_options_mock = MagicMock()
     with_options_mock.with_options = MagicMock(return_value=mock_collection)
@@ -191,47 +402,16 @@ def test_retrieve_pull_requests(mock_logger):
     actual_data = generate_heatmap_data.retrieve_pull_requests(owner, name, repo, 1, mock_client, mock_logger)
 
     mock_collection.find.assert_called_once()
+    assert mock_collection.find.call_args[0][1] == generate_heatmap_data.PULL_REQUEST_PROJECTION
 
-    assert actual_data == expected_data
-
-
-def test_retrieve_commits():
-    repo = generate_fake_repo('test_repo.json')
-
-    actual_result = generate_heatmap_data.retrieve_commits(repo)
-    expected_result = [
-        {
-            "hexsha": "abcdef",
-            "committed_datetime": "2020-01-09 15:38:43+01:00",
-            "author": {"name": "Stephen A"}
-        },
-        {
-            "hexsha": "abcde",
-            "committed_datetime": "2020-02-09 15:38:43+01:00",
-            "author": {"name": "Stephen B"}
-        },
-        {
-            "hexsha": "abcd",
-            "committed_datetime": "2020-05-09 15:38:43+01:00",
-            "author": {"name": "Stephen C"}
-        },
-        {
-            "hexsha": "ab",
-            "committed_datetime": "2020-05-09 15:38:43+01:00",
-            "author": {"name": "Stephen E"}
-        },
-        {
-            "hexsha": "a",
-            "committed_datetime": "2020-06-09 15:38:43+01:00",
-            "author": {"name": "Stephen F"}
-        }
-    ]
-    date_format = "%Y-%m-%d %H:%M:%S%z"
-
-    assert len(expected_result) == len(actual_result)
+    assert actual_data.records == {
+        num: generate_heatmap_data.pull_request_record_from_document(num, pr) for num, pr in expected_data.items()
+    }
 
-    for i, _ in enumerate(expected_result):
-        assert expected_result[i]["hexsha"] == actual_result[i].hexsha
-        c_date = datetime.datetime.strptime(expected_result[i]["committed_datetime"], date_format)
-        assert c_date == actual_result[i].committed_datetime
-        assert expected_result[i]["author"]["name"] == actual_result[i].author.name
+    # the whole pull request is still stored in mongodb, with the dates as datetime objects
+    operations = mock_collection.bulk_write.call_args[0][0]
+    stored = {op._filter["id"]: op._doc["$set"] for op in operations}
+    for num, pr in expected_data.items():
+        for field in ["created_at", "closed_at", "updated_at", "merged_at"]:
+            pr[field] = generate_heatmap_data.parse_date(pr[field])
+    assert stored == expected_data
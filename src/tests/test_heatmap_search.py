@@ -0,0 +1,117 @@
+import datetime
+import json
+import random
+import re
+
+from src.pipeline import generate_heatmap_data, heatmap_search
+from src.pipeline.commit_index import CommitRecord
+from src.pipeline.http_client import RetryingSession
+
+URL = "https://example.com/graphql"
+UTC = datetime.timezone.utc
+
+
+def parse_search_date(date):
+    return datetime.datetime.strptime(date, heatmap_search.SEARCH_DATE_FORMAT).replace(tzinfo=UTC)
+
+
+def matches(item, query):
+    """
+    Evaluates the qualifiers used by heatmap_search against an issue or pull request
+    """
+    for qualifier in query.split()[1:]:
+        key, value = qualifier.split(":", 1)
+        if key == "is":
+            if value in ("issue", "pr"):
+                if item["type"] != value:
+                    return False
+            elif item["state"] != value:
+                return False
+            continue
+        date = item[f"{key}_at"]
+        if date is None:
+            return False
+        if value.startswith("<"):
+            if not date < parse_search_date(value[1:]):
+                return False
+        elif value.startswith(">"):
+            if not date > parse_search_date(value[1:]):
+                return False
+        else:
+            first, last = value.split("..")
+            if not parse_search_date(first) <= date <= parse_search_date(last):
+                return False
+    return True
+
+
+def fake_search(items):
+    def callback(request, context):
+        query = request.json()["query"]
+        results = {alias: {"issueCount": sum(matches(item, json.loads(search)) for item in items)}
+                   for alias, search in re.findall(r'(q\d+): search\(query: ("(?:[^"\\]|\\.)*")', query)}
+        return {"data": results}
+    return callback
+
+
+def test_search_counts_match_the_event_index(requests_mock):
+    rng = random.Random(7)
+    now = datetime.datetime(2021, 8, 29, 10, 30, tzinfo=UTC)
+
+    def random_date():
+        return now - datetime.timedelta(seconds=rng.randrange(0, 30 * 7 * 24 * 60 * 60))
+
+    items = []
+    issues = {}
+    pull_requests = {}
+    for i in range(300):
+        created = random_date()
+        closed = created + datetime.timedelta(seconds=rng.randrange(0, 60 * 24 * 60 * 60))
+        closed = closed if closed < now and rng.random() < 0.6 else None
+        state = "closed" if closed is not None else "open"
+        # like retrieve_issues, the issues include the pull requests, since the github issues list does
+        issues[i] = generate_heatmap_data.IssueRecord(i, state, created, created, closed)
+        if i % 2:
+            items.append({"type": "issue", "state": state, "created_at": created, "closed_at": closed})
+        else:
+            merged = closed if closed is not None and rng.random() < 0.5 else None
+            pull_requests[i] = generate_heatmap_data.PullRequestRecord(i, state, created, created, closed, merged)
+            items.append({"type": "pr", "state": state, "created_at": created, "closed_at": closed,
+                          "merged_at": merged})
+    commits = [CommitRecord(str(i), "A", random_date()) for i in range(50)]
+
+    requests_mock.post(URL, json=fake_search(items))
+    session = RetryingSession(sleep=lambda seconds: None)
+    weeks = generate_heatmap_data.get_heatmap_weeks(20, now)
+
+    expected = generate_heatmap_data.count_heatmap_weeks(
+        generate_heatmap_data.EventIndex(issues, pull_requests, commits), weeks)
+    actual = generate_heatmap_data.count_heatmap_weeks(
+        heatmap_search.SearchCountIndex("owner", "name", commits, url=URL, session=session), weeks)
+    assert actual == expected
+    assert sum(week["issues"]["open"] for week in actual) > 0
+    assert sum(week["pull_requests"]["merged"] for week in actual) > 0
+    # five searches for each week, sent 50 at a time
+    assert requests_mock.call_count == 2
+
+
+def test_choose_heatmap_source(requests_mock, mock_logger, mocker):
+    collection = mocker.MagicMock()
+    client = {"test_db": {"repositories": collection}}
+    since = datetime.datetime(2021, 1, 1, tzinfo=UTC)
+    session = RetryingSession(sleep=lambda seconds: None)
+
+    collection.find_one.return_value = {"heatmap_source": "counts"}
+    assert heatmap_search.choose_heatmap_source("owner", "name", client, since, mock_logger, URL, session) == "counts"
+    assert requests_mock.call_count == 0
+
+    # in auto mode the source depends on the number of items updated since the start of the heatmap
+    collection.find_one.return_value = None
+    requests_mock.post(URL, json={"data": {"q0": {"issueCount": heatmap_search.SEARCH_MIN_ITEMS}}})
+    assert heatmap_search.choose_heatmap_source("owner", "name", client, since, mock_logger, URL, session) == "counts"
+    assert "updated:>=2021-01-01T00:00:00Z" in requests_mock.last_request.json()["query"]
+    requests_mock.post(URL, json={"data": {"q0": {"issueCount": 10}}})
+    assert heatmap_search.choose_heatmap_source("owner", "name", client, since, mock_logger, URL, session) == "full"
+
+    # a failed search falls back to fetching every item
+    requests_mock.post(URL, json={"data": None, "errors": [{"message": "rate limited"}]})
+    assert heatmap_search.choose_heatmap_source("owner", "name", client, since, mock_logger, URL, session) == "full"
@@ -0,0 +1,43 @@
+from src.pipeline import http_cache
+from src.pipeline.http_client import RetryingSession
+
+URL = "https://api.github.com/repos/owner/name/releases?per_page=100&page=1"
+
+
+def test_cached_get_revalidates_with_the_etag(requests_mock, tmpdir):
+    session = RetryingSession(sleep=lambda seconds: None)
+    link = '<https://api.github.com/repos/owner/name/releases?per_page=100&page=2>; rel="next"'
+    requests_mock.get(URL, json=[{"tag_name": "v1"}], headers={"ETag": '"abc"', "Link": link})
+    first = http_cache.cached_get(URL, cache_dir=tmpdir, session=session)
+    assert first.json() == [{"tag_name": "v1"}]
+    assert "If-None-Match" not in requests_mock.last_request.headers
+
+    requests_mock.get(URL, status_code=304)
+    second = http_cache.cached_get(URL, cache_dir=tmpdir, session=session)
+    assert requests_mock.last_request.headers["If-None-Match"] == '"abc"'
+    assert second.status_code == 200
+    assert second.json() == [{"tag_name": "v1"}]
+    # the pagination links are kept with the cached body
+    assert second.links["next"]["url"].endswith("page=2")
+
+    # a different media type is a different cache entry
+    http_cache.cached_get(URL, cache_dir=tmpdir, session=session, headers={"Accept": "application/vnd.github.v3+json"})
+    assert "If-None-Match" not in requests_mock.last_request.headers
+
+
+def test_cached_get_only_stores_responses_with_validators(requests_mock, tmpdir):
+    session = RetryingSession(sleep=lambda seconds: None)
+    requests_mock.get(URL, json=[])
+    http_cache.cached_get(URL, cache_dir=tmpdir, session=session)
+    assert http_cache.load_cache_entry(http_cache.get_cache_path(URL, cache_dir=tmpdir)) is None
+
+    requests_mock.get(URL, json=[], headers={"Last-Modified": "Tue, 01 Jun 2021 00:00:00 GMT"})
+    http_cache.cached_get(URL, cache_dir=tmpdir, session=session)
+    http_cache.cached_get(URL, cache_dir=tmpdir, session=session)
+    assert requests_mock.last_request.headers["If-Modified-Since"] == "Tue, 01 Jun 2021 00:00:00 GMT"
+
+    # errors are returned as they are and do not replace the cached body
+    requests_mock.get(URL, status_code=400, headers={"ETag": '"error"'})
+    assert http_cache.cached_get(URL, cache_dir=tmpdir, session=session).status_code == 400
+    entry = http_cache.load_cache_entry(http_cache.get_cache_path(URL, cache_dir=tmpdir))
+    assert "ETag" not in entry["headers"]
@@ -0,0 +1,51 @@
+import pytest
+import requests
+
+from src.pipeline import http_client
+from src.pipeline.http_client import RetryingSession
+
+URL = "https://api.github.com/repos/owner/name"
+
+
+def test_session_retries_server_errors_and_rate_limits(requests_mock):
+    sleeps = []
+    session = RetryingSession(max_retries=3, sleep=sleeps.append)
+    requests_mock.get(URL, [
+        {"status_code": 502},
+        {"status_code": 403, "headers": {"Retry-After": "7"}, "text": "You have exceeded a secondary rate limit"},
+        {"status_code": 200, "json": {"name": "name"}},
+    ])
+    response = session.get(URL)
+    assert response.json() == {"name": "name"}
+    assert requests_mock.call_count == 3
+    assert 0 <= sleeps[0] <= http_client.BACKOFF_BASE
+    assert sleeps[1] == 7
+    # the default timeout is used for every attempt
+    assert requests_mock.request_history[0].timeout == http_client.HTTP_TIMEOUT
+
+    # other client errors are returned straight away
+    requests_mock.get(URL, status_code=404)
+    assert session.get(URL).status_code == 404
+    assert len(sleeps) == 2
+
+
+def test_session_gives_up_after_the_last_retry(requests_mock):
+    sleeps = []
+    session = RetryingSession(max_retries=2, sleep=sleeps.append)
+    requests_mock.get(URL, status_code=503)
+    assert session.get(URL).status_code == 503
+    assert len(sleeps) == 2
+
+    requests_mock.get(URL, exc=requests.ConnectionError)
+    with pytest.raises(requests.ConnectionError):
+        session.get(URL)
+    assert len(sleeps) == 4
+
+
+def test_get_backoff_is_jittered_and_capped(mocker):
+    response = mocker.MagicMock()
+    response.headers = {}
+    for attempt in range(10):
+        assert 0 <= http_client.get_backoff(attempt, response, base=1, maximum=8) <= min(8, 2 ** attempt)
+    response.headers = {"Retry-After": "600"}
+    assert http_client.get_backoff(0, response, maximum=60) == 60
@@ -0,0 +1,91 @@
+import json
+import os
+from unittest.mock import MagicMock
+
+import git
+
+from src.pipeline import loc_cache, pipeline
+
+
+def fake_cloc(counted):
+    """
+    Stands in for 'cloc --by-file --json': every line of a '.py' file is code, other files are not counted
+    """
+    def run(command, cwd=None, **kwargs):
+        output = {"header": {}}
+        for root, _, files in os.walk(cwd):
+            for name in files:
+                path = os.path.relpath(os.path.join(root, name), cwd)
+                counted.append(path)
+                if name.endswith(".py"):
+                    with open(os.path.join(root, name)) as f:
+                        output[f"./{path}"] = {"blank": 0, "comment": 0, "code": len(f.read().splitlines()),
+                                               "language": "Python"}
+        # like cloc, the paths are printed as they are on disk
+        stdout = json.dumps(output, ensure_ascii=False).encode("utf-8", errors="surrogateescape")
+        return MagicMock(returncode=0, stdout=stdout, stderr=b"")
+    return run
+
+
+def test_tags_only_count_the_changed_files(tmpdir, mock_logger, mocker):
+    remote = git.Repo.init(os.path.join(tmpdir, "remote"))
+    remote.git.config("uploadpack.allowFilter", "true")
+    files = {"a.py": "1\n2\n", "copy.py": "1\n2\n", "b.py": "1\n", "README": "text\n"}
+    for version, changes in enumerate([files, {"b.py": "1\n2\n3\n"}]):
+        for name, content in changes.items():
+            with open(os.path.join(tmpdir, "remote", name), 'w') as f:
+                f.write(content)
+        remote.index.add(list(changes))
+        remote.index.commit(f"commit {version}")
+        remote.create_tag(f"v{version}")
+    mocker.patch('src.pipeline.pipeline.REMOTE_URL_TEMPLATE', "file://" + os.path.join(str(tmpdir), "{name}"))
+    mirror = pipeline.mirror_repo('owner', 'remote', mock_logger, print_progress=False,
+                                  cache_dir=os.path.join(tmpdir, "mirrors"), blobless=True)
+
+    counted = []
+    git_run = loc_cache.subprocess.run
+    run = mocker.patch('subprocess.run', side_effect=lambda command, **kwargs:
+                       fake_cloc(counted)(command, **kwargs) if kwargs.get("shell") else git_run(command, **kwargs))
+    cache_path = os.path.join(tmpdir, "loc_cache.sqlite3")
+
+    loc = loc_cache.count_revision_loc_cached(mirror.git_dir, "v0", cache_path=cache_path)
+    # the identical copy is counted once, like cloc does, and the README is not counted
+    assert loc == {"Python": {"nFiles": 2, "blank": 0, "comment": 0, "code": 3},
+                   "SUM": {"nFiles": 2, "blank": 0, "comment": 0, "code": 3}}
+    assert len(counted) == 3
+    # the missing file contents were downloaded with a single request
+    assert sum(1 for call in run.call_args_list if "fetch" in call[0][0]) == 1
+
+    counted.clear()
+    loc = loc_cache.count_revision_loc_cached(mirror.git_dir, "v1", cache_path=cache_path)
+    assert loc["Python"]["code"] == 5
+    assert counted == [os.path.join(remote.commit("v1").tree["b.py"].hexsha, "b.py")]
+
+    # every file is cached now, so cloc is not run again
+    counted.clear()
+    assert loc_cache.count_revision_loc_cached(mirror.git_dir, "v0", cache_path=cache_path)["SUM"]["code"] == 3
+    assert counted == []
+    mirror.close()
+
+
+def test_file_names_that_are_not_utf8(tmpdir, mocker):
+    repo = git.Repo.init(os.path.join(tmpdir, "repo"))
+    repo.git.config("user.name", "test")
+    repo.git.config("user.email", "test@test.com")
+    with open(os.path.join(os.fsencode(repo.working_tree_dir), "caf\xe9.py".encode("latin-1")), "wb") as f:
+        f.write(b"1\n2\n")
+    repo.git.add(A=True)
+    repo.git.commit(m="latin-1 file name")
+
+    counted = []
+    git_run = loc_cache.subprocess.run
+    mocker.patch('subprocess.run', side_effect=lambda command, **kwargs:
+                 fake_cloc(counted)(command, **kwargs) if kwargs.get("shell") else git_run(command, **kwargs))
+    cache_path = os.path.join(tmpdir, "loc_cache.sqlite3")
+
+    for _ in range(2):
+        loc = loc_cache.count_revision_loc_cached(repo.working_tree_dir, "HEAD", cache_path=cache_path)
+        assert loc["Python"] == {"nFiles": 1, "blank": 0, "comment": 0, "code": 2}
+    # the second count was answered from the cache
+    assert len(counted) == 1
+    repo.close()
@@ -0,0 +1,69 @@
+from unittest.mock import MagicMock
+
+from pymongo import UpdateOne
+
+from src.pipeline import mongo_helpers
+
+
+def test_bulk_upserter_flushes_by_size_and_time():
+    collection = MagicMock()
+    now = [0]
+    writer = mongo_helpers.BulkUpserter(collection, batch_size=3, flush_interval=10, clock=lambda: now[0])
+
+    writer.upsert({"id": 1}, {"a": 1})
+    writer.upsert({"id": 2}, {"a": 2})
+    collection.bulk_write.assert_not_called()
+
+    writer.upsert({"id": 3}, {"a": 3})
+    collection.bulk_write.assert_called_once_with([
+        UpdateOne({"id": 1}, {"$set": {"a": 1}}, upsert=True),
+        UpdateOne({"id": 2}, {"$set": {"a": 2}}, upsert=True),
+        UpdateOne({"id": 3}, {"$set": {"a": 3}}, upsert=True),
+    ], ordered=False)
+
+    # a slow fetch flushes a small batch once the interval has passed
+    writer.upsert({"id": 4}, {"a": 4})
+    now[0] = 10
+    writer.upsert({"id": 5}, {"a": 5})
+    assert collection.bulk_write.call_count == 2
+    assert len(collection.bulk_write.call_args[0][0]) == 2
+
+
+def test_bulk_upserter_flushes_on_exit():
+    collection = MagicMock()
+    try:
+        with mongo_helpers.BulkUpserter(collection) as writer:
+            writer.upsert({"id": 1}, {"a": 1})
+            raise ValueError("fetch failed")
+    except ValueError:
+        pass
+    collection.bulk_write.assert_called_once_with([UpdateOne({"id": 1}, {"$set": {"a": 1}}, upsert=True)],
+                                                  ordered=False)
+
+    # a document upserted twice before a flush is written once, with the later fields
+    collection = MagicMock()
+    with mongo_helpers.BulkUpserter(collection) as writer:
+        writer.upsert({"id": 1}, {"a": 1, "b": 1})
+        writer.upsert({"id": 2}, {"a": 2})
+        writer.upsert({"id": 1}, {"a": 3})
+    collection.bulk_write.assert_called_once_with([UpdateOne({"id": 1}, {"$set": {"a": 3, "b": 1}}, upsert=True),
+                                                   UpdateOne({"id": 2}, {"$set": {"a": 2}}, upsert=True)],
+                                                  ordered=False)
+
+    # nothing is written when there are no pending upserts
+    collection = MagicMock()
+    with mongo_helpers.BulkUpserter(collection):
+        pass
+    collection.bulk_write.assert_not_called()
+
+
+def test_ensure_indexes():
+    collections = {name: MagicMock() for name in ["issues", "pull_requests", "releases"]}
+    client = {"test_db": collections}
+    mongo_helpers.ensure_indexes(client)
+
+    issue_keys = [c[0][0] for c in collections["issues"].create_index.call_args_list]
+    assert [("owner", 1), ("name", 1), ("id", 1)] in issue_keys
+    assert [("owner", 1), ("name", 1), ("updated_at", 1)] in issue_keys
+    assert collections["pull_requests"].create_index.call_count == 2
+    collections["releases"].create_index.assert_called_once_with([("owner", 1), ("name", 1), ("tag_name", 1)])
@@ -0,0 +1,62 @@
+import os
+import time
+
+from src.pipeline import repo_cache
+
+
+def create_fake_mirror(cache_dir, owner, name, size, last_used, in_use=False):
+    mirror_path = repo_cache.get_mirror_path(owner, name, cache_dir)
+    os.makedirs(mirror_path)
+    with open(os.path.join(mirror_path, "pack"), 'wb') as f:
+        f.write(b"0" * size)
+    repo_cache.mark_mirror_used(mirror_path)
+    os.utime(os.path.join(mirror_path, repo_cache.LAST_USED_FILE), (last_used, last_used))
+    if not in_use:
+        repo_cache.release_mirror(mirror_path)
+    return mirror_path
+
+
+def test_get_mirror_path_is_keyed_by_owner():
+    assert repo_cache.get_mirror_path("a", "repo", "cache") != repo_cache.get_mirror_path("b", "repo", "cache")
+
+
+def test_evict_mirrors_removes_least_recently_used(tmpdir, mock_logger):
+    cache_dir = str(tmpdir)
+    oldest = create_fake_mirror(cache_dir, "a", "old", 1000, last_used=100)
+    middle = create_fake_mirror(cache_dir, "b", "middle", 1000, last_used=200)
+    newest = create_fake_mirror(cache_dir, "c", "new", 1000, last_used=300)
+
+    removed = repo_cache.evict_mirrors(mock_logger, cache_dir, quota=2500)
+
+    assert removed == [oldest]
+    assert os.path.exists(middle)
+    assert os.path.exists(newest)
+
+
+def test_evict_mirrors_skips_mirrors_in_use(tmpdir, mock_logger):
+    cache_dir = str(tmpdir)
+    in_use = create_fake_mirror(cache_dir, "a", "in_use", 1000, last_used=100, in_use=True)
+    unused = create_fake_mirror(cache_dir, "b", "unused", 1000, last_used=200)
+
+    removed = repo_cache.evict_mirrors(mock_logger, cache_dir, quota=1500)
+
+    assert removed == [unused]
+    assert os.path.exists(in_use)
+
+
+def test_each_process_has_its_own_in_use_marker(tmpdir, mock_logger):
+    mirror_path = create_fake_mirror(str(tmpdir), "a", "shared", 1000, last_used=100)
+    repo_cache.mark_mirror_used(mirror_path, pid=1)
+    repo_cache.mark_mirror_used(mirror_path, pid=2)
+
+    # one run finishing does not release the mirror while the other run is still using it
+    repo_cache.release_mirror(mirror_path, pid=1)
+    assert repo_cache.is_mirror_in_use(mirror_path)
+    assert repo_cache.evict_mirrors(mock_logger, str(tmpdir), quota=0) == []
+
+    repo_cache.release_mirror(mirror_path, pid=2)
+    assert not repo_cache.is_mirror_in_use(mirror_path)
+
+    # a marker left over from a crashed run stops protecting the mirror after IN_USE_TIMEOUT
+    repo_cache.mark_mirror_used(mirror_path, pid=3)
+    assert not repo_cache.is_mirror_in_use(mirror_path, now=time.time() + repo_cache.IN_USE_TIMEOUT + 1)
@@ -0,0 +1,53 @@
+import threading
+
+import pytest
+
+from src.pipeline import stages
+from src.pipeline.exceptions import *
+
+
+def test_run_stages_passes_results_to_dependents(mock_logger):
+    stage_list = [
+        stages.Stage("sum", lambda r: r["a"] + r["b"], requires=["a", "b"]),
+        stages.Stage("a", lambda r: 1),
+        stages.Stage("b", lambda r: 2),
+    ]
+    results = stages.run_stages(stage_list, mock_logger)
+    assert results == {"a": 1, "b": 2, "sum": 3}
+
+
+def test_run_stages_runs_independent_stages_concurrently(mock_logger):
+    # both stages wait for each other, so this only finishes if they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+    stage_list = [
+        stages.Stage("a", lambda r: barrier.wait()),
+        stages.Stage("b", lambda r: barrier.wait()),
+    ]
+    results = stages.run_stages(stage_list, mock_logger, max_workers=2)
+    assert set(results.keys()) == {"a", "b"}
+
+
+def test_run_stages_failure_skips_dependents(mock_logger):
+    called = []
+
+    def fail(results):
+        raise ValueError("failed")
+
+    stage_list = [
+        stages.Stage("a", fail),
+        stages.Stage("b", lambda r: called.append("b"), requires=["a"]),
+    ]
+    with pytest.raises(ValueError):
+        stages.run_stages(stage_list, mock_logger)
+    assert called == []
+
+
+def test_order_stages_invalid_graphs():
+    with pytest.raises(InvalidArgumentError):
+        stages.order_stages([stages.Stage("a", None, requires=["missing"])])
+
+    with pytest.raises(InvalidArgumentError):
+        stages.order_stages([stages.Stage("a", None, requires=["b"]), stages.Stage("b", None, requires=["a"])])
+
+    with pytest.raises(InvalidArgumentError):
+        stages.order_stages([stages.Stage("a", None), stages.Stage("a", None)])